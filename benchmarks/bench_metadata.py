@@ -0,0 +1,447 @@
+"""
+Measure the cost of metadata operations as the number of files grows.
+
+Run with::
+
+    python benchmarks/bench_metadata.py [--files N ...] [--output FILE]
+
+The results are printed as JSON, or written to FILE, so that they can be
+compared between versions. Each result is the best time out of ``--repeat``
+runs. Loading a processing block uses the memory backend of the config DB.
+
+The memory used per file entry is compared between the records used by
+MetaData, plain dictionaries and dictionaries wrapped by benedict, which is
+how entries were kept before, and measured for a whole MetaData object.
+The memory used by data products cloned from one MetaData object is
+compared with that of independent copies.
+
+With ``--baseline FILE``, the results are compared with those in FILE, and
+the exit status is 1 if any benchmark is slower by more than the factor
+given by ``--tolerance``.
+"""
+
+import argparse
+import copy
+import functools
+import importlib.metadata
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench_yaml_backends import metadata_document
+from benedict import benedict
+
+from ska_sdp_dataproduct_metadata import (
+    MetaData,
+    config,
+    serialisation,
+    sidecar,
+)
+from ska_sdp_dataproduct_metadata.filetable import FileRecord
+
+EB_ID = "eb-test-20200325-00001"
+PB_ID = "pb-test-20200425-00000"
+
+# name of a metadata file with a sidecar in the temporary directory
+MIRRORED = "mirrored.yaml"
+
+# number of data products created from the same metadata
+PRODUCTS = 1000
+
+
+def best_time(function, repeat, setup=None):
+    """
+    Return the best time out of repeat calls of function, in seconds. If
+    setup is given, it is called before each call, untimed, and its result
+    is passed to function.
+    """
+    times = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def file_paths(n_files):
+    """Paths of the data products in the benchmark metadata."""
+    return [f"output/chunk-{index:06d}.ms" for index in range(n_files)]
+
+
+def metadata_with_files(n_files, output_path=None):
+    """
+    Create a MetaData object with n_files files, deferring writes.
+
+    :returns: the MetaData object and the list of its files
+    """
+    metadata = MetaData(autoflush=False)
+    metadata.output_path = output_path
+    metadata.set_execution_block_id(EB_ID)
+    files = metadata.new_files(
+        {"dp_path": path, "description": "visibility chunk"}
+        for path in file_paths(n_files)
+    )
+    return metadata, files
+
+
+def new_files_one_by_one(n_files):
+    """Register n_files files with new_file."""
+    metadata = MetaData(autoflush=False)
+    for path in file_paths(n_files):
+        metadata.new_file(dp_path=path, description="visibility chunk")
+
+
+def update_statuses(files):
+    """Update the status of files with update_status."""
+    for file in files:
+        file.update_status("done")
+
+
+def file_dicts(n_files):
+    """File entries as plain dictionaries."""
+    return [
+        {
+            "crc": None,
+            "description": "visibility chunk",
+            "path": path,
+            "status": "working",
+        }
+        for path in file_paths(n_files)
+    ]
+
+
+def file_records(n_files):
+    """File entries as records."""
+    return [FileRecord(entry) for entry in file_dicts(n_files)]
+
+
+def benedict_dicts(n_files):
+    """File entries as dictionaries wrapped by benedict on access."""
+    data = benedict({"files": file_dicts(n_files)})
+    # accessing the list wraps every entry
+    return data, data.files
+
+
+def allocated_bytes(function):
+    """Return the memory allocated by a function and still in use."""
+    tracemalloc.start()
+    try:
+        result = function()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def memory_usage(n_files):
+    """Measure the memory used per file entry, yielding the results."""
+    representations = {
+        "records": lambda: file_records(n_files),
+        "dicts": lambda: file_dicts(n_files),
+        "benedict_dicts": lambda: benedict_dicts(n_files),
+        "metadata": lambda: metadata_with_files(n_files),
+    }
+    for name, function in representations.items():
+        yield {
+            "benchmark": f"memory_{name}",
+            "files": n_files,
+            "bytes_per_file": allocated_bytes(function) / max(n_files, 1),
+        }
+
+
+def base_metadata():
+    """Metadata of a processing block with a large context."""
+    metadata = MetaData(autoflush=False)
+    metadata.set_execution_block_id(EB_ID)
+    metadata.get_data().context = {
+        f"scan-{index}": {"scan_type": "science", "duration": 60.0}
+        for index in range(1000)
+    }
+    # the sections of metadata handed out by get_data are copied into each
+    # clone, so clone it once for the clones to share them
+    return metadata.clone()
+
+
+def cloned_products(base):
+    """Clone data products from metadata, adding a file to each."""
+    products = [base.clone() for _ in range(PRODUCTS)]
+    for product in products:
+        product.new_file(dp_path="vis.ms", description="visibilities")
+    return products
+
+
+def copied_products(base):
+    """
+    Create data products with copies of the sections of metadata, adding a
+    file to each.
+    """
+    sections = {
+        key: value
+        for key, value in base.get_data().dict().items()
+        if key != "files"
+    }
+    products = []
+    for _ in range(PRODUCTS):
+        product = MetaData(autoflush=False)
+        product.get_data().update(copy.deepcopy(sections))
+        product.new_file(dp_path="vis.ms", description="visibilities")
+        products.append(product)
+    return products
+
+
+def clone_memory_usage():
+    """
+    Measure the memory used per data product by clones and by copies,
+    yielding the results.
+    """
+    base = base_metadata()
+    for name, function in [
+        ("clones", cloned_products),
+        ("copies", copied_products),
+    ]:
+        yield {
+            "benchmark": f"memory_{name}",
+            "products": PRODUCTS,
+            "bytes_per_product": allocated_bytes(
+                functools.partial(function, base)
+            )
+            / PRODUCTS,
+        }
+
+
+def import_time(repeat):
+    """Time importing the package in a new interpreter, in seconds."""
+
+    def run(code):
+        return best_time(
+            lambda: subprocess.run([sys.executable, "-c", code], check=True),
+            repeat,
+        )
+
+    return run("import ska_sdp_dataproduct_metadata") - run("pass")
+
+
+def load_processing_block_time(repeat):
+    """
+    Time loading a processing block from the memory backend of the config
+    DB, in seconds.
+    """
+    # pylint: disable-next=import-outside-toplevel
+    import ska_sdp_config
+
+    config.FEATURE_CONFIG_DB = False
+    client = config.get_config_client()
+    script = {"kind": "realtime", "name": "vis-receive", "version": "0.6.0"}
+    for txn in client.txn():
+        txn.execution_block.create(
+            ska_sdp_config.ExecutionBlock(key=EB_ID, subarray_id="01")
+        )
+        txn.processing_block.create(
+            ska_sdp_config.ProcessingBlock(
+                key=PB_ID, eb_id=EB_ID, script=script, parameters={}
+            )
+        )
+        txn.script.create(
+            ska_sdp_config.entity.Script(
+                key=ska_sdp_config.entity.Script.Key(**script),
+                image="artefact.skao.int/ska-sdp-script-vis-receive:0.6.0",
+            )
+        )
+
+    with tempfile.TemporaryDirectory() as mount_path:
+        return best_time(
+            lambda: MetaData().load_processing_block(PB_ID, mount_path),
+            repeat,
+        )
+
+
+def _changed_after_validation(path):
+    """Read metadata, validate it and add one file."""
+    metadata = MetaData(path, autoflush=False)
+    metadata.validate(incremental=True)
+    metadata.new_file(dp_path="output/new.ms", description="new file")
+    return metadata
+
+
+def _changed_copies(path):
+    """Read metadata twice, and change the status of a file in one."""
+    metadata, other = MetaData(path), MetaData(path)
+    other.get_data().files[0]["status"] = "failure"
+    return metadata, other
+
+
+def _status_patch(path):
+    """Read metadata, and make a patch changing the status of a file."""
+    metadata = MetaData(path, autoflush=False)
+    ops = [{"op": "replace", "path": "/files/0/status", "value": "failure"}]
+    return metadata, {"base": 0, "sequence": 1, "ops": ops}
+
+
+def cases(n_files, path, tmp_dir):
+    """
+    Return the benchmarks for a number of files, as a dictionary of their
+    names to tuples of the function to time and its setup function.
+
+    :param n_files: number of files
+    :param path: path of a metadata file with n_files files
+    :param tmp_dir: directory to write metadata files to
+    """
+    return {
+        "new_file": (lambda: new_files_one_by_one(n_files), None),
+        "new_files": (lambda: metadata_with_files(n_files), None),
+        "update_status": (
+            lambda setup: update_statuses(setup[1]),
+            lambda: metadata_with_files(n_files),
+        ),
+        "validate": (
+            lambda metadata: metadata.validate(),
+            lambda: MetaData(path),
+        ),
+        "validate_incremental": (
+            lambda metadata: metadata.validate(incremental=True),
+            lambda: _changed_after_validation(path),
+        ),
+        "write": (
+            lambda setup: setup[0].write(),
+            lambda: metadata_with_files(
+                n_files, os.path.join(tmp_dir, "output.yaml")
+            ),
+        ),
+        "diff": (
+            lambda setup: setup[0].diff(setup[1]),
+            lambda: _changed_copies(path),
+        ),
+        "apply_patch": (
+            lambda setup: setup[0].apply_patch(setup[1]),
+            lambda: _status_patch(path),
+        ),
+        "read": (lambda: MetaData(path), None),
+        "read_lazy": (lambda: MetaData(path, lazy=True), None),
+        "peek": (lambda: MetaData.peek(path), None),
+        "read_sidecar": (
+            lambda: MetaData(os.path.join(tmp_dir, MIRRORED)),
+            None,
+        ),
+    }
+
+
+def run_benchmarks(files, repeat, tmp_dir):
+    """Run the benchmarks, yielding the results."""
+    yield {"benchmark": "import", "seconds": import_time(repeat)}
+    yield {"benchmark": "construct", "seconds": best_time(MetaData, repeat)}
+    yield {
+        "benchmark": "clone",
+        "products": PRODUCTS,
+        "seconds": best_time(cloned_products, repeat, base_metadata),
+    }
+    yield from clone_memory_usage()
+    try:
+        yield {
+            "benchmark": "load_processing_block",
+            "seconds": load_processing_block_time(repeat),
+        }
+    except ImportError:
+        print("ska_sdp_config is not installed", file=sys.stderr)
+
+    path = os.path.join(tmp_dir, "ska-data-product.yaml")
+    for n_files in files:
+        document = metadata_document(n_files)
+        for metadata_path in (path, os.path.join(tmp_dir, MIRRORED)):
+            with open(metadata_path, "w", encoding="utf8") as metadata_file:
+                metadata_file.write(serialisation.dump(document))
+        sidecar.write(os.path.join(tmp_dir, MIRRORED), document)
+        for name, (function, setup) in cases(n_files, path, tmp_dir).items():
+            seconds = best_time(function, repeat, setup)
+            yield {
+                "benchmark": name,
+                "files": n_files,
+                "seconds": seconds,
+                "per_file_us": seconds / max(n_files, 1) * 1e6,
+            }
+        yield from memory_usage(n_files)
+
+
+def environment():
+    """Describe the environment the benchmarks run in."""
+    try:
+        version = importlib.metadata.version("ska-sdp-dataproduct-metadata")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    return {
+        "package_version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "yaml_backend": serialisation.DEFAULT_BACKEND,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Find the benchmarks that are slower than in the baseline.
+
+    :returns: list of messages describing the regressions
+    """
+    baseline_seconds = {
+        (result["benchmark"], result.get("files")): result["seconds"]
+        for result in baseline["results"]
+        if "seconds" in result
+    }
+    messages = []
+    for result in results["results"]:
+        key = (result["benchmark"], result.get("files"))
+        if key in baseline_seconds and "seconds" in result:
+            ratio = result["seconds"] / baseline_seconds[key]
+            if ratio > tolerance:
+                name = (
+                    key[0] if key[1] is None else f"{key[0]} ({key[1]} files)"
+                )
+                messages.append(
+                    f"{name} is {ratio:.2f} times slower than the baseline"
+                )
+    return messages
+
+
+def main(argv=None):
+    """Run the benchmarks and print or save the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--files", type=int, nargs="+", default=[10, 100, 1000, 10000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--baseline", help="results to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = {
+            "environment": environment(),
+            "results": list(run_benchmarks(args.files, args.repeat, tmp_dir)),
+        }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf8") as baseline_file:
+            baseline = json.load(baseline_file)
+        messages = regressions(results, baseline, args.tolerance)
+        for message in messages:
+            print(message, file=sys.stderr)
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Compare the speed of the YAML backends for reading and writing metadata.
+
+Run with::
+
+    python benchmarks/bench_yaml_backends.py [--files N ...]
+
+The results are printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from ska_sdp_dataproduct_metadata import serialisation
+
+
+def metadata_document(n_files):
+    """Create a metadata document with n_files file entries."""
+    return {
+        "interface": "http://schema.skao.int/ska-data-product-meta/0.1",
+        "execution_block": "eb-test-20200325-00001",
+        "context": {"observer": "AIV person", "intent": "benchmark"},
+        "config": {
+            "processing_block": "pb-test-20200425-00000",
+            "processing_script": "vis-receive",
+            "image": "artefact.skao.int/ska-sdp-script-vis-receive",
+            "version": "0.6.0",
+            "cmdline": None,
+            "commit": None,
+        },
+        "files": [
+            {
+                "crc": str(1000000000 + index),
+                "description": "visibility chunk",
+                "path": f"output/chunk-{index:06d}.ms",
+                "size": 1024 * index,
+                "status": "done",
+            }
+            for index in range(n_files)
+        ],
+        "obscore": {
+            "dataproduct_type": "MS",
+            "obs_collection": "Unknown",
+            "access_format": "application/unknown",
+            "facility_name": "SKA-Observatory",
+            "instrument_name": "SKA-LOW",
+        },
+    }
+
+
+def best_time(function, repeat):
+    """Return the best time out of repeat calls of function, in seconds."""
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main(argv=None):
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--files", type=int, nargs="+", default=[100, 1000, 10000]
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "ska-data-product.yaml")
+        for n_files in args.files:
+            document = metadata_document(n_files)
+            outputs = set()
+            for backend in serialisation.BACKENDS:
+                text = serialisation.dump(document, backend)
+                outputs.add(text)
+                with open(path, "w", encoding="utf8") as yaml_file:
+                    yaml_file.write(text)
+                results.append(
+                    {
+                        "backend": backend,
+                        "files": n_files,
+                        "bytes": len(text.encode("utf8")),
+                        "dump_s": best_time(
+                            lambda d=document, b=backend: serialisation.dump(
+                                d, b
+                            ),
+                            args.repeat,
+                        ),
+                        "load_s": best_time(
+                            lambda b=backend: serialisation.load_file(path, b),
+                            args.repeat,
+                        ),
+                    }
+                )
+            if len(outputs) != 1:
+                raise RuntimeError("Backends produced different output")
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
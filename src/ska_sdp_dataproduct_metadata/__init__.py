@@ -1,7 +1,14 @@
 """SDP Data Product Metadata."""
 
-from .config import new_config_client
+from .config import get_config_client, new_config_client
 from .metadata import MetaData
 from .obscore import ObsCore
+from .templates import register_template
 
-__all__ = ["MetaData", "ObsCore", "new_config_client"]
+__all__ = [
+    "MetaData",
+    "ObsCore",
+    "get_config_client",
+    "new_config_client",
+    "register_template",
+]
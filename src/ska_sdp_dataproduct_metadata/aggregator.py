@@ -0,0 +1,425 @@
+"""
+Aggregating changes to one metadata file from many worker processes.
+
+An :class:`Aggregator` owns a :class:`MetaData` object and receives
+``new_file`` and ``update_status`` messages from workers over a Unix domain
+socket. It applies them in memory and writes the metadata file on a timer or
+after a number of messages, so that the workers never read or write the file
+themselves. Workers use an :class:`AggregatorClient`, which has the same API
+as :class:`MetaData` for registering files.
+
+The protocol is one JSON object per line in each direction: every request
+gets a reply, which contains an ``error`` if the request failed.
+
+The aggregator can run in a thread of the processing script, or as a
+separate process::
+
+    python -m ska_sdp_dataproduct_metadata.aggregator SOCKET METADATA
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+from . import checksum
+from .metadata import MetaData
+
+LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server with a thread per connected worker."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, aggregator):
+        self.aggregator = aggregator
+        super().__init__(socket_path, _Handler)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Handle the requests of one worker, one JSON object per line."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as err:
+                reply = {"error": str(err), "type": "ValueError"}
+            else:
+                reply = self.server.aggregator.handle(request)
+            self.wfile.write(json.dumps(reply).encode("utf8") + b"\n")
+
+
+class Aggregator:  # pylint: disable=too-many-instance-attributes
+    """
+    Server applying the changes received from workers to a metadata file.
+
+    Changes are written when ``flush_count`` of them are pending, every
+    ``flush_interval`` seconds, when a worker calls ``flush()``, and when
+    the aggregator is closed. Each change is validated when it is received:
+    an invalid change is undone and its error returned only to the worker
+    which sent it. If writing fails, the error is logged and returned to all
+    later requests.
+
+    :param metadata: MetaData object to apply the changes to. Its output
+        path determines where the metadata file is written.
+    :param socket_path: path of the Unix domain socket to listen on
+    :param flush_interval: maximum time in seconds before changes are
+        written
+    :param flush_count: number of pending changes after which they are
+        written
+    """
+
+    def __init__(
+        self, metadata, socket_path, flush_interval=1.0, flush_count=1000
+    ):
+        metadata.autoflush = False
+        self.metadata = metadata
+        self.socket_path = socket_path
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._error = None
+        self._server = _Server(socket_path, self)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """
+        Start serving workers in background threads.
+
+        :returns: the aggregator
+        """
+        self._start_thread(self._server.serve_forever)
+        return self
+
+    def serve_forever(self):
+        """
+        Serve workers until :meth:`close` is called from another thread or
+        a signal handler.
+        """
+        self._start_thread(None)
+        self._server.serve_forever()
+
+    def close(self):
+        """
+        Stop serving workers, write any pending changes and remove the
+        socket.
+        """
+        self._stop.set()
+        if self._threads:
+            self._server.shutdown()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+        self._server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.socket_path)
+        with self._lock:
+            self.metadata.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def handle(self, request):
+        """
+        Apply a request from a worker.
+
+        :param request: dictionary with the operation ``op`` and its
+            arguments
+        :returns: dictionary with the reply
+        """
+        try:
+            with self._lock:
+                if self._error is not None:
+                    return self._error
+                reply = self._apply(request)
+                if self._pending >= self.flush_count:
+                    self._flush()
+                    if self._error is not None:
+                        return self._error
+                return reply
+        except MetaData.ValidationError as err:
+            return {
+                "error": str(err),
+                "type": "ValidationError",
+                "errors": [error.message for error in err.errors],
+            }
+        except (KeyError, TypeError, ValueError) as err:
+            return {"error": str(err), "type": "ValueError"}
+
+    def _apply(self, request):
+        """Apply a request to the metadata, holding the lock."""
+        operation = request["op"]
+        # pylint: disable=protected-access
+        if operation == "new_file":
+            with self.metadata._validated_files([request["dp_path"]]):
+                file = self.metadata.new_file(
+                    dp_path=request["dp_path"],
+                    description=request.get("description"),
+                    crc=request.get("crc"),
+                )
+            self._pending += 1
+            return {"path": file.path, "full_path": file.full_path}
+        if operation == "new_files":
+            dp_paths = [file["dp_path"] for file in request["files"]]
+            with self.metadata._validated_files(dp_paths):
+                files = self.metadata.new_files(
+                    {
+                        "dp_path": file["dp_path"],
+                        "description": file.get("description"),
+                        "crc": file.get("crc"),
+                    }
+                    for file in request["files"]
+                )
+            self._pending += len(files)
+            return {
+                "files": [
+                    {"path": file.path, "full_path": file.full_path}
+                    for file in files
+                ]
+            }
+        if operation == "update_status":
+            with self.metadata._validated_files([request["path"]]):
+                self.metadata._update_status(
+                    request["path"], request["status"], request.get("crc")
+                )
+            self._pending += 1
+            return {}
+        if operation == "flush":
+            self._flush()
+            return self._error or {}
+        raise ValueError(f"Unknown operation {operation}")
+
+    def _flush(self):
+        """Write pending changes, holding the lock."""
+        self._pending = 0
+        try:
+            self.metadata.flush()
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            LOG.exception("Writing aggregated metadata failed")
+            self._error = {
+                "error": f"Writing metadata failed: {err}",
+                "type": "RuntimeError",
+            }
+
+    def _flush_periodically(self):
+        """Write pending changes every flush_interval seconds."""
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                if self._error is None and self.metadata.dirty:
+                    self._flush()
+
+    def _start_thread(self, target):
+        """Start the flushing thread, and a thread running target."""
+        for function in (self._flush_periodically, target):
+            if function is not None:
+                thread = threading.Thread(target=function, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+
+class AggregatorClient:
+    """
+    Client registering files with an :class:`Aggregator`, with the same API
+    as :class:`MetaData` for registering files and updating their status.
+
+    CRCs requested with ``compute_crc`` are computed in the worker. The
+    client may be shared by the threads of a worker, but not between
+    processes.
+
+    :param socket_path: path of the Unix domain socket of the aggregator
+    :param timeout: timeout in seconds for each request, or None to wait
+        forever
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(socket_path)
+        self._stream = self._socket.makefile("rwb")
+        self._lock = threading.Lock()
+
+    def new_file(
+        self, dp_path=None, description=None, crc=None, compute_crc=False
+    ):
+        """
+        Register a new file, see :meth:`MetaData.new_file`.
+
+        :returns: instance of the AggregatedFile class
+        """
+        reply = self._request(
+            {
+                "op": "new_file",
+                "dp_path": dp_path,
+                "description": description,
+                "crc": crc,
+            }
+        )
+        return AggregatedFile(self, **reply, compute_crc=compute_crc)
+
+    def new_files(self, files):
+        """
+        Register several new files at once, see :meth:`MetaData.new_files`.
+
+        :returns: list of instances of the AggregatedFile class
+        """
+        files = list(files)
+        reply = self._request(
+            {
+                "op": "new_files",
+                "files": [
+                    {
+                        "dp_path": file["dp_path"],
+                        "description": file.get("description"),
+                        "crc": file.get("crc"),
+                    }
+                    for file in files
+                ],
+            }
+        )
+        return [
+            AggregatedFile(
+                self, **entry, compute_crc=file.get("compute_crc", False)
+            )
+            for file, entry in zip(files, reply["files"])
+        ]
+
+    def flush(self):
+        """Ask the aggregator to write pending changes now."""
+        self._request({"op": "flush"})
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager for compatibility with :meth:`MetaData.batch`. The
+        aggregator batches writes itself, so this has no effect.
+        """
+        yield self
+
+    def close(self):
+        """Disconnect from the aggregator."""
+        self._stream.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _request(self, request):
+        """Send a request and wait for the reply, raising its error."""
+        with self._lock:
+            self._stream.write(json.dumps(request).encode("utf8") + b"\n")
+            self._stream.flush()
+            line = self._stream.readline()
+        if not line:
+            raise ConnectionError("The aggregator closed the connection")
+        reply = json.loads(line)
+        if "error" not in reply:
+            return reply
+        if reply["type"] == "ValidationError":
+            raise MetaData.ValidationError(reply["error"], reply["errors"])
+        if reply["type"] == "ValueError":
+            raise ValueError(reply["error"])
+        raise RuntimeError(reply["error"])
+
+
+class AggregatedFile:
+    """
+    A file registered through an :class:`AggregatorClient`, with the same
+    API as :class:`File`.
+    """
+
+    def __init__(self, client, path, full_path, compute_crc=False):
+        self._client = client
+        self._path = path
+        self._full_path = full_path
+        self._compute_crc = compute_crc
+
+    @property
+    def path(self):
+        """Get the path of the data product."""
+        return self._path
+
+    @property
+    def full_path(self):
+        """Get the full path object."""
+        return self._full_path
+
+    def update_status(self, status):
+        """
+        Update the current file status.
+
+        :param: status: status to be updated to
+        """
+        request = {"op": "update_status", "path": self._path}
+        if status == "done" and self._compute_crc:
+            request["crc"] = str(
+                checksum.crc32_path(
+                    self._full_path, max_workers=MetaData.crc_workers
+                )
+            )
+            self._compute_crc = False
+        request["status"] = status
+        # pylint: disable-next=protected-access
+        self._client._request(request)
+
+
+def main(argv=None):
+    """
+    Run an aggregator for an existing metadata file until it is interrupted
+    or terminated.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("socket", help="path of the Unix socket")
+    parser.add_argument("metadata", help="path of the metadata file")
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=1.0,
+        help="maximum time in seconds before changes are written",
+    )
+    parser.add_argument(
+        "--flush-count",
+        type=int,
+        default=1000,
+        help="number of changes after which they are written",
+    )
+    args = parser.parse_args(argv)
+
+    metadata = MetaData(args.metadata)
+    metadata.output_path = args.metadata
+    aggregator = Aggregator(
+        metadata,
+        args.socket,
+        flush_interval=args.flush_interval,
+        flush_count=args.flush_count,
+    )
+
+    def stop(*_):
+        # shutting down the server waits for serve_forever to return, so it
+        # must not be done in the thread running it
+        threading.Thread(target=aggregator.close).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    LOG.info("Aggregating changes to %s on %s", args.metadata, args.socket)
+    aggregator.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
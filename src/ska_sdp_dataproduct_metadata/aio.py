@@ -0,0 +1,205 @@
+"""
+asyncio interface to the metadata.
+
+Changes are applied to the metadata in the event loop, and the metadata file
+is written in a separate thread, so that slow storage does not block the
+loop. Writes requested while another one is in flight are coalesced into a
+single write.
+"""
+
+import asyncio
+import contextlib
+
+from . import checksum
+from .metadata import MetaData
+
+
+class AsyncMetaData:
+    """
+    asyncio wrapper of a :class:`MetaData` object, for registering files
+    and updating their status from coroutines.
+
+    Each change is written before the coroutine making it returns, as with
+    :class:`MetaData`. At most one write of the metadata file is in flight;
+    changes made meanwhile are written together by the next write. The
+    metadata is validated and copied in the event loop, and serialised and
+    written in a thread.
+
+    :param metadata: MetaData object to wrap, by default a new one. It must
+        not use a journal, coordinated writes or a write interval, and must
+        not be changed directly while it is wrapped.
+    """
+
+    def __init__(self, metadata=None):
+        if metadata is None:
+            metadata = MetaData()
+        # pylint: disable-next=protected-access
+        background = metadata._writer is not None
+        if metadata.journal or metadata.coordinated or background:
+            raise ValueError(
+                "AsyncMetaData does not support journals, coordinated "
+                "writes or background writes"
+            )
+        metadata.autoflush = False
+        self._metadata = metadata
+        # Number of changes made, and the number included in the metadata
+        # file last written
+        self._changes = 0
+        self._written = 0
+        self._write_task = None
+        # Depth of nested batch contexts
+        self._batches = 0
+
+    @property
+    def metadata(self):
+        """The wrapped MetaData object."""
+        return self._metadata
+
+    async def load_processing_block(self, pb_id=None, mount_path=None):
+        """
+        Load a processing block from the config DB in a thread, see
+        :meth:`MetaData.load_processing_block`.
+        """
+        await asyncio.to_thread(
+            self._metadata.load_processing_block, pb_id, mount_path
+        )
+        await self._changed()
+
+    async def new_file(
+        self, dp_path=None, description=None, crc=None, compute_crc=False
+    ):
+        """
+        Register a new file and write the metadata, see
+        :meth:`MetaData.new_file`. CRCs requested with ``compute_crc`` are
+        computed in a thread.
+
+        :returns: instance of the AsyncFile class
+        """
+        file = self._metadata.new_file(
+            dp_path=dp_path, description=description, crc=crc
+        )
+        await self._changed()
+        return AsyncFile(self, file, compute_crc)
+
+    async def new_files(self, files):
+        """
+        Register several new files and write the metadata once, see
+        :meth:`MetaData.new_files`.
+
+        :returns: list of instances of the AsyncFile class
+        """
+        files = list(files)
+        new_files = self._metadata.new_files(
+            {key: value for key, value in file.items() if key != "compute_crc"}
+            for file in files
+        )
+        await self._changed()
+        return [
+            AsyncFile(self, new_file, file.get("compute_crc", False))
+            for file, new_file in zip(files, new_files)
+        ]
+
+    async def flush(self):
+        """
+        Write the metadata if there are changes that have not been written.
+        If a write is in flight, wait for it, and write again if there were
+        changes made after it started.
+        """
+        changes = self._changes
+        while self._written < changes:
+            if self._write_task is None:
+                self._write_task = asyncio.create_task(self._write())
+            # a cancelled caller does not cancel the write shared with others
+            await asyncio.shield(self._write_task)
+
+    async def close(self):
+        """Write any pending changes."""
+        await self.flush()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.close()
+
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        """
+        Asynchronous context manager to defer writing the metadata until
+        the outermost context exits, see :meth:`MetaData.batch`.
+        """
+        self._batches += 1
+        try:
+            yield self
+        finally:
+            self._batches -= 1
+        if self._batches == 0:
+            await self.flush()
+
+    async def _changed(self):
+        """Write the metadata after a change, unless in a batch."""
+        self._changes += 1
+        if self._batches == 0:
+            await self.flush()
+
+    async def _write(self):
+        """
+        Validate and copy the metadata in the event loop, then write the
+        copy in a thread, as :meth:`MetaData.write` does.
+        """
+        try:
+            changes = self._changes
+            # pylint: disable-next=protected-access
+            pending = self._metadata._prepare_write(copy_data=True)
+            try:
+                await asyncio.to_thread(pending.write)
+            except BaseException:
+                # pylint: disable-next=protected-access
+                self._metadata._dirty = True
+                raise
+            # pylint: disable-next=protected-access
+            self._metadata._complete_write(pending)
+            self._written = changes
+        finally:
+            self._write_task = None
+
+
+class AsyncFile:
+    """A file registered with :class:`AsyncMetaData`."""
+
+    def __init__(self, metadata, file, compute_crc=False):
+        self._metadata = metadata
+        self._file = file
+        self._compute_crc = compute_crc
+
+    @property
+    def path(self):
+        """Get the path of the data product."""
+        return self._file.path
+
+    @property
+    def full_path(self):
+        """Get the full path object."""
+        return self._file.full_path
+
+    async def update_status(self, status):
+        """
+        Update the current file status and write the metadata.
+
+        :param: status: status to be updated to
+        """
+        crc = None
+        if status == "done" and self._compute_crc:
+            crc = str(
+                await asyncio.to_thread(
+                    checksum.crc32_path,
+                    self.full_path,
+                    max_workers=MetaData.crc_workers,
+                )
+            )
+            self._compute_crc = False
+        # pylint: disable-next=protected-access
+        self._metadata.metadata._update_status(self.path, status, crc)
+        # pylint: disable-next=protected-access
+        await self._metadata._changed()
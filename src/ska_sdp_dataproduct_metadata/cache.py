@@ -0,0 +1,243 @@
+"""Cache of execution blocks and scripts read from the config DB."""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .config import get_config_client
+
+LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
+
+EXECUTION_BLOCK = "execution_block"
+SCRIPT = "script"
+
+
+class ConfigCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Local cache of the execution blocks and scripts read from the config
+    DB, which rarely change while a processing script runs.
+
+    Entries expire after ``ttl`` seconds, and the least recently used
+    entries are evicted when there are more than ``max_size`` of one kind.
+    If ``watch`` is set, a thread watches the cached entries in the config
+    DB and drops those that change or are deleted. The watcher only reads
+    the cached entries again when entries were added or the config DB
+    reported a change, and otherwise every ``refresh_interval`` seconds.
+
+    To use it when loading processing blocks, set
+    ``MetaData.config_cache = ConfigCache()``.
+
+    :param config: config DB client, defaults to the shared client
+    :param ttl: time in seconds after which an entry expires, or None for
+        no expiry
+    :param max_size: maximum number of entries of each kind
+    :param watch: whether to start the watcher thread
+    :param watch_interval: maximum time in seconds before the watcher
+        starts watching a newly cached entry
+    :param refresh_interval: time in seconds after which the watcher reads
+        the cached entries again, even if the config DB reported no change
+    """
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        config=None,
+        ttl=300.0,
+        max_size=1024,
+        watch=True,
+        watch_interval=1.0,
+        refresh_interval=60.0,
+    ):
+        self._config = config or get_config_client()
+        self.ttl = ttl
+        self.max_size = max_size
+        self.watch_interval = watch_interval
+        self.refresh_interval = refresh_interval
+        # kind -> key -> (record, key in the config DB, expiry time)
+        self._entries = {EXECUTION_BLOCK: OrderedDict(), SCRIPT: OrderedDict()}
+        self._lock = threading.Lock()
+        # Incremented when an entry is added, to watch it
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._stop = threading.Event()
+        # Set if the watcher failed, after which the cache is not used
+        self._failed = False
+        self._watcher = None
+        if watch:
+            self._watcher = threading.Thread(
+                target=self._watch, name="ConfigCache watcher", daemon=True
+            )
+            self._watcher.start()
+
+    def stats(self):
+        """
+        Return the counters of the cache.
+
+        :returns: dictionary with the number of ``hits``, ``misses``,
+            ``evictions`` (expired or least recently used entries) and
+            ``invalidations`` (entries changed in the config DB), and the
+            current ``size``
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "size": sum(
+                    len(entries) for entries in self._entries.values()
+                ),
+            }
+
+    def execution_block(self, txn, eb_id):
+        """
+        Get an execution block, reading it in the transaction on a miss.
+
+        :param txn: config DB transaction
+        :param eb_id: execution block ID
+        :returns: the execution block, or None if it does not exist
+        """
+        return self._get(
+            EXECUTION_BLOCK,
+            eb_id,
+            lambda: txn.execution_block.get(eb_id),
+        )
+
+    def script(self, txn, script_key):
+        """
+        Get a script, reading it in the transaction on a miss.
+
+        :param txn: config DB transaction
+        :param script_key: key of the script (``Script.Key``)
+        :returns: the script, or None if it does not exist
+        """
+        return self._get(
+            SCRIPT,
+            (script_key.kind, script_key.name, script_key.version),
+            lambda: txn.script.get(script_key),
+            script_key,
+        )
+
+    def invalidate(self):
+        """Drop all entries."""
+        with self._lock:
+            for entries in self._entries.values():
+                entries.clear()
+
+    def close(self):
+        """Stop the watcher thread."""
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _get(self, kind, key, read, config_key=None):
+        """
+        Get an entry from the cache, or read and store it on a miss.
+        Records that do not exist are not cached.
+        """
+        entries = self._entries[kind]
+        now = time.monotonic()
+        with self._lock:
+            entry = entries.get(key)
+            if entry is not None:
+                record, _, expiry = entry
+                if expiry is None or expiry > now:
+                    entries.move_to_end(key)
+                    self.hits += 1
+                    return record
+                del entries[key]
+                self.evictions += 1
+            self.misses += 1
+
+        record = read()
+        if record is None or self._failed:
+            return record
+
+        expiry = None if self.ttl is None else now + self.ttl
+        with self._lock:
+            entries[key] = (record, config_key or key, expiry)
+            entries.move_to_end(key)
+            self._generation += 1
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+                self.evictions += 1
+        return record
+
+    def _watch(self):
+        """
+        Watch the cached entries in the config DB, dropping those that
+        changed. The config DB wakes the watcher when a watched entry
+        changes; the timeout makes it pick up newly cached entries.
+
+        Reading the entries in the watcher transaction is what makes the
+        config DB watch them, so they are only read again when the watcher
+        was woken before the timeout, i.e. by a change, when entries were
+        added, or after ``refresh_interval``, which also catches a change
+        reported at the same time as the timeout.
+        """
+        # generation and time of the last reading of the entries, and time
+        # the watcher last started waiting
+        generation, read_time = None, None
+        waited = time.monotonic()
+        try:
+            for watcher in self._config.watcher(timeout=self.watch_interval):
+                if self._stop.is_set():
+                    break
+                now = time.monotonic()
+                woken = now - waited < self.watch_interval
+                waited = now
+                if (
+                    not woken
+                    and generation == self._generation
+                    and now - read_time < self.refresh_interval
+                ):
+                    continue
+                generation = self._generation
+                read_time = now
+                for txn in watcher.txn():
+                    stale = self._find_stale(txn)
+                self._drop(stale)
+                waited = time.monotonic()
+        except Exception:  # pylint: disable=broad-exception-caught
+            LOG.exception("Config DB cache watcher failed, disabling cache")
+            self._failed = True
+            self.invalidate()
+
+    def _find_stale(self, txn):
+        """
+        Read the cached entries in a transaction and find those that differ
+        from the cached records.
+        """
+        with self._lock:
+            cached = {
+                kind: [
+                    (key, record, config_key)
+                    for key, (record, config_key, _) in entries.items()
+                ]
+                for kind, entries in self._entries.items()
+            }
+        readers = {
+            EXECUTION_BLOCK: txn.execution_block.get,
+            SCRIPT: txn.script.get,
+        }
+        return [
+            (kind, key, record)
+            for kind, records in cached.items()
+            for key, record, config_key in records
+            if readers[kind](config_key) != record
+        ]
+
+    def _drop(self, stale):
+        """Drop entries, unless they were replaced in the meantime."""
+        with self._lock:
+            for kind, key, record in stale:
+                entry = self._entries[kind].get(key)
+                if entry is not None and entry[0] is record:
+                    del self._entries[kind][key]
+                    self.invalidations += 1
@@ -0,0 +1,271 @@
+"""Catalogue of the metadata files below a data product mount."""
+
+import logging
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from . import serialisation
+from .metadata import METADATA_FILENAME
+
+LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    execution_block TEXT,
+    processing_block TEXT,
+    dataproduct_type TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    product TEXT NOT NULL REFERENCES products(path) ON DELETE CASCADE,
+    path TEXT,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS products_execution_block
+    ON products(execution_block);
+CREATE INDEX IF NOT EXISTS products_processing_block
+    ON products(processing_block);
+CREATE INDEX IF NOT EXISTS products_dataproduct_type
+    ON products(dataproduct_type);
+CREATE INDEX IF NOT EXISTS files_product ON files(product);
+CREATE INDEX IF NOT EXISTS files_status ON files(status);
+"""
+
+
+def find_metadata_files(root, filename=METADATA_FILENAME):
+    """
+    Find the metadata files below a directory. The directories below one
+    containing a metadata file hold its data products, so they are not
+    searched.
+
+    :param root: directory to search
+    :param filename: name of the metadata files
+    :returns: dictionary of the paths of the metadata files to their
+        modification time in nanoseconds
+    """
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if filename in filenames:
+            path = os.path.join(dirpath, filename)
+            found[path] = os.stat(path).st_mtime_ns
+            dirnames.clear()
+    return found
+
+
+def extract(path):
+    """
+    Extract the fields indexed by the catalogue from a metadata file.
+
+    :param path: path of the metadata file
+    :returns: tuple of a dictionary with the fields of the product and a
+        list of tuples of the path and status of its files
+    """
+    data = serialisation.load_file(path) or {}
+    config = data.get("config") or {}
+    obscore = data.get("obscore") or {}
+    product = {
+        "execution_block": data.get("execution_block"),
+        "processing_block": config.get("processing_block"),
+        "dataproduct_type": obscore.get("dataproduct_type"),
+    }
+    files = [
+        (file.get("path"), file.get("status"))
+        for file in data.get("files") or []
+    ]
+    return product, files
+
+
+def _extract_or_none(path):
+    """Extract fields from a metadata file, or None if it cannot be read."""
+    try:
+        return extract(path)
+    # AttributeError and TypeError are raised by YAML which is not a mapping
+    # of the expected sections
+    except (
+        AttributeError,
+        OSError,
+        TypeError,
+        ValueError,
+        yaml.YAMLError,
+    ) as err:
+        LOG.warning("Cannot read metadata file %s: %s", path, err)
+        return None
+
+
+class Catalogue:
+    """
+    SQLite index of the metadata files below a data product mount, such as
+    ``/product/<eb_id>/ska-sdp/<pb_id>/ska-data-product.yaml``.
+
+    The index records the execution block, processing block and data
+    product type of each product, and the path and status of its files. It
+    is kept up to date with :meth:`refresh`, which only reads the metadata
+    files that were added or modified since the previous refresh.
+
+    :param db_path: path of the SQLite database
+    :param root: directory below which metadata files are searched
+    :param filename: name of the metadata files
+    """
+
+    def __init__(self, db_path, root, filename=METADATA_FILENAME):
+        self.root = root
+        self.filename = filename
+        self._connection = sqlite3.connect(db_path)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database."""
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def refresh(self, processes=None):
+        """
+        Bring the index up to date with the metadata files.
+
+        Metadata files that are new, or whose modification time changed,
+        are read; if there are many of them, they are read in a process
+        pool. Products whose metadata file disappeared are removed.
+
+        :param processes: number of processes to read metadata files with,
+            defaults to one per CPU. Use 1 to read them in this process.
+        :returns: tuple of the numbers of products updated and removed
+        """
+        found = find_metadata_files(self.root, self.filename)
+        indexed = dict(
+            self._connection.execute("SELECT path, mtime_ns FROM products")
+        )
+        changed = sorted(
+            path for path, mtime in found.items() if indexed.get(path) != mtime
+        )
+        removed = [path for path in indexed if path not in found]
+
+        if processes == 1 or len(changed) < 2:
+            extracted = list(map(_extract_or_none, changed))
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                extracted = list(
+                    executor.map(_extract_or_none, changed, chunksize=64)
+                )
+
+        updated = 0
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM products WHERE path = ?",
+                [(path,) for path in removed + changed],
+            )
+            for path, fields in zip(changed, extracted):
+                if fields is None:
+                    continue
+                product, files = fields
+                self._connection.execute(
+                    "INSERT INTO products (path, mtime_ns, execution_block, "
+                    "processing_block, dataproduct_type) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        path,
+                        found[path],
+                        product["execution_block"],
+                        product["processing_block"],
+                        product["dataproduct_type"],
+                    ),
+                )
+                self._connection.executemany(
+                    "INSERT INTO files (product, path, status) "
+                    "VALUES (?, ?, ?)",
+                    [(path, file_path, status) for file_path, status in files],
+                )
+                updated += 1
+        return updated, len(removed)
+
+    def query(
+        self,
+        execution_block=None,
+        processing_block=None,
+        dataproduct_type=None,
+        status=None,
+    ):
+        """
+        Find products. All criteria that are given must match.
+
+        For example, all processing blocks of an execution block with any
+        file in failure::
+
+            {
+                product["processing_block"]
+                for product in catalogue.query(
+                    execution_block="eb-...", status="failure"
+                )
+            }
+
+        :param execution_block: execution block ID
+        :param processing_block: processing block ID
+        :param dataproduct_type: ObsCore data product type
+        :param status: status that any file of the product has
+        :returns: list of dictionaries with the ``path`` of the metadata
+            file, ``execution_block``, ``processing_block`` and
+            ``dataproduct_type`` of the matching products
+        """
+        conditions = []
+        parameters = []
+        for column, value in (
+            ("execution_block", execution_block),
+            ("processing_block", processing_block),
+            ("dataproduct_type", dataproduct_type),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        if status is not None:
+            conditions.append(
+                "EXISTS (SELECT 1 FROM files "
+                "WHERE files.product = products.path AND files.status = ?)"
+            )
+            parameters.append(status)
+
+        sql = (
+            "SELECT path, execution_block, processing_block, "
+            "dataproduct_type FROM products"
+        )
+        if conditions:
+            # the conditions only contain fixed column names and placeholders
+            sql += " WHERE " + " AND ".join(conditions)  # nosec B608
+        sql += " ORDER BY path"
+
+        columns = (
+            "path",
+            "execution_block",
+            "processing_block",
+            "dataproduct_type",
+        )
+        return [
+            dict(zip(columns, row))
+            for row in self._connection.execute(sql, parameters)
+        ]
+
+    def files(self, path, status=None):
+        """
+        List the files of a product.
+
+        :param path: path of the metadata file of the product
+        :param status: only list files with this status
+        :returns: list of tuples of the path and status of the files
+        """
+        sql = "SELECT path, status FROM files WHERE product = ?"
+        parameters = [path]
+        if status is not None:
+            sql += " AND status = ?"
+            parameters.append(status)
+        return list(
+            self._connection.execute(sql + " ORDER BY rowid", parameters)
+        )
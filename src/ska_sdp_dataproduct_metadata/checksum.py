@@ -0,0 +1,78 @@
+"""Computing CRC checksums of data product files."""
+
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the chunks in which files are read
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def crc32_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Compute the CRC-32 of a file, reading it in chunks so that large files
+    are never held in memory.
+
+    :param path: path of the file
+    :param chunk_size: size of the chunks to read, in bytes
+    :returns: the CRC-32, as an unsigned integer
+    """
+    crc = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as data_file:
+        while size := data_file.readinto(buffer):
+            crc = zlib.crc32(view[:size], crc)
+    return crc
+
+
+def list_files(path):
+    """
+    List the files in a directory tree in a deterministic order.
+
+    :param path: path of the directory
+    :returns: sorted list of the paths of the files relative to ``path``,
+        using ``/`` as separator
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, path)
+        for filename in filenames:
+            files.append(
+                filename
+                if relpath == os.curdir
+                else f"{relpath.replace(os.sep, '/')}/{filename}"
+            )
+    return sorted(files)
+
+
+def crc32_path(path, max_workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Compute the CRC-32 of a data product, which is either a file or a
+    directory tree such as a Measurement Set.
+
+    For a directory, the CRC-32 of each file is computed in a thread pool,
+    and the result is the CRC-32 of a listing of the relative paths of the
+    files with their CRC-32, in sorted order. It therefore changes if any
+    file is added, removed, renamed or modified.
+
+    :param path: path of the file or directory
+    :param max_workers: number of threads to use for a directory, defaults
+        to the number of CPUs
+    :param chunk_size: size of the chunks to read, in bytes
+    :returns: the CRC-32, as an unsigned integer
+    """
+    if not os.path.isdir(path):
+        return crc32_file(path, chunk_size)
+
+    files = list_files(path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        crcs = executor.map(
+            lambda name: crc32_file(os.path.join(path, name), chunk_size),
+            files,
+        )
+        listing = "".join(
+            f"{name}\0{crc:08x}\n" for name, crc in zip(files, crcs)
+        )
+    return zlib.crc32(listing.encode("utf8"))
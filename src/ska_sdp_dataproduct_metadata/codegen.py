@@ -0,0 +1,363 @@
+"""
+Generating Python code that validates documents against JSON schemas.
+
+jsonschema interprets a schema for every document, which is slow for
+metadata with many file entries. For the keywords used by the metadata
+schema, this module generates a function per schema which checks whether a
+document is valid, with the semantics of the 2020-12 draft as implemented by
+jsonschema (the ``format`` keyword is not asserted, as jsonschema does not
+assert it by default). Schemas using other keywords are not compiled.
+
+The generated code is written to a cache directory, so that it is generated
+once. The cache directory is given by the ``METADATA_VALIDATOR_CACHE``
+environment variable, and defaults to ``ska-sdp-dataproduct-metadata`` in
+the user cache directory. Cached code is only used if it has the SHA-256
+digest recorded when it was generated, otherwise it is generated again. The
+code is always compiled from the source whose digest was checked, rather
+than imported, so that no bytecode cache can bypass the check.
+"""
+
+import hashlib
+import json
+import logging
+import numbers
+import os
+from collections.abc import Mapping, Sequence
+
+from .storage import write_atomic
+
+LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
+
+# Keywords which are compiled
+COMPILED_KEYWORDS = frozenset(
+    [
+        "additionalProperties",
+        "const",
+        "enum",
+        "items",
+        "properties",
+        "required",
+        "type",
+    ]
+)
+
+# Keywords of the 2020-12 draft which make assertions, but are not compiled.
+# Other keywords are annotations, or unknown and ignored by jsonschema.
+UNSUPPORTED_KEYWORDS = frozenset(
+    [
+        "$dynamicRef",
+        "$recursiveRef",
+        "$ref",
+        "allOf",
+        "anyOf",
+        "contains",
+        "dependencies",
+        "dependentRequired",
+        "dependentSchemas",
+        "else",
+        "exclusiveMaximum",
+        "exclusiveMinimum",
+        "if",
+        "maxContains",
+        "maxItems",
+        "maxLength",
+        "maxProperties",
+        "maximum",
+        "minContains",
+        "minItems",
+        "minLength",
+        "minProperties",
+        "minimum",
+        "multipleOf",
+        "not",
+        "oneOf",
+        "pattern",
+        "patternProperties",
+        "prefixItems",
+        "propertyNames",
+        "then",
+        "unevaluatedItems",
+        "unevaluatedProperties",
+        "uniqueItems",
+    ]
+)
+
+# Tests of the JSON types, as expressions of a variable
+TYPE_TESTS = {
+    "array": "isinstance({0}, list)",
+    "boolean": "isinstance({0}, bool)",
+    "integer": (
+        "(isinstance({0}, int) and not isinstance({0}, bool) "
+        "or isinstance({0}, float) and {0}.is_integer())"
+    ),
+    "null": "{0} is None",
+    "number": "(isinstance({0}, _Number) and not isinstance({0}, bool))",
+    "object": "isinstance({0}, _OBJECT_TYPES)",
+    "string": "isinstance({0}, str)",
+}
+
+
+class UnsupportedSchema(Exception):
+    """A schema uses keywords which cannot be compiled."""
+
+
+def equal(one, two):
+    """
+    Compare JSON values as the ``enum`` and ``const`` keywords do: booleans
+    are not equal to numbers, also inside arrays and objects.
+    """
+    if one is two:
+        return True
+    if isinstance(one, str) or isinstance(two, str):
+        return one == two
+    if isinstance(one, Sequence) and isinstance(two, Sequence):
+        return len(one) == len(two) and all(
+            equal(item, other) for item, other in zip(one, two)
+        )
+    if isinstance(one, Mapping) and isinstance(two, Mapping):
+        return len(one) == len(two) and all(
+            key in two and equal(value, two[key]) for key, value in one.items()
+        )
+    if isinstance(one, bool) or isinstance(two, bool):
+        return isinstance(one, bool) and isinstance(two, bool) and one == two
+    return one == two
+
+
+class _Generator:
+    """Generator of the source of a module with a function per schema."""
+
+    def __init__(self):
+        self.lines = []
+        self.constants = []
+        self.counter = 0
+
+    def constant(self, value):
+        """Add a module constant and return its name."""
+        name = f"_CONSTANT_{len(self.constants)}"
+        if isinstance(value, frozenset):
+            source = f"frozenset({sorted(value)!r})"
+        else:
+            source = repr(value)
+        self.constants.append(f"{name} = {source}")
+        return name
+
+    def function(self, schema):
+        """Generate a function checking a schema and return its name."""
+        name = f"_check_{self.counter}"
+        self.counter += 1
+        body = self.body(schema, "value")
+        self.lines.append(f"def {name}(value):")
+        self.lines.extend("    " + line for line in body)
+        self.lines.append("    return True")
+        self.lines.append("")
+        return name
+
+    def body(self, schema, var):
+        """
+        Generate statements returning False if the value of a variable does
+        not match a schema.
+        """
+        if schema is True:
+            return []
+        if schema is False:
+            return ["return False"]
+        if not isinstance(schema, dict):
+            raise UnsupportedSchema(f"Invalid schema {schema!r}")
+        unsupported = UNSUPPORTED_KEYWORDS.intersection(schema)
+        if unsupported:
+            raise UnsupportedSchema(f"Unsupported keywords {unsupported}")
+
+        lines = []
+        if "type" in schema:
+            lines += self.fail_unless(self.type_test(schema["type"], var))
+        if "enum" in schema:
+            lines += self.fail_unless(self.enum_test(schema["enum"], var))
+        if "const" in schema:
+            constant = self.constant(schema["const"])
+            lines += self.fail_unless(f"_equal({var}, {constant})")
+
+        lines += self.guard(
+            schema, "object", var, self.object_body(schema, var)
+        )
+        item = f"{var}_item"
+        item_lines = self.body(schema.get("items", True), item)
+        if item_lines:
+            item_lines = [f"for {item} in {var}:"] + [
+                "    " + line for line in item_lines
+            ]
+        lines += self.guard(schema, "array", var, item_lines)
+        return lines
+
+    @staticmethod
+    def guard(schema, type_name, var, lines):
+        """
+        Make statements of keywords applying to one type conditional on the
+        type, unless the schema only allows that type.
+        """
+        if not lines or schema.get("type") == type_name:
+            return lines
+        return [f"if {TYPE_TESTS[type_name].format(var)}:"] + [
+            "    " + line for line in lines
+        ]
+
+    def object_body(self, schema, var):
+        """Generate the statements of the keywords applying to objects."""
+        lines = []
+        properties = schema.get("properties", {})
+        for key in schema.get("required", []):
+            lines += self.fail_unless(f"{key!r} in {var}")
+        for key, subschema in properties.items():
+            if subschema is True:
+                continue
+            value = f"{var}_{self.counter}"
+            self.counter += 1
+            lines.append(f"if {key!r} in {var}:")
+            lines.append(f"    {value} = {var}[{key!r}]")
+            lines += ["    " + line for line in self.body(subschema, value)]
+
+        additional = schema.get("additionalProperties", True)
+        if additional is not True:
+            names = self.constant(frozenset(properties))
+            key = f"{var}_key"
+            lines.append(f"for {key} in {var}:")
+            lines.append(f"    if {key} not in {names}:")
+            if additional is False:
+                lines.append("        return False")
+            else:
+                check = self.function(additional)
+                lines.append(f"        if not {check}({var}[{key}]):")
+                lines.append("            return False")
+        return lines
+
+    @staticmethod
+    def type_test(types, var):
+        """Expression testing the type of a variable."""
+        if isinstance(types, str):
+            types = [types]
+        tests = []
+        for name in types:
+            if name not in TYPE_TESTS:
+                raise UnsupportedSchema(f"Unknown type {name!r}")
+            tests.append(TYPE_TESTS[name].format(var))
+        return " or ".join(tests) or "False"
+
+    def enum_test(self, values, var):
+        """Expression testing whether a variable is one of some values."""
+        if all(isinstance(value, str) for value in values):
+            # compare with ==, as members of string enumerations do not hash
+            # like their values
+            constant = self.constant(tuple(values))
+            return f"isinstance({var}, str) and {var} in {constant}"
+        constant = self.constant(list(values))
+        return f"any(_equal(each, {var}) for each in {constant})"
+
+    @staticmethod
+    def fail_unless(test):
+        """Statements returning False if a test fails."""
+        return [f"if not ({test}):", "    return False"]
+
+
+def generate(schemas):
+    """
+    Generate the source of a module with a function checking each schema.
+
+    :param schemas: dictionary of names to schemas
+    :returns: tuple of the source and a dictionary of the names of the
+        schemas to the names of their functions, for the schemas which
+        could be compiled
+    """
+    generator = _Generator()
+    functions = {}
+    for name, schema in schemas.items():
+        lines, counter = list(generator.lines), generator.counter
+        try:
+            functions[name] = generator.function(schema)
+        except UnsupportedSchema as err:
+            LOG.debug("Not compiling schema %s: %s", name, err)
+            generator.lines, generator.counter = lines, counter
+    source = "\n".join(
+        [
+            '"""Validators generated from JSON schemas. Do not edit."""',
+            "",
+            "# Names provided by the module loading this one:",
+            "# _OBJECT_TYPES, _Number, _equal",
+            "",
+            *generator.constants,
+            "",
+            "",
+            *generator.lines,
+        ]
+    )
+    return source, functions
+
+
+def cache_directory():
+    """Directory in which generated validators are cached."""
+    if "METADATA_VALIDATOR_CACHE" in os.environ:
+        return os.environ["METADATA_VALIDATOR_CACHE"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "ska-sdp-dataproduct-metadata")
+
+
+def compile_schemas(schemas, object_types=(dict,)):
+    """
+    Compile schemas to functions returning whether a document is valid.
+
+    The generated code is cached, keyed by the schemas and the version of
+    this module, with the digest of its source.
+
+    :param schemas: dictionary of names to schemas
+    :param object_types: types which are JSON objects
+    :returns: dictionary of the names of the schemas to their functions,
+        for the schemas which could be compiled
+    """
+    with open(__file__, "rb") as generator_file:
+        key = hashlib.sha256(generator_file.read())
+    key.update(json.dumps(schemas, sort_keys=True).encode("utf8"))
+    path = os.path.join(
+        cache_directory(), f"validators_{key.hexdigest()[:24]}.py"
+    )
+    functions_path = path[: -len(".py")] + ".json"
+
+    namespace = {
+        "_OBJECT_TYPES": tuple(object_types),
+        "_Number": numbers.Number,
+        "_equal": equal,
+    }
+    try:
+        with open(functions_path, "r", encoding="utf8") as functions_file:
+            cached = json.load(functions_file)
+        functions = cached["functions"]
+        source = _read_source(path, cached["sha256"])
+    except (OSError, KeyError, TypeError, ValueError):
+        source, functions = generate(schemas)
+        digest = hashlib.sha256(source.encode("utf8")).hexdigest()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, source)
+            write_atomic(
+                functions_path,
+                json.dumps({"sha256": digest, "functions": functions}),
+            )
+        except OSError as err:
+            LOG.debug("Cannot cache validators in %s: %s", path, err)
+    # the source was generated from the schemas by this module, and checked
+    # against its digest if it was read from the cache
+    # pylint: disable-next=exec-used
+    exec(compile(source, path, "exec"), namespace)  # nosec B102
+    return {name: namespace[function] for name, function in functions.items()}
+
+
+def _read_source(path, digest):
+    """
+    Read the source of cached validators.
+
+    :raises ValueError: if the source does not have the given SHA-256 digest
+    """
+    with open(path, "rb") as source_file:
+        source = source_file.read()
+    if hashlib.sha256(source).hexdigest() != digest:
+        raise ValueError(f"{path} does not match its digest")
+    return source.decode("utf8")
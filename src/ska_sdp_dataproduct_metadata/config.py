@@ -2,8 +2,7 @@
 
 import logging
 import os
-
-import ska_sdp_config
+import threading
 
 FEATURE_CONFIG_DB = os.environ.get("FEATURE_CONFIG_DB", True)
 
@@ -12,7 +11,123 @@ LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
 
 def new_config_client():
     """Return an SDP configuration client (factory function)."""
+    # ska_sdp_config pulls in the etcd client, which is slow to import, so
+    # only import it when a client is needed
+    # pylint: disable-next=import-outside-toplevel
+    import ska_sdp_config
+
     backend = "etcd3" if FEATURE_CONFIG_DB else "memory"
     LOG.info("Using config DB %s backend", backend)
     config_client = ska_sdp_config.Config(backend=backend)
     return config_client
+
+
+# Client shared by all MetaData objects in the process
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_config_client():
+    """
+    Return the SDP configuration client shared within the process, creating
+    it on first use.
+
+    The client is not inherited by child processes: a forked child creates
+    its own client when it first needs one.
+    """
+    global _CLIENT  # pylint: disable=global-statement
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = new_config_client()
+        return _CLIENT
+
+
+def close_config_client():
+    """
+    Close the shared SDP configuration client, if it was created. A new
+    client is created by the next call of :func:`get_config_client`.
+    """
+    global _CLIENT  # pylint: disable=global-statement
+    with _CLIENT_LOCK:
+        client, _CLIENT = _CLIENT, None
+    if client is not None:
+        client.close()
+
+
+def _forget_config_client():
+    """
+    Drop the client inherited from the parent process after a fork, since
+    its connection cannot be shared between processes.
+    """
+    global _CLIENT, _CLIENT_LOCK  # pylint: disable=global-statement
+    _CLIENT = None
+    _CLIENT_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_config_client)
+
+
+class ConfigReader:  # pylint: disable=too-few-public-methods
+    """
+    Read processing blocks with their execution block and script from the
+    config DB in a transaction, reading each execution block and script
+    only once.
+
+    :param txn: config DB transaction
+    :param cache: optional cache.ConfigCache to get execution blocks and
+        scripts from
+    """
+
+    def __init__(self, txn, cache=None):
+        self._txn = txn
+        self._cache = cache
+        self._execution_blocks = {}
+        self._scripts = {}
+
+    def read(self, pb_id):
+        """
+        Read a processing block, its execution block and its script.
+
+        :param pb_id: processing block ID
+        :returns: tuple of the processing block, the execution block (None if
+            the processing block has no execution block ID) and the script
+        """
+        # the config DB client is slow to import, so only import it if needed
+        # pylint: disable-next=import-outside-toplevel
+        import ska_sdp_config
+
+        processing_block = self._txn.processing_block.get(pb_id)
+        if processing_block is None:
+            raise ValueError("Processing Block is None!")
+
+        eb_id = processing_block.eb_id
+        LOG.info("Execution Block ID %s", eb_id)
+        execution_block = None
+        if eb_id:
+            if eb_id not in self._execution_blocks:
+                self._execution_blocks[eb_id] = (
+                    self._txn.execution_block.get(eb_id)
+                    if self._cache is None
+                    else self._cache.execution_block(self._txn, eb_id)
+                )
+            execution_block = self._execution_blocks[eb_id]
+
+        # Get script from processing block
+        pb_script = processing_block.script
+        key = (pb_script.kind, pb_script.name, pb_script.version)
+        if key not in self._scripts:
+            script_key = ska_sdp_config.entity.Script.Key(
+                kind=pb_script.kind,
+                name=pb_script.name,
+                version=pb_script.version,
+            )
+            self._scripts[key] = (
+                self._txn.script.get(script_key)
+                if self._cache is None
+                else self._cache.script(self._txn, script_key)
+            )
+        script = self._scripts[key]
+        if script is None:
+            raise ValueError("Script is None!")
+
+        return processing_block, execution_block, script
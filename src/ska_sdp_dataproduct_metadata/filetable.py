@@ -0,0 +1,133 @@
+"""
+Compact representation of the file entries in the metadata.
+
+A data product can have hundreds of thousands of files. Rather than a
+dictionary per entry, which benedict additionally wraps in a benedict object
+when ``files`` is accessed through it, each entry is a :class:`FileRecord`
+with a slot per standard key. Entries are converted from dictionaries when a
+metadata file is read, and back when it is written or handed out by
+:meth:`MetaData.get_data`.
+"""
+
+import sys
+from collections.abc import MutableMapping
+
+FIELDS = ("path", "status", "description", "crc", "size")
+_FIELD_SET = frozenset(FIELDS)
+
+
+class FileRecord(MutableMapping):
+    """
+    Entry of a file in the metadata.
+
+    The standard keys of an entry (``path``, ``status``, ``description``,
+    ``crc`` and ``size``) are stored in slots, and can be read as
+    attributes or items; other keys allowed by the schema are kept in a
+    dictionary. A key which is not set is missing, as in a dictionary, and
+    reading the attribute raises AttributeError. Status strings are
+    interned, so that the entries share them.
+
+    Records compare equal to dictionaries with the same items.
+
+    :param entry: dictionary or iterable of pairs with the items of the entry
+    :param kwargs: further items of the entry
+    """
+
+    __slots__ = FIELDS + ("_extra",)
+
+    def __init__(self, entry=(), **kwargs):
+        self._extra = None
+        self.update(entry, **kwargs)
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            if key == "status" and isinstance(value, str):
+                value = sys.intern(str(value))
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+    def to_dict(self):
+        """Return the entry as a dictionary."""
+        return dict(self)
+
+
+def file_records(entries):
+    """
+    Convert file entries read from a metadata file or journal to records.
+
+    :param entries: list of dictionaries, or None
+    :returns: list of FileRecord objects
+    """
+    return [FileRecord(entry) for entry in entries or []]
+
+
+class File:
+    """Class to represent the file in the metadata."""
+
+    def __init__(self, metadata, path):
+        self._path = path
+        self._metadata = metadata
+
+    @property
+    def path(self):
+        """Get the path of the data product."""
+        return self._path
+
+    @property
+    def full_path(self):
+        """Get the full path object."""
+        return self._metadata.runtime_abspath(self._path)
+
+    def update_status(self, status):
+        """
+        Update the current file status.
+
+        :param: status: status to be updated to
+        """
+        # pylint: disable-next=protected-access
+        self._metadata._update_status(self._path, status)
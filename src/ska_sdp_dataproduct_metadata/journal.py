@@ -0,0 +1,69 @@
+"""Append-only journal of changes to a metadata file."""
+
+import json
+import logging
+import os
+
+LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
+
+JOURNAL_SUFFIX = ".journal"
+
+
+class Journal:
+    """
+    Append-only log of the changes made to a metadata file since it was last
+    written. Each record is a line of JSON.
+
+    :param path: path of the metadata file the journal belongs to
+    """
+
+    def __init__(self, path):
+        self.path = path + JOURNAL_SUFFIX
+        # Number of records appended since the journal was last cleared
+        self.records = 0
+
+    def append(self, records, sync=False):
+        """
+        Append records to the journal.
+
+        :param records: list of records (JSON-serialisable dictionaries,
+            which can contain other mappings such as file entries)
+        :param sync: flush the journal to disk before returning
+        """
+        lines = "".join(
+            # file entries are mappings, but not dictionaries
+            json.dumps(record, sort_keys=True, default=dict) + "\n"
+            for record in records
+        )
+        with open(self.path, "a", encoding="utf8") as journal_file:
+            journal_file.write(lines)
+            if sync:
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+        self.records += len(records)
+
+    def read(self):
+        """
+        Read the records in the journal. An incomplete last record, left by
+        an interrupted append, is ignored.
+
+        :returns: list of records
+        """
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, "r", encoding="utf8") as journal_file:
+            for line in journal_file:
+                if not line.endswith("\n"):
+                    LOG.warning("Ignoring incomplete record in %s", self.path)
+                    break
+                records.append(json.loads(line))
+        return records
+
+    def clear(self):
+        """
+        Remove the journal, once its records are in the metadata file.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.records = 0
@@ -1,45 +1,134 @@
 """Generating Metadata File."""
 
-import json
+# pylint: disable=too-many-lines
+
+import contextlib
+import copy
+import functools
+import glob
 import logging
 import os
+import threading
+from enum import Enum
 
-import jsonschema
-import ska_sdp_config
-import ska_ser_logging
 from benedict import benedict
 
-from .config import new_config_client
+from . import checksum, scan, serialisation, validation
+from .config import ConfigReader, get_config_client
+from .filetable import File, FileRecord, file_records
+from .journal import JOURNAL_SUFFIX, Journal
+from .metrics import METRICS
+from .patch import ChangeLog
+from .patch import apply as apply_ops
+from .patch import make_patch
+from .patch import sections as patch_sections
+from .sidecar import SIDECAR_SUFFIX
+from .sidecar import load as load_sidecar
+from .storage import LOCK_SUFFIX, file_lock, stat_identity
+from .templates import DEFAULT_TEMPLATE, get_template
+
+# pylint: disable-next=unused-import
+from .validation import METADATA_SCHEMA  # noqa: F401
+from .writer import BackgroundWriter, PendingWrite
 
-# Initialise logging
-ska_ser_logging.configure_logging()
 LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
-LOG.setLevel(logging.INFO)
 
-METADATA_TEMPLATE = "metadata_defaults.yaml"
 METADATA_FILENAME = os.environ.get(
     "METADATA_FILENAME", "ska-data-product.yaml"
 )
-METADATA_SCHEMA = "metadata.json"
+METADATA_DURABILITY = os.environ.get("METADATA_DURABILITY", "none")
+
+
+def _synchronized(method):
+    """
+    Decorator for MetaData methods, holding the lock of the object while the
+    method runs.
+    """
+
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock:  # pylint: disable=protected-access
+            return method(self, *args, **kwargs)
 
+    return locked
 
-# pylint:disable=too-many-instance-attributes
+
+# pylint:disable=too-many-instance-attributes,too-many-public-methods
 class MetaData:
     """
     Class for generating the metadata file
 
-    :param path: location of the metadata file to read
+    :param path: location of the metadata file to read. If not given, the
+        metadata is created from a template.
+    :param autoflush: write the metadata after every change. If False,
+        changes are only kept in memory until :meth:`flush` is called.
+    :param durability: durability policy for writes, see
+        :class:`MetaData.Durability`. Defaults to the value of the
+        ``METADATA_DURABILITY`` environment variable, or ``none``.
+    :param journal: append changes to a journal next to the metadata file
+        instead of rewriting it after every change. The journal is folded
+        into the metadata file on :meth:`flush`, :meth:`close`, or after
+        ``journal_compaction`` records. Any journal left next to ``path``
+        is replayed when reading it.
+    :param template: name of the template to create the metadata from, if
+        no path is given; see :func:`register_template`
+    :param coordinated: coordinate writes with other processes writing the
+        same metadata file, such as Dask or MPI workers. Each write takes
+        an advisory lock on the file, reads the entries that other
+        processes added or updated, and merges them with the files added
+        or updated by this object. Other sections are written as they are
+        in this object. Cannot be combined with ``journal``.
+    :param write_interval: write changes in a background thread, at most
+        once per this many seconds, instead of before each change returns.
+        Pending changes are written by :meth:`close`, or at exit if the
+        object was not closed. An error raised by a background write is
+        raised by the next change, :meth:`flush` or :meth:`close`. Each
+        object runs its own writer thread until it is closed or no longer
+        used, including each :meth:`clone` of it.
+        Changes through this object are thread-safe, but changes made
+        directly to the dictionary returned by :meth:`get_data` are not.
+        Cannot be combined with ``journal``.
+    :param lazy: only parse the sections of the metadata file at ``path``
+        other than ``files`` when reading it, and parse ``files`` when it
+        is first needed, e.g. by :meth:`get_data`, changes, validation or
+        writing. To read sections of many metadata files, :meth:`peek` is
+        faster still.
+    :param sidecar: after every write of the metadata file, also write a
+        JSON mirror of it with a sequence number, see :mod:`sidecar`. When
+        reading a metadata file, an up-to-date sidecar is always preferred.
     """
 
-    # create a single validator for all instances of the MetaData class
-    with open(
-        os.path.join(os.path.dirname(__file__), "schema", METADATA_SCHEMA),
-        "r",
-        encoding="utf-8",
-    ) as metadata_schema:
-        validator = jsonschema.validators.Draft202012Validator(
-            json.load(metadata_schema)
-        )
+    # number of journal records after which the metadata file is rewritten
+    journal_compaction = 1000
+
+    # number of threads computing the CRC of a directory, None for one per
+    # CPU
+    crc_workers = None
+
+    # optional cache.ConfigCache for execution blocks and scripts read when
+    # loading processing blocks
+    config_cache = None
+
+    # metrics.Metrics registry recording the cost of config DB transactions,
+    # validation, serialisation and writes
+    metrics = METRICS
+
+    # a single validator for all instances of the MetaData class
+    validator = validation.SchemaValidator()
+
+    class Durability(str, Enum):
+        """
+        How durable writes of the metadata file are. The file is always
+        replaced atomically, so that readers never see a partial file; the
+        policy determines what is flushed to disk before returning.
+        """
+
+        NONE = "none"
+        """Do not wait for the data to be flushed to disk"""
+        FILE = "file"
+        """Flush the contents of the file to disk"""
+        DIRECTORY = "directory"
+        """Flush the file and the directory entry pointing to it to disk"""
 
     class ValidationError(Exception):
         """
@@ -51,19 +140,73 @@ class MetaData:
             super().__init__(message)
             self.errors = errors
 
-    def __init__(self, path=None):
-        # determine default template filename
-        metadata_template_path = os.path.join(
-            os.path.dirname(__file__), "template", METADATA_TEMPLATE
-        )
-
-        # if no path specified (called first time),
-        # use metadata template to create one
-        # this is not necessarily the output path
-        path = path or metadata_template_path
-
-        # read data from yaml
-        self._data = self.read(path)
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        path=None,
+        autoflush=True,
+        durability=None,
+        journal=False,
+        template=DEFAULT_TEMPLATE,
+        coordinated=False,
+        write_interval=None,
+        lazy=False,
+        sidecar=False,
+    ):
+        if journal and coordinated:
+            raise ValueError(
+                "A journal cannot be used with coordinated writes"
+            )
+        if journal and write_interval is not None:
+            raise ValueError("A journal cannot be used with background writes")
+        # Held while changing or writing the metadata
+        self._lock = threading.RLock()
+        # Whether there are changes that have not been written, e.g. by
+        # replaying a journal when reading the metadata
+        self._dirty = False
+        # Text of the files section of a lazily read metadata file, until
+        # it is parsed
+        self._unparsed_files = None
+        # Sequence number of the metadata, and whether it is that of the
+        # last patch applied, without other changes since
+        self._sequence = 0
+        self._patched = False
+        if path:
+            # read data from the sidecar or yaml
+            self._data = self._read_path(path, lazy)
+        else:
+            # if no path specified (called first time),
+            # use metadata template to create one
+            # this is not necessarily the output path
+            self._data = benedict(get_template(template))
+        # Top-level sections shared with clones, which are never changed in
+        # place, but copied first
+        self._shared = set()
+        # Whether get_data handed out the data, which can then be changed
+        # through it at any time
+        self._handed_out = False
+        # normalised path -> entry in self._data.files
+        self._file_index = {}
+        self._indexed_files = None
+        # State of incremental validation: copies of the sections which were
+        # last found to be valid, and the file entries changed since then
+        self._valid_sections = {}
+        self._files_valid = False
+        self._changed_files = {}
+        # Files whose CRC is computed when their status changes to done
+        self._compute_crc = set()
+        # Size and modification time of files found by the last scan
+        self._scan_state = {}
+        # File entries added or updated since the last coordinated write
+        self._unmerged_files = {}
+        # Identity of the metadata file as it was last read or written by a
+        # coordinated write
+        self._merged_stat = None
+        if self._unparsed_files is None:
+            self._index_files()
+        if path:
+            # apply changes that were journalled, but not yet written
+            self._replay(Journal(path).read())
         self._config = None
         self._pb_id = None
         self._pb = None
@@ -73,6 +216,24 @@ class MetaData:
         # Output path of metadata file
         # Set to None if not provided
         self._output_path = None
+        # Deferred writing of changes
+        self.autoflush = autoflush
+        self._batch_depth = 0
+        self.durability = MetaData.Durability(
+            durability or METADATA_DURABILITY
+        )
+        self.journal = journal
+        # Journal of the metadata file last written
+        self._journal = None
+        self.coordinated = coordinated
+        self.sidecar = sidecar
+        # patch.ChangeLog sending the patch of every write to subscribers
+        self.changelog = ChangeLog()
+        self._writer = None
+        if write_interval is not None:
+            self._writer = BackgroundWriter(
+                self._write_in_background, write_interval, self.close
+            )
 
     @property
     def output_path(self):
@@ -107,44 +268,68 @@ class MetaData:
 
         # Get connection to config DB
         LOG.info("Opening connection to config DB")
-        self._config = new_config_client()
+        self._config = get_config_client()
 
         # Processing block ID
         if pb_id is None:
-            self._pb_id = os.getenv("SDP_PB_ID")
-        else:
-            self._pb_id = pb_id
-        LOG.info("Processing Block ID %s", self._pb_id)
+            pb_id = os.getenv("SDP_PB_ID")
+        LOG.info("Processing Block ID %s", pb_id)
 
-        # Get processing Block and eb_id from config DB
-        self._pb = None
-        self._eb_id = None
-        for txn in self._config.txn():
-            self._pb = txn.processing_block.get(self._pb_id)
+        # Get processing block, execution block and script from config DB
+        with self.metrics.timer("config_db_seconds", processing_block=pb_id):
+            for txn in self._config.txn():
+                records = ConfigReader(txn, self.config_cache).read(pb_id)
 
-            if self._pb is None:
-                raise ValueError("Processing Block is None!")
+        self._configure(pb_id, records, mount_path)
 
-            self._eb_id = self._pb.eb_id
-            LOG.info("Execution Block ID %s", self._eb_id)
+    @classmethod
+    def load_processing_blocks(cls, pb_ids, mount_path=None):
+        """
+        Create MetaData objects for several processing blocks.
 
-            if self._eb_id:
-                execution_block = txn.execution_block.get(self._eb_id)
-                self._data.execution_block = self._eb_id
+        The processing blocks are read in a single transaction, in which
+        execution blocks and scripts shared by several processing blocks
+        are only read once.
 
-            # Get script from processing block
-            script_key = ska_sdp_config.entity.Script.Key(
-                kind=self._pb.script.kind,
-                name=self._pb.script.name,
-                version=self._pb.script.version,
-            )
-            script = txn.script.get(script_key)
-            if script is None:
-                raise ValueError("Script is None!")
+        :param pb_ids: processing block IDs
+        :param mount_path: path where the data product volume is mounted.
+        :returns: list of MetaData objects, one per processing block
+        """
+        pb_ids = list(pb_ids)
+        config = get_config_client()
+        with cls.metrics.timer("config_db_seconds"):
+            for txn in config.txn():
+                reader = ConfigReader(txn, cls.config_cache)
+                records = [reader.read(pb_id) for pb_id in pb_ids]
+
+        metadata_list = []
+        for pb_id, pb_records in zip(pb_ids, records):
+            metadata = cls()
+            metadata._config = config
+            metadata._configure(pb_id, pb_records, mount_path)
+            metadata_list.append(metadata)
+        return metadata_list
+
+    def _configure(self, pb_id, records, mount_path):
+        """
+        Configure the MetaData object from the records of a processing block.
 
-        # Update context
+        :param pb_id: processing block ID
+        :param records: tuple of the processing block, its execution block
+            and its script
+        :param mount_path: path where the data product volume is mounted.
+        """
+        self._pb_id = pb_id
+        self._pb, execution_block, script = records
+        self._eb_id = self._pb.eb_id
+
+        # Update execution block and context
         if self._eb_id:
-            self._data.context = execution_block.context
+            self._data.execution_block = self._eb_id
+            # the execution block can be shared with other objects and the
+            # config cache
+            self._data.context = copy.deepcopy(execution_block.context)
+            self._shared.discard("context")
 
         # Update config
         self.set_config(script)
@@ -168,9 +353,50 @@ class MetaData:
     def get_data(self):
         """
         Return the data dictionary within the MetaData object
+
+        Since the data can be modified through the returned dictionary at
+        any time, all file entries are validated on every write from the
+        first call on, and the sections are no longer shared with clones,
+        see :meth:`clone`.
+
+        From the first call on, the file entries are dictionaries rather
+        than compact records, including those added later, so that the data
+        can be serialised and accessed by keypath.
         """
+        self._files()
+        self._handed_out = True
+        self._plain_files()
+        self._files_valid = False
+        self._unshare(*self._shared)
         return self._data
 
+    def _plain_files(self):
+        """
+        Convert the file entries which are records to dictionaries, once
+        the data was handed out by :meth:`get_data`.
+        """
+        if not self._handed_out:
+            return
+        files = self._files()
+        converted = {}
+        for index, entry in enumerate(files):
+            if isinstance(entry, FileRecord):
+                files[index] = converted[id(entry)] = entry.to_dict()
+        if converted:
+            self._index_files()
+            for changed in (self._changed_files, self._unmerged_files):
+                for dp_path, entry in changed.items():
+                    changed[dp_path] = converted.get(id(entry), entry)
+
+    def _new_entry(self, entry=(), **items):
+        """
+        Create a file entry: a compact record, or a dictionary once the data
+        was handed out by :meth:`get_data`.
+        """
+        if self._handed_out:
+            return dict(entry, **items)
+        return FileRecord(entry, **items)
+
     def set_config(self, script):
         """
         Set configuration of generating software.
@@ -181,13 +407,17 @@ class MetaData:
         # Get script from processing block
         pb_script = self._pb.script
 
+        self._unshare("config")
         config_data = self._data.config
         config_data.processing_block = self._pb_id
         config_data.processing_script = pb_script.name
         config_data.image = script.image.split(":", 1)[0]
         config_data.version = pb_script.version
 
-    def new_file(self, dp_path=None, description=None, crc=None):
+    @_synchronized
+    def new_file(
+        self, dp_path=None, description=None, crc=None, compute_crc=False
+    ):
         """
         Creates a new file into the metadata and add current file status.
 
@@ -195,31 +425,624 @@ class MetaData:
                 Not to be confused with path of the metadata file
         :param description: Description of the file
         :param crc: CRC (Cyclic Redundancy Check) checksum for the file.
-            NB: CRC is supplied, not calculated
+            NB: CRC is supplied, not calculated, unless compute_crc is set
+        :param compute_crc: compute the CRC-32 of the file when its status
+            is updated to done. For a directory, the CRC covers all files
+            in it, see :func:`checksum.crc32_path`.
 
         :returns: instance of the File class
         """
+        self._check_writer()
+        entry = self._add_file(dp_path, description, crc, compute_crc)
+        # Write to output metadata
+        self._changed({"op": "new_file", "file": entry})
+
+        # Instance of the class to represent the file
+        return File(self, entry["path"])
+
+    @_synchronized
+    def new_files(self, files):
+        """
+        Creates several new files in the metadata, writing it only once.
 
+        Either all files are added, or none of them if any path is already
+        in the metadata or appears more than once.
+
+        :param files: list of dictionaries with the arguments of
+            :meth:`new_file` (``dp_path``, ``description``, ``crc`` and
+            ``compute_crc``)
+
+        :returns: list of instances of the File class
+        """
+        self._check_writer()
+        files = list(files)
+        dp_paths = [os.path.normpath(file["dp_path"]) for file in files]
+        if len(set(dp_paths)) != len(dp_paths) or any(
+            self._file_entry(dp_path) is not None for dp_path in dp_paths
+        ):
+            raise ValueError("File with same path already exists!")
+
+        entries = [self._add_file(**file) for file in files]
+        # Write to output metadata
+        self._changed(
+            *({"op": "new_file", "file": entry} for entry in entries)
+        )
+        return [File(self, entry["path"]) for entry in entries]
+
+    @_synchronized
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def scan(  # pylint: disable=too-many-locals
+        self,
+        directory=".",
+        pattern="*",
+        predicate=None,
+        description=None,
+        compute_crc=False,
+        max_workers=None,
+    ):
+        """
+        Register the data products found in a directory, writing the
+        metadata once.
+
+        New data products are added with status ``done``, their size and
+        optionally their CRC. Data products that are already in the
+        metadata are only updated if their size or modification time
+        changed since the previous scan, so scanning a tree again only adds
+        what is new.
+
+        The modification times are only kept in memory by this object, as
+        the schema has no field for them. Data products which this object
+        did not scan, e.g. those read from a metadata file or registered by
+        another process, are only compared by size, in KB: a data product
+        which was rewritten with about the same size since is not updated,
+        and its CRC not recomputed.
+
+        :param directory: directory to search, relative to the standard
+            prefix (see :meth:`runtime_abspath`)
+        :param pattern: glob pattern selecting data products, see
+            :func:`scan.find`. Matching directories are registered as a
+            whole.
+        :param predicate: optional function called with the path of a
+            candidate relative to ``directory``, which returns True to
+            register it
+        :param description: description of new data products: a string, or
+            a function called with the path of the data product
+        :param compute_crc: compute the CRC-32 of new and changed data
+            products
+        :param max_workers: number of threads used to get the sizes and
+            CRCs, defaults to one per CPU
+
+        :returns: list of instances of the File class for the data products
+            that were added or updated
+        """
+        self._check_writer()
+        output_name = glob.escape(os.path.basename(self._output_file()))
+        found = scan.find(
+            self.runtime_abspath(directory),
+            pattern,
+            predicate,
+            exclude=(
+                output_name,
+                output_name + JOURNAL_SUFFIX,
+                output_name + LOCK_SUFFIX,
+                output_name + SIDECAR_SUFFIX,
+                # temporary files of atomic writes
+                f".{output_name}.*.tmp",
+            ),
+        )
+        dp_paths = [
+            os.path.normpath(os.path.join(directory, relpath))
+            for relpath, _ in found
+        ]
+
+        def unchanged(dp_path, stat):
+            entry = self._file_entry(dp_path)
+            if entry is None:
+                return False
+            # without the state of a previous scan by this object, only the
+            # size recorded in the metadata can be compared
+            previous = self._scan_state.get(dp_path)
+            if previous is not None:
+                same = stat == previous
+            else:
+                same = entry.get("size") == scan.size_in_kb(stat[0])
+            if same:
+                self._scan_state[dp_path] = stat
+            return same
+
+        records = []
+        files = []
+        for dp_path, stat, crc in scan.changed_products(
+            dp_paths, self.runtime_abspath, unchanged, compute_crc, max_workers
+        ):
+            entry = self._file_entry(dp_path)
+            if entry is None:
+                entry = self._add_file(
+                    dp_path,
+                    (
+                        description(dp_path)
+                        if callable(description)
+                        else description
+                    ),
+                )
+                if entry["description"] is None:
+                    del entry["description"]
+            entry["size"] = scan.size_in_kb(stat[0])
+            entry["status"] = "done"
+            if compute_crc:
+                entry["crc"] = crc
+            self._changed_files[dp_path] = entry
+            self._unmerged_files[dp_path] = entry
+            self._scan_state[dp_path] = stat
+            records.append({"op": "new_file", "file": entry})
+            files.append(File(self, dp_path))
+
+        if records:
+            # Write to output metadata
+            self._changed(*records)
+        return files
+
+    def _add_file(
+        self, dp_path=None, description=None, crc=None, compute_crc=False
+    ):
+        """
+        Add a file to the metadata without writing it.
+
+        :returns: the new file entry
+        """
+        dp_path = os.path.normpath(dp_path)
+        if self._file_entry(dp_path) is not None:
+            raise ValueError("File with same path already exists!")
+
+        entry = self._new_entry(
+            crc=crc, description=description, path=dp_path, status="working"
+        )
+        files = self._files()
+        files.append(entry)
+        self._file_index[dp_path] = entry
+        self._indexed_files = (id(files), len(files))
+        self._changed_files[dp_path] = entry
+        self._unmerged_files[dp_path] = entry
+        if compute_crc:
+            self._compute_crc.add(dp_path)
+        return entry
+
+    def _update_status(self, dp_path, status, crc=None):
+        """
+        Update the status of a file in the metadata and write it.
+
+        A CRC requested with ``compute_crc`` is computed without holding the
+        lock of the object, so that other threads can change it meanwhile.
+
+        :param dp_path: path of the data product
+        :param status: status to be updated to
+        :param crc: CRC of the file computed elsewhere, if any
+        """
+        if crc is None and status == "done":
+            with self._lock:
+                compute_crc = os.path.normpath(dp_path) in self._compute_crc
+            if compute_crc:
+                crc = str(
+                    checksum.crc32_path(
+                        self.runtime_abspath(dp_path),
+                        max_workers=self.crc_workers,
+                    )
+                )
+        self._set_status(dp_path, status, crc)
+
+    @_synchronized
+    def _set_status(self, dp_path, status, crc):
+        """
+        Set the status and CRC of a file in the metadata and write it.
+        """
+        self._check_writer()
+        entry = self._file_entry(dp_path)
+        if entry is None:
+            raise ValueError(f"File {dp_path} is not in the metadata!")
         dp_path = os.path.normpath(dp_path)
-        for file in self._data.files:
-            if dp_path in file.path:
-                raise ValueError("File with same path already exists!")
-
-        add_to_file = [
-            {
-                "crc": crc,
-                "description": description,
-                "path": dp_path,
-                "status": "working",
+        record = {"op": "update_status", "path": entry["path"]}
+
+        if crc is not None:
+            record["crc"] = entry["crc"] = crc
+            self._compute_crc.discard(dp_path)
+
+        record["status"] = entry["status"] = status
+        self._changed_files[dp_path] = entry
+        self._unmerged_files[dp_path] = entry
+
+        # Write YAML file
+        self._changed(record)
+
+    @contextlib.contextmanager
+    def _validated_files(self, dp_paths):
+        """
+        Context manager validating the file entries added or changed inside
+        it, and undoing the changes if they are invalid, so that one invalid
+        change does not keep the metadata from being written.
+
+        :param dp_paths: paths of the files added or changed
+        :raises MetaData.ValidationError: if the changes are invalid
+        """
+        with self._lock:
+            saved = {}
+            for dp_path in dp_paths:
+                entry = self._file_entry(dp_path)
+                saved[os.path.normpath(dp_path)] = (
+                    None if entry is None else dict(entry)
+                )
+            yield
+            validation_errors = self.validate(incremental=True)
+            if validation_errors:
+                self._undo_file_changes(saved)
+                raise MetaData.ValidationError(
+                    "Error(s) occurred during validation.", validation_errors
+                )
+
+    def _undo_file_changes(self, saved):
+        """
+        Undo changes to file entries, holding the lock.
+
+        :param saved: dictionary from the normalised paths of the changed
+            files to copies of their entries before the change, or None for
+            the files which were added
+        """
+        files = self._files()
+        added = {dp_path for dp_path, entry in saved.items() if entry is None}
+        if added:
+            files[:] = [
+                entry
+                for entry in files
+                if os.path.normpath(entry["path"]) not in added
+            ]
+            self._indexed_files = (id(files), len(files))
+        for dp_path, before in saved.items():
+            if before is None:
+                self._file_index.pop(dp_path, None)
+                self._unmerged_files.pop(dp_path, None)
+                self._compute_crc.discard(dp_path)
+            else:
+                entry = self._file_index[dp_path]
+                for key in set(entry) - set(before):
+                    del entry[key]
+                entry.update(before)
+            self._changed_files.pop(dp_path, None)
+
+    def _changed(self, *records):
+        """
+        Write the metadata after a change, unless writing is deferred.
+
+        :param records: journal records describing the change, none if the
+            change is a patch, which is written to the metadata file
+        """
+        if records:
+            self._patched = False
+        if self._writer is not None:
+            self._dirty = True
+            if self._batch_depth == 0:
+                self._writer.notify()
+        elif not self.autoflush or self._batch_depth > 0:
+            self._dirty = True
+        elif records and self.journal and self._journal is not None:
+            self._append_journal(records)
+        else:
+            self.write()
+
+    def _check_writer(self):
+        """
+        Raise the error of a failed background write, if any, to the thread
+        making changes. This is called before a change is made, so that the
+        change is not applied.
+        """
+        if self._writer is not None:
+            self._writer.check()
+
+    def _append_journal(self, records):
+        """
+        Validate a change and append it to the journal, folding the journal
+        into the metadata file once it is long enough.
+        """
+        validation_errors = self.validate(incremental=True)
+        if validation_errors:
+            raise MetaData.ValidationError(
+                "Error(s) occurred during validation.", validation_errors
+            )
+        self._journal.append(
+            records, sync=self.durability != MetaData.Durability.NONE
+        )
+        if self._journal.records >= self.journal_compaction:
+            self.write()
+
+    def _replay(self, records):
+        """
+        Apply journal records to the data, without writing it.
+        """
+        if records:
+            self._sync_file_index()
+        for record in records:
+            if record["op"] == "new_file":
+                entry = self._new_entry(record["file"])
+                dp_path = os.path.normpath(entry["path"])
+                if dp_path in self._file_index:
+                    self._file_index[dp_path].update(entry)
+                else:
+                    self._files().append(entry)
+                    self._file_index[dp_path] = entry
+            elif record["op"] == "update_status":
+                entry = self._file_index.get(os.path.normpath(record["path"]))
+                if entry is not None:
+                    entry["status"] = record["status"]
+                    if "crc" in record:
+                        entry["crc"] = record["crc"]
+        if records:
+            self._index_files()
+            self._dirty = True
+
+    @property
+    def sequence(self):
+        """
+        Sequence number of the metadata, which increases with every write.
+        It is read from the sidecar, if any, and set by :meth:`apply_patch`.
+        """
+        return self._sequence
+
+    def diff(self, other):
+        """
+        Patch transforming this metadata into another, for example to
+        replicate it with :meth:`apply_patch`. To send the changes of every
+        write instead, subscribe to :attr:`changelog`.
+
+        :param other: the other MetaData object
+        :returns: the patch, see :mod:`patch`
+        """
+        return make_patch(
+            self._document(),
+            other._document(),  # pylint: disable=protected-access
+            self.sequence,
+            other.sequence,
+        )
+
+    @_synchronized
+    def apply_patch(self, patch):
+        """
+        Apply a patch and write the metadata, unless writing is deferred.
+        The metadata then has the sequence number of the patch, which is
+        kept by the next write unless the metadata is changed otherwise.
+
+        :param patch: the patch, see :mod:`patch`
+        :raises ValueError: if the patch applies to another sequence number,
+            or cannot be applied, in which case the metadata is unchanged
+        """
+        self._check_writer()
+        if patch["base"] not in (None, self._sequence):
+            raise ValueError(
+                f"Patch applies to sequence number {patch['base']}, "
+                f"not {self._sequence}"
+            )
+        self._unshare(*patch_sections(patch["ops"]))
+        data = apply_ops(self._document(), patch["ops"])
+        if data is not self._data.dict():
+            self._data = benedict(data)
+            self._shared = set()
+        self._index_files()
+        self._plain_files()
+        self._sequence = patch["sequence"]
+        self._patched = self._patched or not self._dirty
+        self._changed()
+
+    @_synchronized
+    def clone(self, output_path=None, sections=None):
+        """
+        Create a copy of the metadata, e.g. for another data product of the
+        same processing block.
+
+        The sections other than ``files``, such as ``context``, ``config``
+        and ``obscore``, are shared by the two objects until either of them
+        changes one, when it is copied. Cloning many data products from the
+        same metadata therefore only costs memory for what differs between
+        them. The sections of an object whose data was handed out by
+        :meth:`get_data` can be changed through it at any time, so they are
+        copied into each clone instead; to share them, clone a clone. The
+        copy has its own list of files, with copies of the entries
+        of this metadata, and its own output path. It is written with the
+        same options as this object, but has no subscribers to its
+        :attr:`changelog`.
+
+        :param output_path: output path of the metadata file of the copy
+        :param sections: dictionary of sections to update in the copy, e.g.
+            ``{"obscore": {"dataproduct_type": ObsCore.DataProductType.MS}}``.
+            The items of each section are added to a copy of the section,
+            without copying the items which are not updated.
+        :returns: the new MetaData object
+        """
+        clone = type(self)(
+            autoflush=self.autoflush,
+            durability=self.durability,
+            journal=self.journal,
+            coordinated=self.coordinated,
+            write_interval=(
+                self._writer.interval if self._writer is not None else None
+            ),
+            sidecar=self.sidecar,
+        )
+        data = dict(self._document())
+        files = data.pop("files", [])
+        if self._handed_out:
+            data = copy.deepcopy(data)
+            shared = set()
+        else:
+            shared = {
+                key for key, value in data.items() if isinstance(value, dict)
             }
-        ]
-        self._data.files.extend(add_to_file)
-        # Write to output metadata
-        self.write()
+        for key, items in (sections or {}).items():
+            # benedict checks that the keys are not key paths
+            items = benedict(copy.deepcopy(items)).dict()
+            data[key] = {**data.get(key, {}), **items}
+            shared.add(key)
+        data["files"] = (
+            [FileRecord(entry) for entry in files]
+            if isinstance(files, list)
+            else copy.deepcopy(files)
+        )
+        if not self._handed_out:
+            self._shared |= shared.intersection(self._data.dict())
+        # pylint: disable=protected-access
+        # the keys of the sections were checked when they were added to this
+        # metadata, so do not traverse them again
+        clone._data = benedict(data, check_keys=False)
+        clone._shared = shared
+        clone._valid_sections = dict(self._valid_sections)
+        clone._index_files()
+        clone._unmerged_files = dict(clone._file_index)
+        clone._compute_crc = set(self._compute_crc)
+        clone._scan_state = dict(self._scan_state)
+        clone._config = self._config
+        clone._pb_id = self._pb_id
+        clone._pb = self._pb
+        clone._eb_id = self._eb_id
+        clone._root = self._root
+        clone._prefix = self._prefix
+        clone.output_path = output_path
+        return clone
+
+    def _unshare(self, *keys):
+        """
+        Copy the sections shared with clones among the given ones, before
+        changing them.
+        """
+        data = self._data.dict()
+        for key in self._shared.intersection(keys):
+            data[key] = copy.deepcopy(data[key])
+        self._shared.difference_update(keys)
 
-        # Instance of the class to represent the file
-        file = File(self, dp_path)
-        return file
+    @property
+    def dirty(self):
+        """
+        Whether there are changes that have not been written yet.
+        """
+        return self._dirty
+
+    @_synchronized
+    def flush(self):
+        """
+        Write the metadata if there are changes that have not been written,
+        including changes only recorded in the journal.
+        """
+        self._check_writer()
+        if self._dirty or (
+            self._journal is not None and self._journal.records
+        ):
+            self.write()
+
+    def close(self):
+        """
+        Write any pending changes. This should be called when the metadata
+        is no longer changed, in particular when using a journal or
+        background writes. Background writes stop, so changes made after
+        closing are written before they return, unless writing is deferred.
+        """
+        writer = self._writer
+        if writer is not None:
+            writer.stop()
+            with self._lock:
+                self._writer = None
+            writer.check()
+        self.flush()
+
+    def _write_in_background(self):
+        """
+        Write pending changes from the background writer, unless a batch is
+        in progress.
+        """
+        with self._lock:
+            if self._batch_depth == 0:
+                self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager to defer writing the metadata.
+
+        Changes made inside the context are kept in memory, and the metadata
+        is validated and written once when the outermost context exits. If
+        the context exits with an exception, the changes are not written
+        but remain pending for the next :meth:`flush` or :meth:`write`.
+        With background writes, the changes are handed to the background
+        writer instead.
+        """
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+        if self._batch_depth == 0:
+            writer = self._writer
+            if writer is None:
+                self.flush()
+            elif self._dirty:
+                writer.notify()
+
+    def _files(self):
+        """
+        Return the underlying list of file entries.
+
+        Accessing ``self._data.files`` makes benedict wrap every entry on each
+        access, so go through the plain dictionary instead. The entries of a
+        lazily read metadata file are parsed on the first call.
+        """
+        data = self._data.dict()
+        if self._unparsed_files is not None:
+            loaded = serialisation.load(self._unparsed_files) or {}
+            data["files"] = file_records(loaded.get("files"))
+            self._unparsed_files = None
+        return data["files"]
+
+    def _document(self):
+        """
+        Return the underlying dictionary of the data, with the files parsed.
+        """
+        self._files()
+        return self._data.dict()
+
+    def _index_files(self):
+        """
+        (Re)build the index from normalised path to file entry.
+        """
+        files = self._files()
+        self._file_index = {
+            os.path.normpath(entry["path"]): entry
+            for entry in files
+            if entry.get("path") is not None
+        }
+        self._indexed_files = (id(files), len(files))
+        self._files_valid = False
+
+    def _sync_file_index(self):
+        """
+        Rebuild the index if the list of files was replaced or extended
+        directly through the data dictionary.
+        """
+        files = self._files()
+        if self._indexed_files != (id(files), len(files)):
+            self._index_files()
+
+    def _file_entry(self, dp_path):
+        """
+        Look up the entry of a file by its data product path.
+
+        :param dp_path: path of the data product
+        :returns: the file entry, or None if the file is not registered
+        """
+        self._sync_file_index()
+        return self._file_index.get(os.path.normpath(dp_path))
 
     def read(self, file):
         """
@@ -229,41 +1052,193 @@ class MetaData:
         :returns: Returns the yaml loaded metadata file
 
         """
-        return benedict(file, format="yaml")
+        if os.path.isfile(file):
+            data = benedict(serialisation.load_file(file))
+        else:
+            # not a local file: let benedict fetch or decode it
+            data = benedict(file, format="yaml")
+        return data
+
+    def _read_path(self, path, lazy):
+        """
+        Read a metadata file, from its sidecar if it is up to date. If lazy,
+        keep the text of the files section to parse it when it is first
+        needed.
+        """
+        loaded = load_sidecar(path)
+        if loaded is not None:
+            self._sequence, data = loaded
+        elif lazy and os.path.isfile(path):
+            with open(path, "r", encoding="utf8") as metadata_file:
+                data, deferred = serialisation.load_deferred(
+                    metadata_file.read(), ["files"]
+                )
+            self._unparsed_files = deferred.get("files")
+        else:
+            data = self.read(path).dict()
+        if isinstance(data.get("files"), list):
+            data["files"] = file_records(data["files"])
+        return benedict(data)
+
+    @staticmethod
+    def peek(path, keys=("execution_block", "config", "obscore")):
+        """
+        Read some top-level sections of a metadata file, without parsing the
+        others if possible, in particular the list of files. This is much
+        faster than reading the whole file for tools that scan many data
+        products. Changes only recorded in a journal are not included.
+
+        :param path: path of the metadata file
+        :param keys: keys of the sections to read
+        :returns: dictionary of the sections found in the file
+        """
+        with open(path, "r", encoding="utf8") as metadata_file:
+            return serialisation.load_sections(metadata_file.read(), keys)
 
+    @_synchronized
     def write(self):
         """
         Write the metadata to a yaml file.
         """
+        pending = self._prepare_write()
+        try:
+            if self.coordinated:
+                self._write_coordinated(pending)
+            else:
+                pending.write()
+        except BaseException:
+            self._dirty = True
+            raise
+        self._complete_write(pending)
+
+    @_synchronized
+    def _prepare_write(self, copy_data=False):
+        """
+        Validate the metadata and prepare writing it, see
+        :class:`PendingWrite`. Changes made from now on are written by the
+        next write.
+
+        :param copy_data: write a copy of the metadata, so that it can be
+            changed while the write is in progress
+        :returns: the PendingWrite object
+        """
+        labels = {"processing_block": self._pb_id} if self._pb_id else {}
+        timings = {}
 
         # validate the data before writing
-        validation_errors = self.validate()
+        with self.metrics.timer("validation_seconds", timings, **labels):
+            validation_errors = self.validate(incremental=True)
         if validation_errors:
             raise MetaData.ValidationError(
                 "Error(s) occurred during validation.", validation_errors
             )
-        # Allow writing to a custom path
-        output_path = self.output_path or self.runtime_abspath(
-            METADATA_FILENAME
+        data = self._document()
+        pending = PendingWrite(
+            self._output_file(),
+            serialisation.to_plain(data) if copy_data else data,
+            self.durability,
+            self.sidecar,
+            self._sequence,
+            # keep the sequence number of the last patch applied
+            self._sequence if self._patched else None,
+            self.metrics,
+            labels,
         )
+        pending.timings.update(timings)
+        self._dirty = False
+        return pending
 
-        # Check if directories exist, if not create
-        parent_dir = os.path.dirname(output_path)
-        if not os.path.exists(parent_dir):
-            os.makedirs(parent_dir)
+    @_synchronized
+    def _complete_write(self, pending):
+        """
+        Record a write prepared by :meth:`_prepare_write` once it is done.
 
-        # Write YAML file
-        with open(output_path, "w", encoding="utf8") as out_file:
-            out_file.write(self._data.to_yaml())
+        :param pending: the PendingWrite object
+        """
+        base = self._sequence
+        self._sequence = pending.sequence
+        self._patched = False
+        self._unmerged_files = {}
 
-    def validate(self) -> list:
+        # The metadata file now contains all changes, so start a new journal
+        self._journal = Journal(pending.output_path) if self.journal else None
+        self.changelog.written(pending.data, base, self._sequence)
+        pending.record(files=len(pending.data["files"]))
+
+    def _write_coordinated(self, pending):
+        """
+        Merge the file entries written by other processes and write the
+        metadata, holding the lock on the file.
+
+        To keep the lock short, the metadata is validated before taking it,
+        and if no other process replaced the file since this object last
+        wrote it, it is also serialised before taking the lock. The file is
+        only read under the lock if another process replaced it.
+        """
+        output_path = pending.output_path
+        if stat_identity(output_path) == self._merged_stat:
+            pending.serialise()
+        with contextlib.ExitStack() as stack:
+            with pending.timer("lock_wait_seconds"):
+                stack.enter_context(file_lock(output_path))
+            if self._merge_files(output_path):
+                pending.text = None
+            pending.write()
+            self._merged_stat = stat_identity(output_path)
+
+    def _merge_files(self, path):
+        """
+        Merge the file entries in a metadata file into the data, if it was
+        replaced since this object last read or wrote it. Entries added or
+        updated by this object take precedence; the order is that of the
+        file, followed by the entries only known to this object.
+
+        :param path: path of the metadata file
+        :returns: whether the file was read
+        """
+        stat = stat_identity(path)
+        if stat is None or stat == self._merged_stat:
+            return False
+
+        merged = []
+        merged_paths = set()
+        for entry in file_records(serialisation.load_file(path).get("files")):
+            dp_path = os.path.normpath(entry["path"])
+            merged.append(self._unmerged_files.get(dp_path, entry))
+            merged_paths.add(dp_path)
+        files = self._files()
+        for entry in files:
+            if os.path.normpath(entry["path"]) not in merged_paths:
+                merged.append(entry)
+        files[:] = merged
+
+        # The merged entries were validated by the processes writing them
+        files_valid = self._files_valid
+        self._index_files()
+        self._plain_files()
+        self._files_valid = files_valid
+        return True
+
+    def _output_file(self):
+        """
+        Path of the metadata file to write.
+        """
+        # Allow writing to a custom path
+        return self.output_path or self.runtime_abspath(METADATA_FILENAME)
+
+    def validate(self, incremental=False) -> list:
         """
         Validate the current contents of the metadata against the schema.
 
+        :param incremental: only validate the sections and file entries that
+            changed since the last validation
         :returns: A list of errors.
         """
+        if incremental:
+            return self._validate_changes()
 
         errors = []
+        self._files()
 
         # validate the metadata against the schema
         validator_errors = MetaData.validator.iter_errors(self._data)
@@ -272,34 +1247,39 @@ class MetaData:
         for validator_error in validator_errors:
             errors.append(validator_error)
 
+        if not errors:
+            self._set_valid(self._data.dict())
         return errors
 
-
-class File:
-    """Class to represent the file in the metadata."""
-
-    def __init__(self, metadata, path):
-        self._path = path
-        self._metadata = metadata
-
-    @property
-    def full_path(self):
-        """Get the full path object."""
-        return self._metadata.runtime_abspath(self._path)
-
-    def update_status(self, status):
+    def _validate_changes(self) -> list:
         """
-        Update the current file status.
+        Validate the parts of the metadata which changed since the last
+        successful validation.
 
-        :param: status: status to be updated to
+        :returns: A list of errors.
         """
-        # read metadata yaml
-        data = self._metadata.get_data()
-
-        # Update File
-        for file in data.files:
-            if self._path in file.path:
-                file.status = status
+        data = self._data.dict()
+        self._sync_file_index()
+        errors = validation.changed_errors(
+            data,
+            self._valid_sections,
+            self._changed_files.values() if self._files_valid else None,
+        )
+        if not errors:
+            self._set_valid(data)
+        return errors
 
-        # Write YAML file
-        self._metadata.write()
+    def _set_valid(self, data):
+        """
+        Record that the metadata is valid, as the starting point for the
+        next incremental validation.
+        """
+        # shared sections are not changed in place, so need no copy
+        self._valid_sections = {
+            key: data[key] if key in self._shared else copy.deepcopy(data[key])
+            for key in validation.validators().sections
+            if key in data
+        }
+        # entries handed out by get_data may change without notice
+        self._files_valid = not self._handed_out
+        self._changed_files = {}
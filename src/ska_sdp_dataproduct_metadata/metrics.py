@@ -0,0 +1,221 @@
+"""
+Metrics of the cost of metadata operations.
+
+:class:`MetaData` records the time spent in config DB transactions,
+validation, serialisation and writing the metadata file, and the number of
+bytes written, in the registry ``MetaData.metrics``. By default, this is the
+registry shared by all objects in the process, :data:`METRICS`.
+
+The metrics can be read with :meth:`Metrics.snapshot`, passed to callbacks
+as they are recorded, or exported in the Prometheus textfile format, for
+example for the textfile collector of the node exporter. Set the
+``METADATA_METRICS_TEXTFILE`` environment variable to export the shared
+registry after every write.
+
+Every write of a metadata file is also logged as a line with a JSON object
+describing its cost, at the level ``Metrics.log_level``.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from .storage import write_atomic
+
+LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
+
+PROMETHEUS_PREFIX = "ska_sdp_dataproduct_metadata_"
+
+TIMER = "timer"
+COUNTER = "counter"
+
+
+class Metrics:
+    """
+    Registry of timings and counts, optionally labelled, for example with
+    the processing block ID.
+
+    Timings are recorded as a count and a sum, counts as a total.
+
+    :param textfile: path of the Prometheus textfile that :meth:`export`
+        writes, or None to not export the metrics
+    """
+
+    # level of the log line describing each write of a metadata file
+    log_level = logging.DEBUG
+
+    def __init__(self, textfile=None):
+        self.textfile = textfile
+        self._lock = threading.Lock()
+        # (name, labels) -> [kind, count, sum]
+        self._values = {}
+        self._callbacks = []
+
+    def subscribe(self, callback):
+        """
+        Call a function for every recorded value.
+
+        :param callback: function called with the name of the metric, the
+            value (time in seconds or count) and a dictionary of labels
+        """
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop calling a function subscribed with :meth:`subscribe`."""
+        self._callbacks.remove(callback)
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record a timing.
+
+        :param name: name of the metric, which should end in ``_seconds``
+        :param seconds: time in seconds
+        :param labels: labels of the value
+        """
+        self._record(TIMER, name, seconds, labels)
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add to a count.
+
+        :param name: name of the metric
+        :param value: value to add
+        :param labels: labels of the value
+        """
+        self._record(COUNTER, name, value, labels)
+
+    @contextlib.contextmanager
+    def timer(self, name, timings=None, **labels):
+        """
+        Context manager recording the time spent in it.
+
+        :param name: name of the metric
+        :param timings: optional dictionary to which the time is also added,
+            under the name of the metric
+        :param labels: labels of the value
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(name, seconds, **labels)
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + seconds
+
+    # pylint: disable-next=too-many-arguments
+    def record_write(self, path, size, seconds, timings, files, **labels):
+        """
+        Record a write of a metadata file: count it and the bytes written,
+        log a line describing it and export the metrics.
+
+        :param path: path of the metadata file
+        :param size: number of bytes written
+        :param seconds: time taken by the whole write
+        :param timings: times of the steps of the write, by metric name
+        :param files: number of file entries in the metadata
+        :param labels: labels of the values
+        """
+        self.increment("bytes_written", size, **labels)
+        self.observe("flush_seconds", seconds, **labels)
+        if LOG.isEnabledFor(self.log_level):
+            record = {
+                "event": "metadata_write",
+                "path": path,
+                **labels,
+                "files": files,
+                "bytes": size,
+                "seconds": seconds,
+                **timings,
+            }
+            LOG.log(self.log_level, "%s", json.dumps(record))
+        self.export()
+
+    def snapshot(self):
+        """
+        Return the current values.
+
+        :returns: list of dictionaries with the ``name``, ``labels``,
+            ``kind`` (``timer`` or ``counter``), ``count`` and ``sum`` of
+            each metric
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            {
+                "name": name,
+                "labels": dict(labels),
+                "kind": kind,
+                "count": count,
+                "sum": total,
+            }
+            for (name, labels), (kind, count, total) in values
+        ]
+
+    def reset(self):
+        """Forget all values."""
+        with self._lock:
+            self._values.clear()
+
+    def to_prometheus(self):
+        """
+        Format the values in the Prometheus text format. Timers are
+        summaries without quantiles, counters are counters.
+
+        :returns: the text
+        """
+        lines = []
+        described = set()
+        for metric in self.snapshot():
+            name = PROMETHEUS_PREFIX + metric["name"]
+            labels = _format_labels(metric["labels"])
+            if metric["kind"] == TIMER:
+                if name not in described:
+                    lines.append(f"# TYPE {name} summary")
+                lines.append(f"{name}_count{labels} {metric['count']}")
+                lines.append(f"{name}_sum{labels} {metric['sum']!r}")
+            else:
+                if name not in described:
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}_total{labels} {metric['sum']!r}")
+            described.add(name)
+        return "".join(line + "\n" for line in lines)
+
+    def export(self):
+        """
+        Write the values to the Prometheus textfile, if one is set. The
+        file is replaced atomically, as the textfile collector requires.
+        """
+        if self.textfile:
+            write_atomic(self.textfile, self.to_prometheus())
+
+    def _record(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._values.setdefault(key, [kind, 0, 0])
+            entry[1] += 1
+            entry[2] += value
+        for callback in self._callbacks:
+            callback(name, value, labels)
+
+
+def _format_labels(labels):
+    """Format labels for the Prometheus text format."""
+    if not labels:
+        return ""
+    escaped = (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        for value in labels.values()
+    )
+    pairs = ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped))
+    return "{" + pairs + "}"
+
+
+# Registry shared by all MetaData objects in the process
+METRICS = Metrics(os.environ.get("METADATA_METRICS_TEXTFILE"))
@@ -0,0 +1,403 @@
+"""
+Patches between metadata documents, for replicating metadata elsewhere
+without sending whole metadata files.
+
+A patch is a dictionary with a list of operations (``ops``) transforming a
+metadata document into another, in the format of JSON Patch (RFC 6902),
+and the sequence numbers of the two documents (``base`` and ``sequence``),
+see :attr:`MetaData.sequence`. A patch only applies to metadata with the
+sequence number ``base``, so that consumers apply patches in order. A patch
+whose ``base`` is None replaces the whole document, and applies to any
+metadata.
+
+File entries are matched by their paths, so that a new file is an ``add``
+operation, and a status change a ``replace`` of the status of the entry.
+Other sections are compared key by key, e.g. an edit of an ObsCore
+attribute is a ``replace`` of that attribute.
+"""
+
+import copy
+from collections.abc import Mapping
+
+from .filetable import FileRecord
+from .serialisation import to_plain
+
+OPERATIONS = ("add", "remove", "replace", "test")
+
+_SCALARS = (str, int, float, bool, type(None))
+_MISSING = object()
+
+
+def diff(old, new):
+    """
+    Operations transforming a metadata document into another.
+
+    :param old: the document to transform, or None to replace the whole of
+        it
+    :param new: the document to transform it into
+    :returns: list of JSON Patch operations
+    """
+    if old is None:
+        return [{"op": "replace", "path": "", "value": to_plain(new)}]
+    ops = []
+    _diff_value(old, new, "", ops)
+    return ops
+
+
+def make_patch(old, new, base, sequence):
+    """
+    Patch transforming a metadata document into another.
+
+    :param old: the document to transform, or None to replace the whole of
+        it
+    :param new: the document to transform it into
+    :param base: sequence number of the document to transform
+    :param sequence: sequence number of the document to transform it into
+    :returns: the patch
+    """
+    return {
+        "base": None if old is None else base,
+        "sequence": sequence,
+        "ops": diff(old, new),
+    }
+
+
+def apply(document, ops):
+    """
+    Apply operations to a metadata document. Either all operations are
+    applied, or none of them.
+
+    :param document: the document, which is changed in place
+    :param ops: list of JSON Patch operations
+    :returns: the changed document, which is a new one if an operation
+        replaced the whole document
+    :raises ValueError: if an operation cannot be applied
+    """
+    undo = []
+    try:
+        for operation in ops:
+            document = _apply_operation(document, operation, undo)
+    except (KeyError, IndexError, TypeError, ValueError) as err:
+        for undone in reversed(undo):
+            document = _undo(document, *undone)
+        raise ValueError(f"Cannot apply patch: {err!r}") from err
+    return document
+
+
+def sections(ops):
+    """
+    Top-level keys of a document which operations change in place.
+
+    :param ops: list of JSON Patch operations
+    :returns: set of keys
+    """
+    keys = set()
+    for operation in ops:
+        pointer = (
+            operation.get("path") if isinstance(operation, Mapping) else None
+        )
+        # the whole document is replaced rather than changed, and invalid
+        # pointers fail when applied
+        if isinstance(pointer, str) and pointer.startswith("/"):
+            keys.add(_tokens(pointer)[0])
+    return keys
+
+
+def snapshot(document):
+    """
+    Copy a metadata document, to compare it with later versions.
+
+    :param document: the document
+    :returns: the copy, with file entries as records
+    """
+    files = document.get("files")
+    copied = {
+        key: to_plain(value)
+        for key, value in document.items()
+        if key != "files"
+    }
+    if isinstance(files, list):
+        copied["files"] = [
+            FileRecord(entry) if isinstance(entry, Mapping) else entry
+            for entry in files
+        ]
+    elif "files" in document:
+        copied["files"] = to_plain(files)
+    return copied
+
+
+class ChangeLog:
+    """
+    Log of the changes written by a :class:`MetaData` object, which sends
+    the patch of each write to subscribers.
+
+    While there are subscribers, a copy of the metadata as last written is
+    kept, to compute the patch of the next write. The first patch after
+    subscribing replaces the whole document.
+    """
+
+    def __init__(self):
+        self._callbacks = []
+        # The metadata as last written, while there are subscribers
+        self._written = None
+
+    def subscribe(self, callback):
+        """
+        Call a function with the patch of every write.
+
+        :param callback: function called with the patch
+        """
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop calling a function subscribed with :meth:`subscribe`."""
+        self._callbacks.remove(callback)
+        if not self._callbacks:
+            self._written = None
+
+    def written(self, document, base, sequence):
+        """
+        Send the patch of a write to the subscribers.
+
+        :param document: the metadata written
+        :param base: sequence number of the metadata before the write
+        :param sequence: sequence number of the metadata written
+        """
+        if not self._callbacks:
+            return
+        patch = make_patch(self._written, document, base, sequence)
+        self._written = snapshot(document)
+        for callback in list(self._callbacks):
+            callback(patch)
+
+
+def _diff_value(old, new, pointer, ops):
+    """Add the operations transforming a value into another."""
+    if isinstance(old, Mapping) and isinstance(new, Mapping):
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _child(pointer, key)})
+        for key, value in new.items():
+            previous = old.get(key, _MISSING)
+            if previous is _MISSING:
+                ops.append(
+                    {
+                        "op": "add",
+                        "path": _child(pointer, key),
+                        "value": to_plain(value),
+                    }
+                )
+            elif type(value) is type(previous) and type(value) in _SCALARS:
+                # the common case of a scalar, without converting it
+                if value != previous:
+                    ops.append(
+                        {
+                            "op": "replace",
+                            "path": _child(pointer, key),
+                            "value": value,
+                        }
+                    )
+            elif not pointer and key == "files" and isinstance(value, list):
+                _diff_files(previous, value, ops)
+            else:
+                _diff_value(previous, value, _child(pointer, key), ops)
+    elif not _same(old, new):
+        ops.append({"op": "replace", "path": pointer, "value": to_plain(new)})
+
+
+def _diff_files(old, new, ops):
+    """
+    Add the operations transforming a list of file entries into another,
+    matching the entries by their paths: changes of the entries in both,
+    then the removal of old entries, then the insertion of new ones.
+    """
+    old_index = _path_index(old)
+    new_index = _path_index(new)
+    if (
+        old_index is None
+        or new_index is None
+        or not _ordered(old_index, new_index)
+    ):
+        # the entries cannot be matched, or were reordered
+        _diff_value(old, list(new), "/files", ops)
+        return
+
+    for index, entry in enumerate(old):
+        if entry["path"] in new_index:
+            _diff_value(
+                entry, new[new_index[entry["path"]]], f"/files/{index}", ops
+            )
+    removed = [
+        index
+        for index, entry in enumerate(old)
+        if entry["path"] not in new_index
+    ]
+    for index in reversed(removed):
+        ops.append({"op": "remove", "path": f"/files/{index}"})
+
+    length = len(old) - len(removed)
+    for index, entry in enumerate(new):
+        if entry["path"] not in old_index:
+            pointer = "/files/-" if index == length else f"/files/{index}"
+            ops.append(
+                {"op": "add", "path": pointer, "value": to_plain(entry)}
+            )
+            length += 1
+
+
+def _path_index(files):
+    """
+    Index of file entries by path, or None if they are not all mappings
+    with a distinct path.
+    """
+    if not isinstance(files, list):
+        return None
+    index = {}
+    for position, entry in enumerate(files):
+        if not isinstance(entry, Mapping) or not isinstance(
+            entry.get("path"), str
+        ):
+            return None
+        index[entry["path"]] = position
+    return index if len(index) == len(files) else None
+
+
+def _ordered(old_index, new_index):
+    """Whether the entries in both of two lists are in the same order."""
+    kept = [old_index[path] for path in new_index if path in old_index]
+    return all(one < two for one, two in zip(kept, kept[1:]))
+
+
+def _same(one, two):
+    """
+    Whether two values are the same JSON value, distinguishing e.g. 1, 1.0
+    and True, and enumeration members and their values.
+    """
+    if one is two:
+        return True
+    if type(one) is type(two) and type(one) in _SCALARS:
+        return one == two
+    if isinstance(one, Mapping) and isinstance(two, Mapping):
+        return one.keys() == two.keys() and all(
+            _same(value, two[key]) for key, value in one.items()
+        )
+    if isinstance(one, (list, tuple)) and isinstance(two, (list, tuple)):
+        return len(one) == len(two) and all(
+            _same(value, other) for value, other in zip(one, two)
+        )
+    one, two = to_plain(one), to_plain(two)
+    return type(one) is type(two) and one == two
+
+
+def _child(pointer, key):
+    """JSON pointer of a member of an object."""
+    return pointer + "/" + str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _tokens(pointer):
+    """Reference tokens of a JSON pointer."""
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise ValueError(f"Invalid JSON pointer {pointer!r}")
+    return [
+        token.replace("~1", "/").replace("~0", "~")
+        for token in pointer[1:].split("/")
+    ]
+
+
+def _key(container, token, append=False):
+    """Key or index of a reference token in a container."""
+    if not isinstance(container, list):
+        if not isinstance(container, Mapping):
+            raise TypeError(f"Cannot index {type(container).__name__}")
+        return token
+    if append and token == "-":
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith("0")):
+        raise ValueError(f"Invalid array index {token!r}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not append):
+        raise IndexError(f"Array index {index} out of range")
+    return index
+
+
+def _new_value(tokens, value):
+    """
+    Copy a value added to a document, with file entries as records.
+    """
+    value = copy.deepcopy(value)
+    if len(tokens) == 2 and tokens[0] == "files" and isinstance(value, dict):
+        return FileRecord(value)
+    if tokens == ["files"] and isinstance(value, list):
+        return [
+            FileRecord(entry) if isinstance(entry, dict) else entry
+            for entry in value
+        ]
+    if not tokens and isinstance(value, dict):
+        if "files" in value:
+            value["files"] = _new_value(["files"], value["files"])
+    return value
+
+
+def _apply_operation(document, operation, undo):
+    """
+    Apply an operation to a document, adding what undoes it to a list.
+
+    :returns: the changed document
+    """
+    name = operation["op"]
+    if name not in OPERATIONS:
+        raise ValueError(f"Unsupported operation {name!r}")
+    tokens = _tokens(operation["path"])
+    if not tokens:
+        if name == "remove":
+            raise ValueError("Cannot remove the whole document")
+        if name == "test":
+            if not _same(document, operation["value"]):
+                raise ValueError("Test of the whole document failed")
+            return document
+        undo.append(("document", None, None, document))
+        return _new_value(tokens, operation["value"])
+
+    parent = document
+    for token in tokens[:-1]:
+        parent = parent[_key(parent, token)]
+    key = _key(parent, tokens[-1], append=name == "add")
+
+    if name == "test":
+        if not _same(parent[key], operation["value"]):
+            raise ValueError(f"Test of {operation['path']} failed")
+    elif name == "remove":
+        previous = parent[key]
+        del parent[key]
+        action = "insert" if isinstance(parent, list) else "set"
+        undo.append((action, parent, key, previous))
+    elif name == "add" and isinstance(parent, list):
+        parent.insert(key, _new_value(tokens, operation["value"]))
+        undo.append(("delete", parent, key, None))
+    elif name == "replace" or key in parent:
+        previous = parent[key]
+        parent[key] = _new_value(tokens, operation["value"])
+        undo.append(("set", parent, key, previous))
+    else:
+        parent[key] = _new_value(tokens, operation["value"])
+        undo.append(("delete", parent, key, None))
+    return document
+
+
+def _undo(document, action, parent, key, previous):
+    """
+    Undo an operation.
+
+    :returns: the document as it was before the operation
+    """
+    if action == "document":
+        return previous
+    if action == "set":
+        parent[key] = previous
+    elif action == "insert":
+        parent.insert(key, previous)
+    else:
+        del parent[key]
+    return document
@@ -0,0 +1,132 @@
+"""Scanning directory trees for data product files."""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+
+from . import checksum
+
+
+def find(root, pattern="*", predicate=None, exclude=()):
+    """
+    Find the data products in a directory tree, in sorted order.
+
+    A file or directory is a data product if it matches ``pattern`` and
+    ``predicate``. Matching directories (such as Measurement Sets) are
+    returned as a whole, without descending into them; other directories
+    are searched recursively.
+
+    :param root: directory to search
+    :param pattern: glob pattern. If it contains no ``/``, it is matched
+        against the name of each file or directory, otherwise against its
+        path relative to ``root``.
+    :param predicate: optional function called with the relative path,
+        which returns True to accept a data product
+    :param exclude: glob patterns matched against the names of files to
+        ignore
+    :returns: list of tuples of the relative path (using ``/`` as
+        separator) and whether it is a directory
+    """
+    matches = []
+
+    def match(relpath, name):
+        if fnmatchcase(relpath if "/" in pattern else name, pattern):
+            return predicate is None or predicate(relpath)
+        return False
+
+    def search(dirpath, prefix):
+        with os.scandir(dirpath) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            relpath = prefix + entry.name
+            if entry.is_dir():
+                if match(relpath, entry.name):
+                    matches.append((relpath, True))
+                else:
+                    search(entry.path, relpath + "/")
+            elif not any(
+                fnmatchcase(entry.name, excluded) for excluded in exclude
+            ) and match(relpath, entry.name):
+                matches.append((relpath, False))
+
+    search(root, "")
+    return matches
+
+
+def stat_product(path):
+    """
+    Get the size and modification time of a data product.
+
+    For a directory, the size is the total size of the files in it, and the
+    modification time is the latest one of the files and directories in
+    it.
+
+    :param path: path of the file or directory
+    :returns: tuple of the size in bytes and the modification time in
+        nanoseconds
+    """
+    stat = os.stat(path)
+    size, mtime = stat.st_size, stat.st_mtime_ns
+    if os.path.isdir(path):
+        size = 0
+        for dirpath, _, filenames in os.walk(path):
+            mtime = max(mtime, os.stat(dirpath).st_mtime_ns)
+            for filename in filenames:
+                stat = os.stat(os.path.join(dirpath, filename))
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime_ns)
+    return size, mtime
+
+
+def changed_products(
+    dp_paths, abspath, unchanged, compute_crc=False, max_workers=None
+):
+    """
+    Get the size and modification time of data products in threads, and
+    compute the CRCs of those that changed.
+
+    :param dp_paths: data product paths
+    :param abspath: function returning the absolute path of a data product
+    :param unchanged: function called with a data product path and the
+        result of :func:`stat_product` for it, which returns True if the
+        data product did not change
+    :param compute_crc: compute the CRC-32 of the data products that changed
+    :param max_workers: number of threads, defaults to one per CPU
+    :returns: list of tuples of the path, the result of
+        :func:`stat_product` and the CRC (or None) of the data products
+        that changed
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        stats = executor.map(
+            lambda dp_path: stat_product(abspath(dp_path)), dp_paths
+        )
+        changed = [
+            (dp_path, stat)
+            for dp_path, stat in zip(dp_paths, stats)
+            if not unchanged(dp_path, stat)
+        ]
+        if compute_crc:
+            # the threads are used for separate data products, so use a
+            # single thread for each
+            crcs = executor.map(
+                lambda change: str(
+                    checksum.crc32_path(abspath(change[0]), max_workers=1)
+                ),
+                changed,
+            )
+        else:
+            crcs = [None] * len(changed)
+        return [
+            (dp_path, stat, crc) for (dp_path, stat), crc in zip(changed, crcs)
+        ]
+
+
+def size_in_kb(size):
+    """
+    Convert a size in bytes to the unit of the ``size`` field of a file
+    entry, rounding up so that only empty files have size 0.
+
+    :param size: size in bytes
+    :returns: size in KB
+    """
+    return -(-size // 1024)
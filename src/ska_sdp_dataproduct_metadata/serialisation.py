@@ -0,0 +1,202 @@
+"""
+Reading and writing metadata as YAML.
+
+The PyYAML bindings to libyaml are used when they are available, since they
+are much faster than the pure-Python implementation. Both backends produce
+the same output, except for mapping keys that are empty or contain control
+characters, which the backends format differently.
+
+Metadata files can also be loaded partially: the top-level entries of a
+document written by :func:`dump` start at the beginning of a line, so the
+text of each entry can be found without parsing the others, see
+:func:`split_sections`.
+"""
+
+import re
+from collections.abc import Mapping
+from enum import Enum
+
+import yaml
+
+try:
+    from yaml import CSafeDumper, CSafeLoader
+except ImportError:  # PyYAML built without libyaml
+    CSafeDumper = CSafeLoader = None
+
+LIBYAML = "libyaml"
+PYTHON = "python"
+
+BACKENDS = {PYTHON: (yaml.SafeLoader, yaml.SafeDumper)}
+if CSafeLoader is not None:
+    BACKENDS[LIBYAML] = (CSafeLoader, CSafeDumper)
+
+DEFAULT_BACKEND = LIBYAML if LIBYAML in BACKENDS else PYTHON
+
+# The emitters of the backends break long lines differently, so do not break
+# them at all to get the same output from both
+LINE_WIDTH = 2**31 - 1
+
+# Lines which start a top-level entry of a block mapping, or which cannot be
+# part of one: everything but indented lines, blank lines, comments and
+# items of sequences that are not indented
+_TOP_LEVEL_LINE = re.compile(r"^(?:[^\s#-]|-\S).*$", re.MULTILINE)
+_TOP_LEVEL_KEY = re.compile(r"([A-Za-z_][\w.-]*):(?:[ \t]|$)")
+
+
+def _backend(backend):
+    """Return the loader and dumper classes of a backend."""
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"YAML backend {backend} is not available")
+    return BACKENDS[backend]
+
+
+def to_plain(data):
+    """
+    Convert data to the plain types that the safe YAML dumpers accept, e.g.
+    enumeration members such as those of ObsCore to their values, and
+    mappings such as file entries to dictionaries.
+
+    :param data: data to convert
+    :returns: the converted data
+    """
+    if isinstance(data, dict):
+        return {key: to_plain(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_plain(value) for value in data]
+    if isinstance(data, Enum):
+        return to_plain(data.value)
+    # Subclasses of built-in types are not recognised by the dumpers
+    for plain_type in (bool, int, float, str):
+        if isinstance(data, plain_type):
+            return plain_type(data)
+    if isinstance(data, Mapping):
+        return {key: to_plain(value) for key, value in data.items()}
+    return data
+
+
+def load(stream, backend=None):
+    """
+    Load YAML data.
+
+    :param stream: string or open file with the YAML document
+    :param backend: YAML backend to use (``libyaml`` or ``python``). By
+        default, libyaml is used if it is available.
+    :returns: the loaded data
+    """
+    loader, _ = _backend(backend)
+    return yaml.load(stream, Loader=loader)  # nosec: loader is safe
+
+
+def load_file(path, backend=None):
+    """
+    Load YAML data from a file.
+
+    :param path: path of the YAML file
+    :param backend: YAML backend to use, see :func:`load`
+    :returns: the loaded data
+    """
+    with open(path, "r", encoding="utf8") as yaml_file:
+        return load(yaml_file, backend)
+
+
+def dump(data, backend=None):
+    """
+    Dump data to YAML. The output is the same for all backends: keys are
+    sorted, block style is used for all collections and lines are not
+    broken.
+
+    :param data: data to dump
+    :param backend: YAML backend to use, see :func:`load`
+    :returns: the YAML document as a string
+    """
+    _, dumper = _backend(backend)
+    return yaml.dump(
+        to_plain(data),
+        Dumper=dumper,
+        default_flow_style=False,
+        sort_keys=True,
+        width=LINE_WIDTH,
+    )
+
+
+def split_sections(text):
+    """
+    Split a YAML document whose top level is a block mapping into the text
+    of each of its top-level entries, without parsing it.
+
+    :param text: the YAML document
+    :returns: dictionary of the keys of the top-level entries to their
+        text, in the order of the document, or None if the document is not
+        a block mapping with plain keys
+    """
+    sections = {}
+    key = None
+    start = 0
+    for line in _TOP_LEVEL_LINE.finditer(text):
+        end = line.start()
+        match = _TOP_LEVEL_KEY.match(line.group())
+        if match is None or match.group(1) in sections:
+            return None
+        if key is None:
+            # only comments and blank lines can precede the first entry
+            if any(
+                not prefix.lstrip().startswith("#")
+                for prefix in text[:end].splitlines()
+                if prefix.strip()
+            ):
+                return None
+        else:
+            sections[key] = text[start:end]
+        key = match.group(1)
+        start = end
+    if key is None:
+        return None
+    sections[key] = text[start:]
+    return sections
+
+
+def load_sections(text, keys, backend=None):
+    """
+    Load some top-level entries of a YAML document which is a mapping,
+    without parsing the others if possible.
+
+    :param text: the YAML document
+    :param keys: keys of the entries to load
+    :param backend: YAML backend to use, see :func:`load`
+    :returns: dictionary of the entries found
+    """
+    sections = split_sections(text)
+    if sections is not None:
+        selected = "".join(sections[key] for key in keys if key in sections)
+        try:
+            return load(selected, backend) or {}
+        except yaml.YAMLError:
+            # e.g. an alias of an anchor in an entry that was not loaded
+            pass
+    data = load(text, backend) or {}
+    return {key: data[key] for key in keys if key in data}
+
+
+def load_deferred(text, deferred, backend=None):
+    """
+    Load a YAML document which is a mapping, except for some top-level
+    entries whose text is returned to load them later with :func:`load`.
+
+    :param text: the YAML document
+    :param deferred: keys of the entries not to load
+    :param backend: YAML backend to use, see :func:`load`
+    :returns: tuple of the loaded data and a dictionary of the keys of the
+        entries not loaded to their text
+    """
+    sections = split_sections(text)
+    if sections is not None:
+        texts = {key: sections.pop(key) for key in deferred if key in sections}
+        eager = "".join(sections.values())
+        # anchors in the loaded entries could be used by the others
+        if "&" not in eager:
+            try:
+                return load(eager, backend) or {}, texts
+            except yaml.YAMLError:
+                pass
+    return load(text, backend), {}
@@ -0,0 +1,138 @@
+"""
+JSON mirror of a metadata file, for readers which poll it.
+
+The YAML metadata file stays the canonical format. With the ``sidecar``
+option of :class:`MetaData`, every write of it is followed by a write of
+``<metadata file>.json``, which consists of two lines of JSON: a header with
+a sequence number increasing with each write and the identity of the
+metadata file it mirrors, then the metadata itself. Readers can check
+whether the metadata changed by reading the header only, see
+:func:`read_sequence`, and load it with :func:`load`, which is much faster
+than parsing the YAML file.
+
+A sidecar is only used if the metadata file was not replaced after it was
+written, e.g. by a writer not keeping the sidecar up to date.
+"""
+
+import json
+
+from . import serialisation
+from .storage import stat_identity, write_atomic
+
+SIDECAR_SUFFIX = ".json"
+
+
+def sidecar_path(path):
+    """
+    Path of the sidecar of a metadata file.
+
+    :param path: path of the metadata file
+    """
+    return path + SIDECAR_SUFFIX
+
+
+def read_header(path):
+    """
+    Read the header of the sidecar of a metadata file.
+
+    :param path: path of the metadata file
+    :returns: dictionary with the ``sequence`` number and the identity of
+        the ``source`` metadata file, or None if there is no valid sidecar
+    """
+    try:
+        with open(sidecar_path(path), "r", encoding="utf8") as sidecar_file:
+            header = json.loads(sidecar_file.readline())
+    except (OSError, ValueError):
+        return None
+    return header if isinstance(header, dict) else None
+
+
+def read_sequence(path):
+    """
+    Read the sequence number of the metadata file, if its sidecar is up to
+    date, without reading the metadata.
+
+    :param path: path of the metadata file
+    :returns: the sequence number, or None if there is no sidecar or it is
+        out of date
+    """
+    header = read_header(path)
+    if header is None or not _is_fresh(path, header):
+        return None
+    return header.get("sequence")
+
+
+def load(path):
+    """
+    Load the metadata from the sidecar of a metadata file, if it is up to
+    date.
+
+    :param path: path of the metadata file
+    :returns: tuple of the sequence number and the metadata, or None if
+        there is no sidecar or it is out of date
+    """
+    try:
+        with open(sidecar_path(path), "r", encoding="utf8") as sidecar_file:
+            header = json.loads(sidecar_file.readline())
+            if not isinstance(header, dict) or not _is_fresh(path, header):
+                return None
+            data = json.loads(sidecar_file.readline())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return header.get("sequence"), data
+
+
+def dumps(data):
+    """
+    Serialise the metadata for its sidecar. Values which JSON has no type
+    for, like dates, are written as strings.
+
+    :param data: the metadata
+    :returns: the line of JSON, without the newline
+    """
+    return json.dumps(
+        serialisation.to_plain(data), separators=(",", ":"), default=str
+    )
+
+
+# pylint: disable-next=too-many-arguments,too-many-positional-arguments
+def write(path, data, durability="none", previous=0, sequence=None, text=None):
+    """
+    Write the sidecar of a metadata file that was just written.
+
+    The metadata can be serialised with :func:`dumps` before the metadata
+    file is written, so that a value it cannot serialise does not leave the
+    sidecar out of date.
+
+    By default, the sequence number is one more than the largest of
+    ``previous`` and the sequence number of the existing sidecar, so that it
+    increases even when several objects or processes write the metadata
+    file.
+
+    :param path: path of the metadata file
+    :param data: the metadata
+    :param durability: durability policy, see :class:`MetaData.Durability`
+    :param previous: sequence number of the last sidecar known to the caller
+    :param sequence: sequence number to write instead, e.g. that of a patch
+        the metadata was received in
+    :param text: the metadata serialised by :func:`dumps`, if already done
+    :returns: the sequence number written
+    """
+    if text is None:
+        text = dumps(data)
+    if sequence is None:
+        header = read_header(path) or {}
+        sequence = max(previous or 0, header.get("sequence") or 0) + 1
+    header = {"sequence": sequence, "source": stat_identity(path)}
+    write_atomic(
+        sidecar_path(path), json.dumps(header) + "\n" + text + "\n", durability
+    )
+    return sequence
+
+
+def _is_fresh(path, header):
+    """Whether a sidecar mirrors the current metadata file."""
+    source = header.get("source")
+    return source is not None and tuple(source) == stat_identity(path)
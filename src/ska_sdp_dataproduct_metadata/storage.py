@@ -0,0 +1,80 @@
+"""Writing metadata files safely, and locking them between processes."""
+
+import contextlib
+import fcntl
+import os
+import uuid
+
+LOCK_SUFFIX = ".lock"
+
+
+def write_atomic(path, text, durability="none"):
+    """
+    Write a text file atomically, by writing a temporary file in the same
+    directory and moving it into place.
+
+    :param path: path of the file
+    :param text: contents of the file
+    :param durability: a MetaData.Durability policy (``none``, ``file`` or
+        ``directory``)
+    """
+    parent_dir = os.path.dirname(path) or "."
+    tmp_path = os.path.join(
+        parent_dir, f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp"
+    )
+    try:
+        with open(tmp_path, "x", encoding="utf8") as tmp_file:
+            tmp_file.write(text)
+            if durability != "none":
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        # keep the permissions of the file being replaced
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if durability == "directory":
+        dir_fd = os.open(parent_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def stat_identity(path):
+    """
+    Identify the version of a file that is replaced atomically on every
+    write, as its inode, size and modification time.
+
+    :param path: path of the file
+    :returns: the identity, or None if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Context manager holding an exclusive advisory lock on a metadata file.
+
+    The lock is taken on a separate lock file next to the metadata file,
+    since the metadata file itself is replaced on every write. It only
+    excludes other processes that take the same lock.
+
+    :param path: path of the metadata file
+    """
+    lock_fd = os.open(path + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(lock_fd)
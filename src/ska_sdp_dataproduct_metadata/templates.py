@@ -0,0 +1,87 @@
+"""Templates for new metadata, parsed once per process."""
+
+import os
+import threading
+from types import MappingProxyType
+
+from . import serialisation
+
+DEFAULT_TEMPLATE = "default"
+METADATA_TEMPLATE = "metadata_defaults.yaml"
+
+# Template name -> frozen template data
+_TEMPLATES = {}
+_LOCK = threading.Lock()
+
+
+def freeze(data):
+    """
+    Convert data to an immutable structure: mappings become read-only
+    mappings and lists become tuples.
+
+    :param data: data to convert
+    :returns: immutable copy of the data
+    """
+    if isinstance(data, dict):
+        return MappingProxyType(
+            {key: freeze(value) for key, value in data.items()}
+        )
+    if isinstance(data, (list, tuple)):
+        return tuple(freeze(value) for value in data)
+    return data
+
+
+def thaw(data):
+    """
+    Make a mutable copy of data created by :func:`freeze`.
+
+    :param data: immutable data
+    :returns: mutable copy of the data
+    """
+    if isinstance(data, MappingProxyType):
+        return {key: thaw(value) for key, value in data.items()}
+    if isinstance(data, tuple):
+        return [thaw(value) for value in data]
+    return data
+
+
+def register_template(name, template):
+    """
+    Register a template for new metadata, which can then be used with
+    ``MetaData(template=name)``.
+
+    :param name: name of the template
+    :param template: path of a YAML file with the template, or a dictionary
+        with its contents. The dictionary is copied, so later changes to it
+        do not affect the template.
+    """
+    if isinstance(template, (str, os.PathLike)):
+        template = serialisation.load_file(template)
+    frozen = freeze(serialisation.to_plain(template))
+    with _LOCK:
+        _TEMPLATES[name] = frozen
+
+
+def get_template(name=DEFAULT_TEMPLATE):
+    """
+    Get a copy of the contents of a template.
+
+    :param name: name of the template
+    :returns: dictionary with the contents of the template
+    """
+    with _LOCK:
+        if name == DEFAULT_TEMPLATE and name not in _TEMPLATES:
+            _TEMPLATES[name] = freeze(
+                serialisation.load_file(
+                    os.path.join(
+                        os.path.dirname(__file__),
+                        "template",
+                        METADATA_TEMPLATE,
+                    )
+                )
+            )
+        try:
+            frozen = _TEMPLATES[name]
+        except KeyError:
+            raise ValueError(f"Unknown metadata template {name}") from None
+    return thaw(frozen)
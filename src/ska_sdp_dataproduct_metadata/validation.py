@@ -0,0 +1,186 @@
+"""Validating metadata against the schema."""
+
+import functools
+import json
+import os
+from collections import namedtuple
+
+from . import codegen
+from .filetable import FileRecord
+
+METADATA_SCHEMA = "metadata.json"
+
+Validators = namedtuple("Validators", ["full", "document", "sections", "file"])
+
+
+@functools.cache
+def validators():
+    """
+    Compile the validators of the metadata schema, on first use.
+
+    Besides the validator for the whole metadata, create validators for its
+    parts, so that only the parts which changed need to be validated: one
+    for the document without the contents of its sections, one for each
+    section, and one for a single entry in ``files``.
+    """
+    with open(
+        os.path.join(os.path.dirname(__file__), "schema", METADATA_SCHEMA),
+        "r",
+        encoding="utf-8",
+    ) as metadata_schema:
+        schema = json.load(metadata_schema)
+
+    properties = schema.get("properties", {})
+
+    files_schema = dict(properties["files"])
+    file_schema = files_schema.pop("items", {})
+
+    document_schema = dict(schema)
+    document_schema["properties"] = {key: True for key in properties}
+    document_schema["properties"]["files"] = files_schema
+
+    schemas = {
+        "full": schema,
+        "document": document_schema,
+        "file": file_schema,
+    }
+    schemas.update(
+        (f"sections.{key}", section_schema)
+        for key, section_schema in properties.items()
+        if key != "files"
+    )
+    checks = codegen.compile_schemas(schemas, (dict, FileRecord))
+    compiled = {
+        name: CompiledValidator(subschema, checks.get(name))
+        for name, subschema in schemas.items()
+    }
+
+    return Validators(
+        full=compiled["full"],
+        document=compiled["document"],
+        sections={
+            key: compiled[f"sections.{key}"]
+            for key in properties
+            if key != "files"
+        },
+        file=compiled["file"],
+    )
+
+
+@functools.cache
+def _validator_class():
+    """The jsonschema validator class for metadata."""
+    # jsonschema is slow to import, so only import it when needed
+    # pylint: disable-next=import-outside-toplevel
+    import jsonschema
+
+    # file entries are records rather than dictionaries
+    base_class = jsonschema.validators.Draft202012Validator
+    return jsonschema.validators.extend(
+        base_class,
+        type_checker=base_class.TYPE_CHECKER.redefine("object", _is_object),
+    )
+
+
+class CompiledValidator:
+    """
+    Validator of a schema, which checks documents with code generated from
+    the schema, see :mod:`.codegen`, and only uses jsonschema to find the
+    errors of invalid documents. The errors are thus exactly those of
+    jsonschema.
+
+    :param schema: the schema
+    :param check: generated function returning whether a document is valid,
+        or None if the schema could not be compiled
+    """
+
+    def __init__(self, schema, check=None):
+        self.schema = schema
+        self.check = check
+        self._validator = None
+
+    @property
+    def validator(self):
+        """The jsonschema validator, created on first use."""
+        if self._validator is None:
+            self._validator = _validator_class()(self.schema)
+        return self._validator
+
+    def is_valid(self, instance):
+        """Whether a document is valid."""
+        if self.check is not None:
+            return self.check(instance)
+        return self.validator.is_valid(instance)
+
+    def iter_errors(self, instance):
+        """Iterate over the errors of a document."""
+        if self.check is None or not self.check(instance):
+            yield from self.validator.iter_errors(instance)
+
+
+def _is_object(checker, instance):  # pylint: disable=unused-argument
+    """Check whether an instance is a JSON object."""
+    return isinstance(instance, (dict, FileRecord))
+
+
+class SchemaValidator:  # pylint: disable=too-few-public-methods
+    """
+    Descriptor for the validator of the whole metadata, which is compiled
+    when first accessed.
+    """
+
+    def __get__(self, instance, owner=None):
+        return validators().full
+
+
+def changed_errors(data, valid_sections, entries=None):
+    """
+    Validate the parts of the metadata which changed since it was last
+    found to be valid.
+
+    :param data: the metadata
+    :param valid_sections: copies of the sections as they were when last
+        found to be valid
+    :param entries: file entries changed since then, or None to validate
+        all of them
+    :returns: list of errors
+    """
+    # the document itself, without the contents of the sections
+    compiled = validators()
+    errors = list(compiled.document.iter_errors(data))
+
+    for key, validator in compiled.sections.items():
+        if key not in data or (
+            key in valid_sections and data[key] == valid_sections[key]
+        ):
+            continue
+        errors.extend(
+            prefix_errors(
+                validator.iter_errors(data[key]), (key,), ("properties", key)
+            )
+        )
+
+    files = data.get("files")
+    if isinstance(files, list):
+        for entry in files if entries is None else entries:
+            file_errors = list(compiled.file.iter_errors(entry))
+            if file_errors:
+                errors.extend(
+                    prefix_errors(
+                        file_errors,
+                        ("files", files.index(entry)),
+                        ("properties", "files", "items"),
+                    )
+                )
+    return errors
+
+
+def prefix_errors(errors, path, schema_path):
+    """
+    Prefix the paths of errors found when validating part of the metadata,
+    so that they match the errors from validating the whole document.
+    """
+    for error in errors:
+        error.path.extendleft(reversed(path))
+        error.schema_path.extendleft(reversed(schema_path))
+        yield error
@@ -0,0 +1,221 @@
+"""Writing metadata files, and writing them in a background thread."""
+
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+
+from . import serialisation, sidecar
+from .journal import Journal
+from .storage import write_atomic
+
+LOG = logging.getLogger("ska_sdp_dataproduct_metadata")
+
+
+class PendingWrite:  # pylint: disable=too-many-instance-attributes
+    """
+    A write of a metadata file prepared by :meth:`MetaData._prepare_write`,
+    which serialises and writes the metadata without the lock of the
+    MetaData object, e.g. in another thread, before
+    :meth:`MetaData._complete_write` records it.
+
+    :param output_path: path of the metadata file
+    :param data: the metadata to write, which must not change until the
+        write is done
+    :param durability: durability policy, see :class:`MetaData.Durability`
+    :param write_sidecar: whether to write the sidecar of the file
+    :param previous: sequence number of the metadata before the write
+    :param sequence: sequence number to write, or None to advance it
+    :param metrics: metrics.Metrics registry timing the steps of the write
+    :param labels: labels of the metrics
+    """
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        output_path,
+        data,
+        durability,
+        write_sidecar,
+        previous,
+        sequence,
+        metrics,
+        labels,
+    ):
+        self.start = time.perf_counter()
+        self.output_path = output_path
+        self.data = data
+        self.durability = durability
+        self.write_sidecar = write_sidecar
+        self.previous = previous
+        self.sequence = sequence
+        self.metrics = metrics
+        self.labels = labels
+        # times of the steps of the write, by metric name
+        self.timings = {}
+        self.text = None
+        self.sidecar_text = None
+
+    def timer(self, name):
+        """Context manager timing a step of the write."""
+        return self.metrics.timer(name, self.timings, **self.labels)
+
+    def serialise(self):
+        """
+        Serialise the metadata and its sidecar, e.g. before taking a lock on
+        the file.
+        """
+        with self.timer("serialisation_seconds"):
+            self.text = serialisation.dump(self.data)
+            if self.write_sidecar:
+                self.sidecar_text = sidecar.dumps(self.data)
+
+    def write(self):
+        """
+        Write the metadata file, serialising the metadata unless already
+        done, then write its sidecar, or advance the sequence number, and
+        clear the journal of the file, whose records it now includes. Both
+        are serialised before the file is replaced, so that an error
+        serialising them leaves the file as it was.
+        """
+        parent_dir = os.path.dirname(self.output_path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        if self.text is None:
+            self.serialise()
+        with self.timer("write_seconds"):
+            write_atomic(self.output_path, self.text, self.durability)
+        if self.write_sidecar:
+            with self.timer("sidecar_seconds"):
+                self.sequence = sidecar.write(
+                    self.output_path,
+                    self.data,
+                    self.durability,
+                    self.previous,
+                    self.sequence,
+                    self.sidecar_text,
+                )
+        elif self.sequence is None:
+            self.sequence = self.previous + 1
+        Journal(self.output_path).clear()
+
+    def record(self, files):
+        """
+        Record the metrics of the write once it is done.
+
+        :param files: number of file entries written
+        """
+        self.metrics.record_write(
+            self.output_path,
+            len(self.text.encode("utf8")),
+            time.perf_counter() - self.start,
+            self.timings,
+            files=files,
+            **self.labels,
+        )
+
+
+class BackgroundWriter:  # pylint: disable=too-many-instance-attributes
+    """
+    Daemon thread writing a MetaData object after it changes, at most once
+    per interval.
+
+    An error raised by a write is kept, and raised by :meth:`check` in the
+    thread changing the metadata.
+
+    The writer only refers weakly to the MetaData object while no write is
+    pending, so that an object which is no longer used is freed, and the
+    thread then stops. Each writer runs its own thread until it is stopped
+    or the object is freed.
+
+    :param write: method of the MetaData object writing it
+    :param interval: minimum time in seconds between writes
+    :param close: method of the MetaData object called at exit if the
+        writer was not stopped
+    """
+
+    def __init__(self, write, interval, close):
+        self.interval = interval
+        self._write = weakref.WeakMethod(write, self._freed)
+        self._close = weakref.WeakMethod(close)
+        self._condition = threading.Condition()
+        self._pending = False
+        # the write method while a write is pending, which keeps the object
+        # alive until it is written
+        self._pending_write = None
+        self._stopping = threading.Event()
+        self._error = None
+        atexit.register(self._close_at_exit)
+        self._thread = threading.Thread(
+            target=self._run, name="MetaData writer", daemon=True
+        )
+        self._thread.start()
+
+    def notify(self):
+        """Request a write."""
+        with self._condition:
+            self._pending = True
+            self._pending_write = self._write()
+            self._condition.notify()
+
+    def check(self):
+        """Raise the error of the last failed write, if any."""
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def stop(self):
+        """Stop the thread, without writing pending changes."""
+        self._signal_stop()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _signal_stop(self):
+        atexit.unregister(self._close_at_exit)
+        with self._condition:
+            self._stopping.set()
+            self._pending_write = None
+            self._condition.notify()
+
+    def _freed(self, _):
+        """Stop the thread once the MetaData object was freed."""
+        self._signal_stop()
+
+    def _run(self):
+        last_write = None
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping.is_set():
+                    self._condition.wait()
+            # wait until the interval since the last write has passed, so
+            # that the changes made meanwhile are written together
+            if last_write is not None:
+                delay = last_write + self.interval - time.monotonic()
+                if delay > 0:
+                    self._stopping.wait(delay)
+            if self._stopping.is_set():
+                return
+            with self._condition:
+                self._pending = False
+                write, self._pending_write = self._pending_write, None
+            try:
+                if write is not None:
+                    write()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                LOG.warning(
+                    "Writing metadata in the background failed: %s", err
+                )
+                self._error = err
+            write = None
+            last_write = time.monotonic()
+
+    def _close_at_exit(self):
+        close = self._close()
+        if close is None:
+            return
+        try:
+            close()
+        except Exception:  # pylint: disable=broad-exception-caught
+            LOG.exception("Writing metadata at exit failed")
@@ -1,7 +1,44 @@
 """Pytest fixtures."""
 
-from ska_sdp_dataproduct_metadata import config
+import pytest
+import yaml
+
+from ska_sdp_dataproduct_metadata import MetaData, config
 
 # Use the config DB memory backend. This will be overridden if the
 # FEATURE_CONFIG_DB environment variable is set to 1.
 config.FEATURE_CONFIG_DB = False
+
+METADATA_FILENAME = "ska-data-product.yaml"
+
+
+@pytest.fixture(autouse=True, scope="session")
+def validator_cache(tmp_path_factory):
+    """Cache the generated validators in a temporary directory"""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv(
+            "METADATA_VALIDATOR_CACHE",
+            str(tmp_path_factory.mktemp("validators")),
+        )
+        yield
+
+
+def new_metadata(output_path, **kwargs):
+    """Create a MetaData object writing a metadata file to output_path"""
+    metadata = MetaData(**kwargs)
+    metadata.output_path = output_path
+    metadata.set_execution_block_id("test")
+    return metadata
+
+
+def read_metadata(path):
+    """Read a metadata file"""
+    with open(path, "r", encoding="utf8") as metadata_file:
+        return yaml.safe_load(metadata_file)
+
+
+def read_files(path):
+    """Read the path and status of the files in a metadata file"""
+    return [
+        (file["path"], file["status"]) for file in read_metadata(path)["files"]
+    ]
@@ -0,0 +1,104 @@
+"""Test aggregating changes from worker processes over a Unix socket."""
+
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from ska_sdp_dataproduct_metadata import MetaData
+from ska_sdp_dataproduct_metadata.aggregator import (
+    Aggregator,
+    AggregatorClient,
+)
+
+from .conftest import METADATA_FILENAME, new_metadata, read_metadata
+
+WORKERS = 4
+FILES_PER_WORKER = 250
+
+
+def new_aggregator(tmp_path, **kwargs):
+    """Start an aggregator writing a metadata file in tmp_path"""
+    metadata = new_metadata(str(tmp_path / METADATA_FILENAME))
+    return Aggregator(metadata, str(tmp_path / "socket"), **kwargs).start()
+
+
+def register_files(socket_path, worker):
+    """Register files through the aggregator and mark them done"""
+    with AggregatorClient(socket_path) as client:
+        files = client.new_files(
+            {"dp_path": f"worker-{worker}/{index}.dat", "description": "x"}
+            for index in range(FILES_PER_WORKER // 2)
+        )
+        for index in range(FILES_PER_WORKER // 2, FILES_PER_WORKER):
+            files.append(
+                client.new_file(
+                    dp_path=f"worker-{worker}/{index}.dat", description="x"
+                )
+            )
+        for file in files:
+            file.update_status("done")
+
+
+def test_aggregator(tmp_path):
+    """Check that changes from many worker processes are all written"""
+    with new_aggregator(tmp_path, flush_count=100) as aggregator:
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            futures = [
+                executor.submit(register_files, aggregator.socket_path, worker)
+                for worker in range(WORKERS)
+            ]
+            for future in futures:
+                future.result()
+
+    files = read_metadata(aggregator.metadata.output_path)["files"]
+    assert len(files) == WORKERS * FILES_PER_WORKER
+    assert {file["status"] for file in files} == {"done"}
+    assert not (tmp_path / "socket").exists()
+
+
+def test_client(tmp_path):
+    """Check that the client behaves like MetaData"""
+    data_file = tmp_path / "data.bin"
+    data_file.write_bytes(b"data")
+
+    with new_aggregator(tmp_path, flush_interval=3600) as aggregator:
+        output_path = aggregator.metadata.output_path
+        with AggregatorClient(aggregator.socket_path) as client:
+            file = client.new_file(
+                dp_path=str(data_file), description="data", compute_crc=True
+            )
+            assert file.full_path == aggregator.metadata.runtime_abspath(
+                str(data_file)
+            )
+            with pytest.raises(ValueError, match="already exists"):
+                client.new_file(dp_path=str(data_file), description="data")
+
+            with client.batch():
+                file.update_status("done")
+            assert not (tmp_path / METADATA_FILENAME).exists()
+            client.flush()
+            assert read_metadata(output_path)["files"] == [
+                {
+                    "crc": str(zlib.crc32(b"data")),
+                    "description": "data",
+                    "path": str(data_file),
+                    "status": "done",
+                }
+            ]
+
+            # an invalid change is rejected, and only reported to the worker
+            # which made it
+            with pytest.raises(MetaData.ValidationError):
+                client.new_file(dp_path="invalid")
+            with pytest.raises(MetaData.ValidationError):
+                file.update_status(None)
+            with AggregatorClient(aggregator.socket_path) as other_client:
+                other_client.new_file(dp_path="other", description="other")
+                other_client.flush()
+            files = read_metadata(output_path)["files"]
+            assert [entry["path"] for entry in files] == [
+                str(data_file),
+                "other",
+            ]
+            assert files[0]["status"] == "done"
@@ -0,0 +1,152 @@
+"""Test the asyncio interface to the metadata."""
+
+import asyncio
+import threading
+import time
+import zlib
+
+import pytest
+
+from ska_sdp_dataproduct_metadata import MetaData, aio, sidecar
+from ska_sdp_dataproduct_metadata.metrics import Metrics
+from ska_sdp_dataproduct_metadata.writer import PendingWrite
+
+from .conftest import (
+    METADATA_FILENAME,
+    new_metadata,
+    read_files,
+    read_metadata,
+)
+
+
+def new_async_metadata(tmp_path):
+    """Create an AsyncMetaData object writing a metadata file in tmp_path"""
+    metadata = new_metadata(str(tmp_path / METADATA_FILENAME))
+    return aio.AsyncMetaData(metadata)
+
+
+def test_async_metadata(tmp_path):
+    """Check that changes made from coroutines are written"""
+    data_file = tmp_path / "data.bin"
+    data_file.write_bytes(b"data")
+
+    async def register():
+        async with new_async_metadata(tmp_path) as metadata:
+            file = await metadata.new_file(
+                dp_path=str(data_file), description="data", compute_crc=True
+            )
+            output_path = metadata.metadata.output_path
+            assert read_files(output_path) == [(str(data_file), "working")]
+
+            await file.update_status("done")
+            async with metadata.batch():
+                files = await metadata.new_files(
+                    [
+                        {"dp_path": "a.dat", "description": "a"},
+                        {"dp_path": "b.dat", "description": "b"},
+                    ]
+                )
+                await files[0].update_status("failure")
+                assert len(read_files(output_path)) == 1
+            with pytest.raises(ValueError, match="already exists"):
+                await metadata.new_file(dp_path="a.dat", description="a")
+        return output_path
+
+    output_path = asyncio.run(register())
+    assert read_files(output_path) == [
+        (str(data_file), "done"),
+        ("a.dat", "failure"),
+        ("b.dat", "working"),
+    ]
+    crc = read_metadata(output_path)["files"][0]["crc"]
+    assert crc == str(zlib.crc32(b"data"))
+
+    with pytest.raises(ValueError, match="journal"):
+        aio.AsyncMetaData(MetaData(journal=True))
+    with pytest.raises(ValueError, match="background"):
+        aio.AsyncMetaData(MetaData(write_interval=1.0))
+
+
+def test_writes_are_coalesced(tmp_path, monkeypatch):
+    """
+    Check that writes run off the event loop, and that changes made while a
+    write is in flight are written together
+    """
+    writes = []
+    write = PendingWrite.write
+
+    def slow_write(pending):
+        writes.append(threading.current_thread())
+        time.sleep(0.2)
+        write(pending)
+
+    monkeypatch.setattr(PendingWrite, "write", slow_write)
+
+    async def register():
+        metadata = new_async_metadata(tmp_path)
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        first = asyncio.create_task(
+            metadata.new_file(dp_path="first.dat", description="x")
+        )
+        # let the first write start
+        await asyncio.sleep(0.05)
+        await asyncio.gather(
+            first,
+            *(
+                metadata.new_file(dp_path=f"{index}.dat", description="x")
+                for index in range(20)
+            ),
+        )
+        ticker.cancel()
+        return metadata.metadata.output_path, ticks
+
+    output_path, ticks = asyncio.run(register())
+    assert len(read_files(output_path)) == 21
+    # the first change is written alone, all others in one more write
+    assert len(writes) == 2
+    assert threading.main_thread() not in writes
+    # the event loop kept running during the writes
+    assert ticks > 10
+
+
+def test_async_writes_are_recorded(tmp_path, monkeypatch):
+    """
+    Check that asynchronous writes advance the sequence number, and send
+    patches and record metrics as MetaData.write does
+    """
+    metrics = Metrics()
+    monkeypatch.setattr(MetaData, "metrics", metrics)
+    metadata = new_metadata(str(tmp_path / METADATA_FILENAME), sidecar=True)
+    patches = []
+    metadata.changelog.subscribe(patches.append)
+
+    async def register():
+        async with aio.AsyncMetaData(metadata) as async_metadata:
+            file = await async_metadata.new_file(
+                dp_path="a.dat", description="a"
+            )
+            await file.update_status("done")
+
+    asyncio.run(register())
+    assert metadata.sequence == 2
+    assert sidecar.read_sequence(metadata.output_path) == 2
+    assert not metadata.dirty
+    assert [(patch["base"], patch["sequence"]) for patch in patches] == [
+        (None, 1),
+        (1, 2),
+    ]
+    assert patches[1]["ops"] == [
+        {"op": "replace", "path": "/files/0/status", "value": "done"}
+    ]
+    totals = {metric["name"]: metric for metric in metrics.snapshot()}
+    assert totals["flush_seconds"]["count"] == 2
+    for name in ("validation_seconds", "write_seconds", "sidecar_seconds"):
+        assert totals[name]["count"] == 2
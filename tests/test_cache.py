@@ -0,0 +1,157 @@
+"""Test the cache of execution blocks and scripts."""
+
+import time
+
+import ska_sdp_config
+
+from ska_sdp_dataproduct_metadata import MetaData
+from ska_sdp_dataproduct_metadata.cache import ConfigCache
+
+from .conftest import read_metadata
+from .test_metadata import (
+    CONFIG_DB_CLIENT,
+    MOUNT_PATH,
+    OUTPUT_METADATA_WITHOUT_FILES,
+    clean_up,
+    create_eb_pb,
+)
+
+
+def get_eb_id():
+    """Get the ID of the execution block in the config DB"""
+    for txn in CONFIG_DB_CLIENT.txn():
+        return txn.execution_block.list_keys()[0]
+
+
+def test_hits_and_misses():
+    """Check that records are read from the config DB only once"""
+    clean_up(f"{MOUNT_PATH}/product")
+    create_eb_pb()
+    eb_id = get_eb_id()
+
+    cache = ConfigCache(CONFIG_DB_CLIENT, watch=False)
+    for txn in CONFIG_DB_CLIENT.txn():
+        first = cache.execution_block(txn, eb_id)
+        second = cache.execution_block(txn, eb_id)
+        assert cache.execution_block(txn, "eb-test-20200325-99999") is None
+    assert first is second
+    assert first.key == eb_id
+    assert cache.stats() == {
+        "hits": 1,
+        "misses": 2,
+        "evictions": 0,
+        "invalidations": 0,
+        "size": 1,
+    }
+
+
+def test_evictions():
+    """Check that expired and least recently used entries are evicted"""
+    clean_up(f"{MOUNT_PATH}/product")
+    create_eb_pb()
+    eb_id = get_eb_id()
+    other_eb_id = "eb-test-20200325-00002"
+    for txn in CONFIG_DB_CLIENT.txn():
+        txn.execution_block.create(
+            ska_sdp_config.ExecutionBlock(key=other_eb_id)
+        )
+
+    cache = ConfigCache(CONFIG_DB_CLIENT, ttl=0.0, watch=False)
+    for txn in CONFIG_DB_CLIENT.txn():
+        cache.execution_block(txn, eb_id)
+        cache.execution_block(txn, eb_id)
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["evictions"] == 1
+
+    cache = ConfigCache(CONFIG_DB_CLIENT, max_size=1, watch=False)
+    for txn in CONFIG_DB_CLIENT.txn():
+        cache.execution_block(txn, eb_id)
+        cache.execution_block(txn, other_eb_id)
+        cache.execution_block(txn, eb_id)
+    assert cache.stats()["misses"] == 3
+    assert cache.stats()["evictions"] == 2
+    assert cache.stats()["size"] == 1
+
+
+def test_watcher_drops_changed_entries():
+    """Check that entries changed in the config DB are dropped"""
+    clean_up(f"{MOUNT_PATH}/product")
+    create_eb_pb()
+    eb_id = get_eb_id()
+
+    cache = ConfigCache(CONFIG_DB_CLIENT, ttl=None, watch_interval=0.1)
+    try:
+        for txn in CONFIG_DB_CLIENT.txn():
+            assert cache.execution_block(txn, eb_id) is not None
+
+        for txn in CONFIG_DB_CLIENT.txn():
+            txn.execution_block.delete(eb_id)
+
+        deadline = time.monotonic() + 10
+        while cache.stats()["invalidations"] == 0:
+            assert time.monotonic() < deadline, "entry was not invalidated"
+            time.sleep(0.05)
+
+        for txn in CONFIG_DB_CLIENT.txn():
+            assert cache.execution_block(txn, eb_id) is None
+    finally:
+        cache.close()
+
+
+def test_load_processing_block_with_cache(monkeypatch):
+    """Check that loading processing blocks uses the cache if it is set"""
+    clean_up(f"{MOUNT_PATH}/product")
+    create_eb_pb()
+    for txn in CONFIG_DB_CLIENT.txn():
+        pb_id = txn.processing_block.list_keys()[0]
+
+    cache = ConfigCache(watch=False)
+    monkeypatch.setattr(MetaData, "config_cache", cache)
+
+    expected = read_metadata(OUTPUT_METADATA_WITHOUT_FILES)
+    for _ in range(2):
+        metadata = MetaData()
+        metadata.load_processing_block(pb_id, mount_path=MOUNT_PATH)
+        assert metadata.get_data().dict() == expected
+
+    # The execution block and script are read once, then found in the cache
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["hits"] == 2
+
+
+def test_watcher_does_not_poll(monkeypatch):
+    """
+    Check that the watcher only reads the cached entries again when entries
+    were added, or after the refresh interval
+    """
+    clean_up(f"{MOUNT_PATH}/product")
+    create_eb_pb()
+    eb_id = get_eb_id()
+
+    cache = ConfigCache(CONFIG_DB_CLIENT, ttl=None, watch_interval=0.05)
+    readings = []
+    find_stale = cache._find_stale  # pylint: disable=protected-access
+    monkeypatch.setattr(
+        cache,
+        "_find_stale",
+        lambda txn: readings.append(time.monotonic()) or find_stale(txn),
+    )
+
+    def wait_for_readings(count):
+        deadline = time.monotonic() + 10
+        while len(readings) < count:
+            assert time.monotonic() < deadline, "entries were not read"
+            time.sleep(0.05)
+
+    try:
+        for txn in CONFIG_DB_CLIENT.txn():
+            cache.execution_block(txn, eb_id)
+        # the entries are read once they are cached, and possibly before
+        wait_for_readings(1)
+        time.sleep(0.5)
+        assert len(readings) <= 2
+
+        cache.refresh_interval = 0.1
+        wait_for_readings(len(readings) + 2)
+    finally:
+        cache.close()
@@ -0,0 +1,107 @@
+"""Test the catalogue of metadata files."""
+
+import os
+
+import pytest
+
+from ska_sdp_dataproduct_metadata import serialisation
+from ska_sdp_dataproduct_metadata.catalogue import Catalogue
+
+METADATA_FILENAME = "ska-data-product.yaml"
+
+
+def write_metadata(root, eb_id, pb_id, dataproduct_type, statuses):
+    """Write a metadata file for a product below root"""
+    path = os.path.join(
+        root, "product", eb_id, "ska-sdp", pb_id, METADATA_FILENAME
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {
+        "execution_block": eb_id,
+        "config": {"processing_block": pb_id},
+        "files": [
+            {"path": f"file-{index}", "status": status}
+            for index, status in enumerate(statuses)
+        ],
+        "obscore": {"dataproduct_type": dataproduct_type},
+    }
+    with open(path, "w", encoding="utf8") as metadata_file:
+        metadata_file.write(serialisation.dump(data))
+    return path
+
+
+@pytest.fixture(name="catalogue")
+def catalogue_fixture(tmp_path):
+    """Catalogue of a product tree with a few products"""
+    root = tmp_path / "mnt"
+    write_metadata(root, "eb-1", "pb-1", "MS", ["done", "done"])
+    write_metadata(root, "eb-1", "pb-2", "MS", ["done", "failure"])
+    write_metadata(root, "eb-1", "pb-3", "POINTING-OFFSETS", ["working"])
+    write_metadata(root, "eb-2", "pb-4", "MS", ["failure"])
+    with Catalogue(tmp_path / "catalogue.sqlite", root) as catalogue:
+        yield catalogue
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_query(catalogue, processes):
+    """Check that products can be found by their fields and file status"""
+    assert catalogue.refresh(processes=processes) == (4, 0)
+
+    products = catalogue.query(execution_block="eb-1", status="failure")
+    assert [product["processing_block"] for product in products] == ["pb-2"]
+    assert catalogue.files(products[0]["path"], status="failure") == [
+        ("file-1", "failure")
+    ]
+
+    products = catalogue.query(dataproduct_type="MS")
+    assert [product["processing_block"] for product in products] == [
+        "pb-1",
+        "pb-2",
+        "pb-4",
+    ]
+    assert len(catalogue.query()) == 4
+    assert not catalogue.query(processing_block="pb-5")
+
+
+def test_incremental_refresh(catalogue):
+    """Check that a refresh only reads new and modified metadata files"""
+    catalogue.refresh()
+    assert catalogue.refresh() == (0, 0)
+
+    path = write_metadata(catalogue.root, "eb-1", "pb-1", "MS", ["failure"])
+    os.utime(path, ns=(0, 0))
+    write_metadata(catalogue.root, "eb-3", "pb-5", "MS", ["done"])
+    os.remove(catalogue.query(processing_block="pb-4")[0]["path"])
+    assert catalogue.refresh() == (2, 1)
+
+    products = catalogue.query(status="failure")
+    assert [product["processing_block"] for product in products] == [
+        "pb-1",
+        "pb-2",
+    ]
+    assert catalogue.query(execution_block="eb-3")
+    assert not catalogue.query(execution_block="eb-2")
+
+
+def test_skipped_files(catalogue):
+    """
+    Check that metadata files which are not mappings are skipped, and that
+    the data products of a product are not searched
+    """
+    path = write_metadata(catalogue.root, "eb-1", "pb-1", "MS", ["done"])
+    nested = os.path.join(os.path.dirname(path), "data", METADATA_FILENAME)
+    os.makedirs(os.path.dirname(nested))
+    with open(nested, "w", encoding="utf8") as metadata_file:
+        metadata_file.write("ignored: true\n")
+    path = write_metadata(catalogue.root, "eb-3", "pb-5", "MS", [])
+    with open(path, "w", encoding="utf8") as metadata_file:
+        metadata_file.write("- not a mapping\n")
+
+    assert catalogue.refresh() == (4, 0)
+    products = catalogue.query()
+    assert [product["processing_block"] for product in products] == [
+        "pb-1",
+        "pb-2",
+        "pb-3",
+        "pb-4",
+    ]
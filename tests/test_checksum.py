@@ -0,0 +1,60 @@
+"""Test computing CRC checksums of data product files."""
+
+import os
+import zlib
+
+from ska_sdp_dataproduct_metadata import checksum
+
+
+def write_tree(root, files):
+    """Create files with the given contents below root"""
+    for name, contents in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as data_file:
+            data_file.write(contents)
+
+
+def test_crc32_file(tmp_path):
+    """
+    Check that the CRC of a file does not depend on the chunk size
+    """
+    contents = os.urandom(100_000)
+    write_tree(tmp_path, {"data.bin": contents})
+    path = tmp_path / "data.bin"
+
+    expected = zlib.crc32(contents)
+    assert checksum.crc32_file(path) == expected
+    assert checksum.crc32_file(path, chunk_size=4096) == expected
+    assert checksum.crc32_path(path) == expected
+
+
+def test_crc32_directory(tmp_path):
+    """
+    Check that the CRC of a directory does not depend on the order in
+    which files were created or on the number of threads, but changes with
+    file names and contents
+    """
+    files = {
+        "table.f0": b"first column",
+        "table.f1": b"second column",
+        "SUBTABLE/table.f0": b"subtable",
+        "table.dat": b"",
+    }
+    write_tree(tmp_path / "a.ms", files)
+    write_tree(tmp_path / "b.ms", dict(reversed(files.items())))
+
+    crc = checksum.crc32_path(tmp_path / "a.ms")
+    assert checksum.crc32_path(tmp_path / "b.ms", max_workers=1) == crc
+    assert checksum.list_files(tmp_path / "a.ms") == [
+        "SUBTABLE/table.f0",
+        "table.dat",
+        "table.f0",
+        "table.f1",
+    ]
+
+    os.rename(tmp_path / "b.ms" / "table.f1", tmp_path / "b.ms" / "table.f2")
+    assert checksum.crc32_path(tmp_path / "b.ms") != crc
+
+    write_tree(tmp_path / "a.ms", {"table.f0": b"first columN"})
+    assert checksum.crc32_path(tmp_path / "a.ms") != crc
@@ -0,0 +1,133 @@
+"""Test cloning metadata."""
+
+import tracemalloc
+
+import pytest
+
+from ska_sdp_dataproduct_metadata import ObsCore
+
+from .conftest import METADATA_FILENAME, new_metadata, read_metadata
+
+
+def base_metadata(output_path=None):
+    """
+    MetaData object with a large context, cloned from the one whose data
+    was set through get_data, so that its clones share its sections
+    """
+    metadata = new_metadata(output_path)
+    metadata.set_execution_block_id("eb-test-20240101-00000")
+    data = metadata.get_data()
+    data.context = {f"key-{index}": {"value": index} for index in range(1000)}
+    data.obscore.instrument_name = ObsCore.SKA_LOW
+    return metadata.clone(output_path)
+
+
+def test_clone(tmp_path):
+    """
+    Check that clones are written with the sections of the original, and
+    that changes to either do not affect the other
+    """
+    base = base_metadata(str(tmp_path / METADATA_FILENAME))
+    base.new_file(dp_path="calibration.h5", description="calibration")
+    clones = [
+        base.clone(str(tmp_path / str(index) / METADATA_FILENAME))
+        for index in range(3)
+    ]
+    clones[1].get_data().context["key-0"]["value"] = "changed"
+    clones[2].get_data().config.cmdline = "changed"
+    base.get_data().obscore.instrument_name = ObsCore.SKA_MID
+    for index, clone in enumerate(clones):
+        clone.new_file(dp_path=f"vis-{index}.ms", description="visibilities")
+
+    written = [read_metadata(clone.output_path) for clone in clones]
+    for index, data in enumerate(written):
+        assert data["execution_block"] == "eb-test-20240101-00000"
+        assert data["obscore"]["instrument_name"] == "SKA-LOW"
+        assert [entry["path"] for entry in data["files"]] == [
+            "calibration.h5",
+            f"vis-{index}.ms",
+        ]
+    assert written[0]["context"] == base.get_data().context
+    assert written[1]["context"]["key-0"] == {"value": "changed"}
+    assert [data["config"]["cmdline"] for data in written] == [
+        None,
+        None,
+        "changed",
+    ]
+
+    clones[0].write()
+    assert read_metadata(clones[0].output_path) == written[0]
+    assert base.get_data().context["key-0"] == {"value": 0}
+    assert base.get_data().config.cmdline is None
+    assert len(base.get_data().files) == 1
+    assert base.output_path == str(tmp_path / METADATA_FILENAME)
+
+
+def test_clone_sections(tmp_path):
+    """Check that sections can be updated when cloning"""
+    base = base_metadata()
+    clone = base.clone(
+        str(tmp_path / METADATA_FILENAME),
+        {"obscore": {"dataproduct_type": ObsCore.DataProductType.MS}},
+    )
+    clone.write()
+    obscore = read_metadata(clone.output_path)["obscore"]
+    assert obscore["dataproduct_type"] == "MS"
+    assert obscore["instrument_name"] == "SKA-LOW"
+    assert base.get_data().obscore.dataproduct_type == "Unknown"
+
+    # patches change the sections of the clone only
+    clone.apply_patch(
+        {
+            "base": clone.sequence,
+            "sequence": clone.sequence + 1,
+            "ops": [{"op": "remove", "path": "/context/key-0/value"}],
+        }
+    )
+    assert read_metadata(clone.output_path)["context"]["key-0"] == {}
+    assert base.get_data().context["key-0"] == {"value": 0}
+
+    with pytest.raises(ValueError):
+        base.clone(sections={"obscore": {"a.b": 1}})
+
+
+def test_clone_data_handed_out():
+    """
+    Check that changes made through the data returned by get_data before
+    cloning do not affect the clones
+    """
+    metadata = new_metadata(None)
+    data = metadata.get_data()
+    obscore = data.obscore
+    data.context = {"key": {"value": 0}}
+    clone = metadata.clone()
+    data.obscore.instrument_name = ObsCore.SKA_LOW
+    obscore.facility_name = "changed"
+    data.context["key"]["value"] = 1
+
+    clone_data = clone.get_data()
+    assert clone_data.obscore.instrument_name != ObsCore.SKA_LOW
+    assert clone_data.obscore.facility_name != "changed"
+    assert clone_data.context == {"key": {"value": 0}}
+
+
+def test_clone_memory():
+    """
+    Check that clones share the sections of the original until they are
+    changed
+    """
+    base = base_metadata()
+    base.validate(incremental=True)
+
+    tracemalloc.start()
+    try:
+        clones = [base.clone() for _ in range(10)]
+        for clone in clones:
+            clone.validate(incremental=True)
+        shared = tracemalloc.get_traced_memory()[0]
+        clones[0].get_data()
+        copied = tracemalloc.get_traced_memory()[0] - shared
+    finally:
+        tracemalloc.stop()
+    # a copy of the context is much larger than all the clones
+    assert shared < copied
@@ -0,0 +1,248 @@
+"""Test the validators generated from the metadata schema."""
+
+import copy
+import importlib.util
+import os
+import py_compile
+import random
+
+import jsonschema
+import pytest
+import yaml
+
+from ska_sdp_dataproduct_metadata import MetaData, ObsCore, codegen, validation
+from ska_sdp_dataproduct_metadata.filetable import FileRecord
+
+RESOURCES = os.path.join(os.path.dirname(__file__), "resources")
+
+VALUES = [
+    None,
+    True,
+    False,
+    0,
+    1,
+    2,
+    -3,
+    1.0,
+    1.5,
+    float("inf"),
+    "",
+    "x",
+    "done",
+    "working",
+    "failure",
+    "1",
+    [],
+    [1, True],
+    [1.0, 1],
+    {},
+    {"a": 1},
+    {"a": True},
+    ObsCore.DataProductType.MS,
+    ObsCore.CalibrationLevel.LEVEL_1,
+    ObsCore.AccessFormat.TAR_GZ,
+]
+
+KEYS = ["path", "status", "crc", "execution_block", "cmdline", "s_ra", "x"]
+
+SCHEMA = {
+    "type": "object",
+    "required": ["a"],
+    "properties": {
+        "a": {"type": ["integer", "string"], "enum": [1, "1", [1, True]]},
+        "b": {"const": {"a": 1}},
+        "c": {"type": "array", "items": {"type": ["number", "null"]}},
+        "d": {"items": False, "additionalProperties": {"type": "boolean"}},
+        "e": False,
+        "f": {"enum": [1.0, None, "done"], "format": "uri", "title": "f"},
+    },
+    "additionalProperties": {"type": "object", "properties": {"a": True}},
+}
+
+
+def documents():
+    """Valid documents and file entries"""
+    for filename in sorted(os.listdir(RESOURCES)):
+        if filename.endswith(".yaml"):
+            with open(
+                os.path.join(RESOURCES, filename), "r", encoding="utf8"
+            ) as resource:
+                yield yaml.safe_load(resource)
+
+
+def paths(value, prefix=()):
+    """All paths in a document"""
+    yield prefix
+    if isinstance(value, (dict, FileRecord)):
+        for key, item in value.items():
+            yield from paths(item, prefix + (key,))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from paths(item, prefix + (index,))
+
+
+def mutate(document, rng):
+    """Change, add or remove a random value of a document"""
+    document = copy.deepcopy(document)
+    path = rng.choice(list(paths(document)))
+    if not path:
+        return rng.choice(VALUES)
+    parent = document
+    for key in path[:-1]:
+        parent = parent[key]
+    action = rng.random()
+    if action < 0.2 and not isinstance(parent, list):
+        del parent[path[-1]]
+    elif action < 0.35 and not isinstance(parent, list):
+        parent[rng.choice(KEYS)] = copy.deepcopy(rng.choice(VALUES))
+    elif action < 0.45 and isinstance(parent[path[-1]], dict):
+        parent[path[-1]] = FileRecord(parent[path[-1]])
+    else:
+        parent[path[-1]] = copy.deepcopy(rng.choice(VALUES))
+    return document
+
+
+def error_paths(validator, document):
+    """The paths of the errors of a document"""
+    return sorted(
+        (list(error.path), list(error.schema_path))
+        for error in validator.iter_errors(document)
+    )
+
+
+def check_same_errors(compiled, document):
+    """
+    Check that a compiled validator accepts the same documents as
+    jsonschema, with the same errors
+    """
+    # pylint: disable-next=protected-access
+    reference = validation._validator_class()(compiled.schema)
+    valid = reference.is_valid(document)
+    assert compiled.check(document) == valid, document
+    assert compiled.is_valid(document) == valid
+    assert error_paths(compiled, document) == error_paths(reference, document)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_metadata_schema(seed):
+    """
+    Check that the validators of the metadata schema and its parts give the
+    same results as jsonschema for fuzzed documents
+    """
+    compiled = validation.validators()
+    assert all(
+        validator.check is not None
+        for validator in [
+            compiled.full,
+            compiled.document,
+            compiled.file,
+            *compiled.sections.values(),
+        ]
+    )
+    rng = random.Random(seed)
+    for document in documents():
+        check_same_errors(compiled.full, document)
+        for _ in range(250):
+            mutated = mutate(document, rng)
+            check_same_errors(compiled.full, mutated)
+            check_same_errors(compiled.document, mutated)
+            if isinstance(mutated, dict):
+                for key, validator in compiled.sections.items():
+                    if key in mutated:
+                        check_same_errors(validator, mutated[key])
+                files = mutated.get("files")
+                for entry in files if isinstance(files, list) else []:
+                    check_same_errors(compiled.file, entry)
+
+    # a mix of entries which are records and dictionaries
+    metadata = MetaData()
+    metadata.set_execution_block_id("test")
+    metadata.get_data().files.append({"path": "a.ms", "status": "done"})
+    metadata.get_data().files.append(FileRecord(path="b.ms", status="x"))
+    check_same_errors(compiled.full, metadata.get_data())
+
+
+def test_keywords(tmp_path, monkeypatch):
+    """
+    Check that the generator gives the same results as jsonschema for all
+    the keywords it compiles, and that it does not compile other keywords
+    """
+    monkeypatch.setenv("METADATA_VALIDATOR_CACHE", str(tmp_path))
+    draft = jsonschema.validators.Draft202012Validator
+    # formats are only asserted with a format checker, which is not used
+    assert set(draft.VALIDATORS) - {"format"} <= (
+        codegen.COMPILED_KEYWORDS | codegen.UNSUPPORTED_KEYWORDS
+    )
+
+    schemas = {
+        "schema": SCHEMA,
+        "true": True,
+        "false": False,
+        "minimum": {"properties": {"a": {"minimum": 1}}},
+        "unknown_type": {"type": "decimal"},
+    }
+    checks = codegen.compile_schemas(schemas, (dict, FileRecord))
+    assert sorted(checks) == ["false", "schema", "true"]
+    rng = random.Random(0)
+    document = {"a": 1.0, "b": {"a": 1}, "c": [1.5, None], "d": {"x": True}}
+    for index in range(2000):
+        mutated = mutate(document, rng) if index else document
+        for name, check in checks.items():
+            compiled = validation.CompiledValidator(schemas[name], check)
+            check_same_errors(compiled, mutated)
+
+    # schemas which are not compiled are validated by jsonschema
+    unsupported = validation.CompiledValidator(schemas["minimum"])
+    assert unsupported.is_valid({"a": 1})
+    assert error_paths(unsupported, {"a": 0}) == [
+        (["a"], ["properties", "a", "minimum"])
+    ]
+
+
+def test_cache(tmp_path, monkeypatch):
+    """Check that generated validators are cached and reused"""
+    monkeypatch.setenv("METADATA_VALIDATOR_CACHE", str(tmp_path / "cache"))
+    schemas = {"schema": SCHEMA}
+    check = codegen.compile_schemas(schemas)["schema"]
+    cached = os.listdir(tmp_path / "cache")
+    assert len([name for name in cached if name.endswith(".py")]) == 1
+
+    def fail(_):
+        raise AssertionError("Validators were generated again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(codegen, "generate", fail)
+        cached_check = codegen.compile_schemas(schemas)["schema"]
+    assert cached_check.__code__.co_code == check.__code__.co_code
+    assert cached_check({"a": "1"}) and not cached_check({"a": 2})
+
+    # bytecode matching the cached source is not used
+    (source_path,) = (tmp_path / "cache").glob("*.py")
+    source = source_path.read_bytes()
+    stat = source_path.stat()
+    planted = b'raise AssertionError("planted")\n'
+    source_path.write_bytes(planted.ljust(len(source), b"#"))
+    os.utime(source_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    py_compile.compile(
+        str(source_path),
+        importlib.util.cache_from_source(str(source_path)),
+        doraise=True,
+    )
+    source_path.write_bytes(source)
+    os.utime(source_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    with monkeypatch.context() as patch:
+        patch.setattr(codegen, "generate", fail)
+        cached_check = codegen.compile_schemas(schemas)["schema"]
+    assert cached_check({"a": "1"}) and not cached_check({"a": 2})
+
+    # a cached module which was changed is not used, but generated again
+    source_path.write_text('raise AssertionError("changed")\n')
+    check = codegen.compile_schemas(schemas)["schema"]
+    assert check({"a": "1"}) and not check({"a": 2})
+    assert "changed" not in source_path.read_text()
+
+    # without a cache, the code is compiled in memory
+    (tmp_path / "file").write_text("")
+    monkeypatch.setenv("METADATA_VALIDATOR_CACHE", str(tmp_path / "file"))
+    check = codegen.compile_schemas(schemas)["schema"]
+    assert check({"a": "1"}) and not check({"a": 2})
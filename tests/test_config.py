@@ -0,0 +1,21 @@
+"""Test the connection to the SDP configuration database."""
+
+import os
+
+from ska_sdp_dataproduct_metadata import config, get_config_client
+
+
+def test_shared_client():
+    """Check that the same client is returned every time"""
+    assert get_config_client() is get_config_client()
+
+
+def test_client_not_inherited_by_fork():
+    """Check that a forked process does not reuse the client of its parent"""
+    get_config_client()
+    pid = os.fork()
+    if pid == 0:
+        # pylint: disable-next=protected-access
+        os._exit(0 if config._CLIENT is None else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
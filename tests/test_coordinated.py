@@ -0,0 +1,104 @@
+"""Test processes writing the same metadata file concurrently."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from ska_sdp_dataproduct_metadata import MetaData
+
+from .conftest import METADATA_FILENAME, new_metadata, read_files
+
+WORKERS = 8
+FILES_PER_WORKER = 250
+BATCH_SIZE = 125
+SINGLE_FILES = 2
+
+
+def register_files(output_path, worker):
+    """Register files in batches and one by one, and mark them done"""
+    metadata = new_metadata(output_path, coordinated=True)
+    for start in range(0, FILES_PER_WORKER, BATCH_SIZE):
+        with metadata.batch():
+            files = metadata.new_files(
+                {
+                    "dp_path": f"worker-{worker}/{index}.dat",
+                    "description": f"file {index} of worker {worker}",
+                }
+                for index in range(start, start + BATCH_SIZE)
+            )
+        with metadata.batch():
+            for file in files:
+                file.update_status("done")
+    for index in range(SINGLE_FILES):
+        file = metadata.new_file(
+            dp_path=f"worker-{worker}/single-{index}.dat",
+            description="single file",
+        )
+        file.update_status("done")
+
+
+def test_uncoordinated_writes_lose_files(tmp_path):
+    """Check that without coordination, the last writer wins"""
+    output_path = str(tmp_path / METADATA_FILENAME)
+    first = new_metadata(output_path)
+    second = new_metadata(output_path)
+    first.new_file(dp_path="a.dat", description="a")
+    second.new_file(dp_path="b.dat", description="b")
+    assert read_files(output_path) == [("b.dat", "working")]
+
+
+def test_coordinated_writes_merge_files(tmp_path):
+    """Check that coordinated writes merge files and their status"""
+    output_path = str(tmp_path / METADATA_FILENAME)
+    first = new_metadata(output_path, coordinated=True)
+    second = new_metadata(output_path, coordinated=True)
+    file_a = first.new_file(dp_path="a.dat", description="a")
+    file_b = second.new_file(dp_path="b.dat", description="b")
+    file_a.update_status("done")
+    assert read_files(output_path) == [
+        ("a.dat", "done"),
+        ("b.dat", "working"),
+    ]
+
+    # The update of b must not revert the status of a
+    file_b.update_status("failure")
+    assert read_files(output_path) == [
+        ("a.dat", "done"),
+        ("b.dat", "failure"),
+    ]
+    paths = [file.path for file in second.get_data().files]
+    assert paths == ["a.dat", "b.dat"]
+    assert os.path.exists(output_path + ".lock")
+
+    with pytest.raises(ValueError, match="journal"):
+        MetaData(journal=True, coordinated=True)
+
+
+def test_concurrent_processes(tmp_path):
+    """
+    Check that no files are lost when many processes register thousands of
+    files in the same metadata file concurrently
+    """
+    output_path = str(tmp_path / METADATA_FILENAME)
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        futures = [
+            executor.submit(register_files, output_path, worker)
+            for worker in range(WORKERS)
+        ]
+        for future in futures:
+            future.result()
+
+    files = read_files(output_path)
+    expected = {
+        f"worker-{worker}/{index}.dat"
+        for worker in range(WORKERS)
+        for index in range(FILES_PER_WORKER)
+    } | {
+        f"worker-{worker}/single-{index}.dat"
+        for worker in range(WORKERS)
+        for index in range(SINGLE_FILES)
+    }
+    assert len(files) == len(expected)
+    assert {path for path, _ in files} == expected
+    assert {status for _, status in files} == {"done"}
@@ -0,0 +1,132 @@
+"""Test the representation of file entries."""
+
+import copy
+import json
+import sys
+
+import pytest
+import yaml
+
+from ska_sdp_dataproduct_metadata import MetaData, serialisation
+from ska_sdp_dataproduct_metadata.filetable import FileRecord
+
+METADATA_FILENAME = "ska-data-product.yaml"
+
+
+def test_file_record():
+    """Check that records behave as dictionaries of their items"""
+    record = FileRecord({"path": "a.ms", "status": "working"}, size=10)
+    record["checksum_type"] = "crc32"
+    assert record == {
+        "path": "a.ms",
+        "status": "working",
+        "size": 10,
+        "checksum_type": "crc32",
+    }
+    # the fields are slots, which pylint does not see
+    # pylint: disable-next=no-member
+    assert record.path == "a.ms"
+    assert "crc" not in record
+    assert record.get("crc") is None
+    with pytest.raises(KeyError):
+        _ = record["crc"]
+    with pytest.raises(AttributeError):
+        # pylint: disable-next=no-member
+        _ = record.crc
+
+    del record["size"]
+    del record["checksum_type"]
+    with pytest.raises(KeyError):
+        del record["size"]
+    assert len(record) == 2
+    assert list(record) == ["path", "status"]
+
+    status = "".join(["do", "ne"])
+    record["status"] = status
+    # pylint: disable-next=no-member
+    assert record.status is sys.intern(status)
+
+    assert copy.deepcopy(record) == record
+    assert json.loads(json.dumps(record, default=dict)) == record
+    assert serialisation.to_plain([record]) == [dict(record)]
+    assert not hasattr(record, "__dict__")
+
+
+def test_entries_are_records(tmp_path):
+    """
+    Check that file entries are records, both when created and when read
+    from a metadata file, that they are written as before, and handed out
+    as dictionaries by get_data
+    """
+    output_path = str(tmp_path / "product" / METADATA_FILENAME)
+    metadata = MetaData()
+    metadata.output_path = output_path
+    metadata.set_execution_block_id("test")
+    metadata.new_file(dp_path="a.ms", description="a").update_status("done")
+
+    # pylint: disable-next=protected-access
+    assert isinstance(metadata._files()[0], FileRecord)
+    files = metadata.get_data().files
+    assert not isinstance(files[0], FileRecord)
+    assert files[0] == {
+        "path": "a.ms",
+        "status": "done",
+        "description": "a",
+        "crc": None,
+    }
+
+    read = MetaData(output_path)
+    # pylint: disable-next=protected-access
+    assert isinstance(read._files()[0], FileRecord)
+    assert read.get_data().dict() == metadata.get_data().dict()
+    assert not read.validate()
+
+    # entries can still be added as dictionaries
+    read.get_data().files.append({"path": "b.ms", "status": "unknown"})
+    errors = read.validate(incremental=True)
+    assert [list(error.path) for error in errors] == [["files", 1, "status"]]
+
+
+def check_serialises(data):
+    """Check that the files of a data dictionary serialise as dictionaries"""
+    files = json.loads(json.dumps(data))["files"]
+    assert json.loads(data.to_json())["files"] == files
+    assert serialisation.load(data.to_yaml())["files"] == files
+    assert yaml.safe_load(yaml.safe_dump(data.dict()))["files"] == files
+    return files
+
+
+def test_get_data_serialises(tmp_path):
+    """
+    Check that the data returned by get_data can be serialised and accessed
+    by keypath, also after files are added, and that changes made through
+    it are written
+    """
+    output_path = str(tmp_path / METADATA_FILENAME)
+    metadata = MetaData()
+    metadata.output_path = output_path
+    metadata.set_execution_block_id("test")
+    file = metadata.new_file(dp_path="a.ms", description="a")
+
+    data = metadata.get_data()
+    assert data["files[0].path"] == "a.ms"
+    assert check_serialises(data) == [
+        {"path": "a.ms", "status": "working", "description": "a", "crc": None}
+    ]
+
+    # files added afterwards are dictionaries too
+    metadata.new_file(dp_path="b.ms", description="b")
+    assert data["files[1].path"] == "b.ms"
+    assert [entry["path"] for entry in check_serialises(data)] == [
+        "a.ms",
+        "b.ms",
+    ]
+
+    # the entries handed out are those of the metadata
+    data["files[0].description"] = "changed"
+    file.update_status("done")
+    written = serialisation.load_file(output_path)["files"]
+    assert [(entry["description"], entry["status"]) for entry in written] == [
+        ("changed", "done"),
+        ("b", "working"),
+    ]
@@ -0,0 +1,55 @@
+"""Test the cost of importing the package."""
+
+import json
+import subprocess
+import sys
+
+# Budget for importing the package in a fresh interpreter, in seconds
+IMPORT_TIME_BUDGET = 1.5
+
+# Modules that are slow to import and must only be imported when used
+DEFERRED_MODULES = ["jsonschema", "ska_sdp_config"]
+
+IMPORT_CODE = f"""
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import ska_sdp_dataproduct_metadata
+elapsed = time.perf_counter() - start
+
+deferred = {DEFERRED_MODULES!r}
+print(json.dumps({{
+    "elapsed": elapsed,
+    "imported": [name for name in deferred if name in sys.modules],
+}}))
+"""
+
+
+def import_package():
+    """Import the package in a new interpreter and report on the import"""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_CODE],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(result.stdout)
+
+
+def test_import_defers_slow_modules():
+    """
+    Check that importing the package does not import the schema validator,
+    the config DB client or the logging configuration
+    """
+    assert not import_package()["imported"]
+
+
+def test_import_time():
+    """
+    Check that importing the package takes less than the budget (best of
+    three attempts)
+    """
+    elapsed = min(import_package()["elapsed"] for _ in range(3))
+    assert elapsed < IMPORT_TIME_BUDGET
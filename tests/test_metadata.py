@@ -4,12 +4,23 @@ import json
 import logging
 import os
 import shutil
+import threading
+import zlib
 
 import pytest
 import ska_sdp_config
 import yaml
 
-from ska_sdp_dataproduct_metadata import MetaData, ObsCore, new_config_client
+from ska_sdp_dataproduct_metadata import (
+    MetaData,
+    ObsCore,
+    checksum,
+    new_config_client,
+    register_template,
+    sidecar,
+)
+
+from .conftest import METADATA_FILENAME, new_metadata, read_metadata
 
 LOG = logging.getLogger("metadata-test")
 LOG.setLevel(logging.DEBUG)
@@ -17,7 +28,6 @@ LOG.setLevel(logging.DEBUG)
 CONFIG_DB_CLIENT = new_config_client()
 SUBARRAY_ID = "01"
 MOUNT_PATH = "tests/resources"
-METADATA_FILENAME = "ska-data-product.yaml"
 OUTPUT_METADATA = "tests/resources/expected_metadata.yaml"
 OUTPUT_METADATA_WITHOUT_FILES = (
     "tests/resources/expected_metadata_without_files.yaml"
@@ -66,8 +76,10 @@ def test_metadata_generation():
     metadata = MetaData()
     metadata.load_processing_block(pb_id, mount_path=MOUNT_PATH)
     metadata.write()
-    generated_metadata = read_file(f"{data_product_path}/{METADATA_FILENAME}")
-    assert generated_metadata == read_file(OUTPUT_METADATA_WITHOUT_FILES)
+    generated_metadata = read_metadata(
+        f"{data_product_path}/{METADATA_FILENAME}"
+    )
+    assert generated_metadata == read_metadata(OUTPUT_METADATA_WITHOUT_FILES)
 
     # Check when files are added
     file = metadata.new_file(
@@ -75,15 +87,55 @@ def test_metadata_generation():
         description="raw visibilities",
         crc="3421780262",
     )
-    metadata_with_files = read_file(f"{data_product_path}/{METADATA_FILENAME}")
-    assert metadata_with_files == read_file(OUTPUT_METADATA_WITH_FILES)
+    metadata_with_files = read_metadata(
+        f"{data_product_path}/{METADATA_FILENAME}"
+    )
+    assert metadata_with_files == read_metadata(OUTPUT_METADATA_WITH_FILES)
 
     # Check with status has been updated
     file.update_status("done")
-    updated_status_files_metadata = read_file(
+    updated_status_files_metadata = read_metadata(
         f"{data_product_path}/{METADATA_FILENAME}"
     )
-    assert updated_status_files_metadata == read_file(UPDATED_METADATA)
+    assert updated_status_files_metadata == read_metadata(UPDATED_METADATA)
+
+
+def test_load_processing_blocks():
+    """
+    Check that metadata for several processing blocks is loaded at once,
+    using the shared config DB client
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    # Create eb and pb
+    create_eb_pb()
+
+    for txn in CONFIG_DB_CLIENT.txn():
+        pb_id = txn.processing_block.list_keys()[0]
+        processing_block = txn.processing_block.get(pb_id)
+
+    metadata_list = MetaData.load_processing_blocks(
+        [pb_id, pb_id], mount_path=MOUNT_PATH
+    )
+    assert len(metadata_list) == 2
+    assert metadata_list[0] is not metadata_list[1]
+
+    expected = read_metadata(OUTPUT_METADATA_WITHOUT_FILES)
+    data_product_path = (
+        f"{MOUNT_PATH}/product/{processing_block.eb_id}/ska-sdp/{pb_id}"
+    )
+    for metadata in metadata_list:
+        assert metadata.runtime_abspath(".") == data_product_path
+        assert metadata.get_data().dict() == expected
+
+    # the execution block is read once, but each object has its own context
+    metadata_list[0].get_data().context["edited"] = {"value": True}
+    assert "edited" not in metadata_list[1].get_data().context
+
+    with pytest.raises(ValueError, match=r"Processing Block is None!"):
+        MetaData.load_processing_blocks([pb_id, "pb-tes-20200425-00000"])
 
 
 def test_no_eb_id_is_invalid():
@@ -163,8 +215,10 @@ def test_with_duplicate_file_path():
     metadata.load_processing_block(pb_id, mount_path=MOUNT_PATH)
     metadata.write()
 
-    generated_metadata = read_file(f"{data_product_path}/{METADATA_FILENAME}")
-    expected_metadata = read_file(OUTPUT_METADATA_WITHOUT_FILES)
+    generated_metadata = read_metadata(
+        f"{data_product_path}/{METADATA_FILENAME}"
+    )
+    expected_metadata = read_metadata(OUTPUT_METADATA_WITHOUT_FILES)
     assert generated_metadata == expected_metadata
 
     # Check when files are added
@@ -209,19 +263,19 @@ def test_custom_metadata_filename():
         description="raw visibilities",
         crc="3421780262",
     )
-    metadata_with_files = read_file(
+    metadata_with_files = read_metadata(
         f"{data_product_path}/{new_metadata_filename}"
     )
     # Expected metadata has files=[] attribute populated
     # With path etc. of files
-    assert metadata_with_files == read_file(OUTPUT_METADATA_WITH_FILES)
+    assert metadata_with_files == read_metadata(OUTPUT_METADATA_WITH_FILES)
 
     # Check with status has been updated
     file.update_status("done")
-    updated_status_files_metadata = read_file(
+    updated_status_files_metadata = read_metadata(
         f"{data_product_path}/{new_metadata_filename}"
     )
-    assert updated_status_files_metadata == read_file(UPDATED_METADATA)
+    assert updated_status_files_metadata == read_metadata(UPDATED_METADATA)
 
 
 def test_write_obscore_attributes():
@@ -254,21 +308,514 @@ def test_write_obscore_attributes():
     # write output
     metadata.write()
 
-    generated_metadata = read_file(f"{data_product_path}/{METADATA_FILENAME}")
-    expected_metadata = read_file(OUTPUT_METADATA_OBSCORE_WITHOUT_FILES)
+    generated_metadata = read_metadata(
+        f"{data_product_path}/{METADATA_FILENAME}"
+    )
+    expected_metadata = read_metadata(OUTPUT_METADATA_OBSCORE_WITHOUT_FILES)
     assert generated_metadata == expected_metadata
 
 
+def test_file_paths_match_exactly():
+    """
+    Check that files are matched on their exact (normalised) path, so that a
+    path which is a prefix of another one does not count as a duplicate
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata()
+
+    metadata.new_file(dp_path="a/b.ms", description="visibilities")
+    flags = metadata.new_file(dp_path="a/b.ms.flags", description="flags")
+
+    with pytest.raises(
+        ValueError, match=r"File with same path already exists!"
+    ):
+        metadata.new_file(dp_path="./a//b.ms", description="visibilities")
+
+    flags.update_status("done")
+    files = metadata.get_data().files
+    assert [file.path for file in files] == ["a/b.ms", "a/b.ms.flags"]
+    assert [file.status for file in files] == ["working", "done"]
+
+
+def test_update_status_of_unknown_file():
+    """
+    Check that updating the status of a file that is not in the metadata
+    raises a ValueError
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata()
+    file = metadata.new_file(dp_path="vis.ms", description="visibilities")
+    metadata.get_data().files = []
+
+    with pytest.raises(ValueError, match=r"is not in the metadata!"):
+        file.update_status("done")
+
+
+def test_batch_defers_write():
+    """
+    Check that changes made in a batch are written once, on exit
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata()
+    with metadata.batch():
+        file = metadata.new_file(dp_path="vis.ms", description="visibilities")
+        file.update_status("done")
+        assert metadata.dirty
+        assert not os.path.exists(metadata.output_path)
+
+    assert not metadata.dirty
+    files = read_metadata(metadata.output_path)["files"]
+    assert [(file["path"], file["status"]) for file in files] == [
+        ("vis.ms", "done")
+    ]
+
+
+def test_new_files():
+    """
+    Check that several files can be added at once, and that none is added
+    if any of them is a duplicate
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata(pb_id="test-new-files")
+    metadata.autoflush = False
+    files = metadata.new_files(
+        [
+            {"dp_path": "a.ms", "description": "a"},
+            {"dp_path": "b.ms", "description": "b", "crc": "1"},
+        ]
+    )
+    assert [file.full_path for file in files] == ["/a.ms", "/b.ms"]
+    assert not os.path.exists(metadata.output_path)
+
+    with pytest.raises(
+        ValueError, match=r"File with same path already exists!"
+    ):
+        metadata.new_files(
+            [
+                {"dp_path": "c.ms", "description": "c"},
+                {"dp_path": "a.ms", "description": "a"},
+            ]
+        )
+    with pytest.raises(
+        ValueError, match=r"File with same path already exists!"
+    ):
+        metadata.new_files(
+            [
+                {"dp_path": "c.ms", "description": "c"},
+                {"dp_path": "./c.ms", "description": "c"},
+            ]
+        )
+
+    metadata.flush()
+    written = read_metadata(metadata.output_path)["files"]
+    assert [file["path"] for file in written] == ["a.ms", "b.ms"]
+
+
+def test_incremental_validation():
+    """
+    Check that incremental validation finds the same errors as a full
+    validation, for changes to file entries and to sections
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata()
+    metadata.new_file(dp_path="a.ms", description="a")
+    file = metadata.new_file(dp_path="b.ms", description="b")
+    assert not metadata.validate(incremental=True)
+
+    with pytest.raises(MetaData.ValidationError) as excinfo:
+        file.update_status("unknown")
+    errors = excinfo.value.errors
+    assert [list(error.path) for error in errors] == [["files", 1, "status"]]
+    assert [list(error.path) for error in metadata.validate()] == [
+        ["files", 1, "status"]
+    ]
+
+    file.update_status("done")
+    metadata.get_data().obscore.calib_level = 5
+    errors = metadata.validate(incremental=True)
+    assert [list(error.path) for error in errors] == [
+        ["obscore", "calib_level"]
+    ]
+    assert [error.message for error in errors] == [
+        error.message for error in metadata.validate()
+    ]
+
+
+def test_validation_of_data_handed_out():
+    """
+    Check that file entries changed through the data returned by get_data
+    are validated, also when the reference is kept across writes
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata()
+    data = metadata.get_data()
+    metadata.new_file(dp_path="a.ms", description="a")
+    metadata.new_file(dp_path="b.ms", description="b")
+    data.files[0]["status"] = "bogus"
+    with pytest.raises(MetaData.ValidationError) as excinfo:
+        metadata.new_file(dp_path="c.ms", description="c")
+    errors = excinfo.value.errors
+    assert [list(error.path) for error in errors] == [["files", 0, "status"]]
+    assert read_metadata(metadata.output_path)["files"][0]["status"] == (
+        "working"
+    )
+
+
+@pytest.mark.parametrize("durability", list(MetaData.Durability))
+def test_write_durability(durability):
+    """
+    Check that the metadata is written with each durability policy, without
+    leaving temporary files behind
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata()
+    metadata.durability = durability
+    metadata.new_file(dp_path="vis.ms", description="visibilities")
+
+    assert read_metadata(metadata.output_path)["files"][0]["path"] == "vis.ms"
+    output_dir = os.path.dirname(metadata.output_path)
+    assert os.listdir(output_dir) == [METADATA_FILENAME]
+
+
+def test_failed_write_keeps_previous_file(monkeypatch):
+    """
+    Check that the previous metadata file is left intact if writing fails
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata()
+    metadata.durability = MetaData.Durability.FILE
+    metadata.write()
+    previous = read_metadata(metadata.output_path)
+
+    def fail(_):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "fsync", fail)
+    with pytest.raises(OSError, match=r"disk full"):
+        metadata.new_file(dp_path="vis.ms", description="visibilities")
+
+    assert read_metadata(metadata.output_path) == previous
+    output_dir = os.path.dirname(metadata.output_path)
+    assert os.listdir(output_dir) == [METADATA_FILENAME]
+
+
+def test_journal():
+    """
+    Check that changes are appended to the journal, folded into the metadata
+    file on compaction, and replayed when reading the metadata file
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata()
+    metadata.journal = True
+    metadata.journal_compaction = 3
+    journal_path = f"{metadata.output_path}.journal"
+
+    # The first change writes the metadata file, later ones the journal
+    file = metadata.new_file(dp_path="a.ms", description="a")
+    assert not os.path.exists(journal_path)
+    file.update_status("done")
+    metadata.new_file(dp_path="b.ms", description="b")
+    assert len(read_metadata(metadata.output_path)["files"]) == 1
+    assert os.path.exists(journal_path)
+
+    # A pending journal is replayed when reading
+    replayed = MetaData(metadata.output_path)
+    files = replayed.get_data().files
+    assert [(file.path, file.status) for file in files] == [
+        ("a.ms", "done"),
+        ("b.ms", "working"),
+    ]
+
+    # Compaction after journal_compaction records
+    metadata.new_file(dp_path="c.ms", description="c")
+    assert not os.path.exists(journal_path)
+    assert len(read_metadata(metadata.output_path)["files"]) == 3
+
+    metadata.new_file(dp_path="d.ms", description="d")
+    assert os.path.exists(journal_path)
+    metadata.close()
+    assert not os.path.exists(journal_path)
+    assert len(read_metadata(metadata.output_path)["files"]) == 4
+
+
+def test_journal_replay_written():
+    """
+    Check that a journal replayed when reading the metadata file is folded
+    into it by close
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata(journal=True)
+    metadata.new_file(dp_path="a.ms", description="a")
+    metadata.new_file(dp_path="b.ms", description="b")
+    journal_path = f"{metadata.output_path}.journal"
+    assert os.path.exists(journal_path)
+
+    replayed = MetaData(metadata.output_path, journal=True)
+    replayed.output_path = metadata.output_path
+    assert replayed.dirty
+    replayed.close()
+    assert not os.path.exists(journal_path)
+    assert [
+        file["path"] for file in read_metadata(replayed.output_path)["files"]
+    ] == [
+        "a.ms",
+        "b.ms",
+    ]
+
+
+def test_templates():
+    """
+    Check that metadata created from a template is independent of the
+    template and of other metadata, and that templates can be registered
+    """
+    metadata = MetaData()
+    metadata.get_data().obscore.instrument_name = ObsCore.SKA_MID
+    assert MetaData().get_data().obscore.instrument_name == ObsCore.UNKNOWN
+
+    template = MetaData().get_data().dict()
+    template["obscore"]["instrument_name"] = ObsCore.SKA_LOW
+    register_template("ska-low", template)
+    template["obscore"]["instrument_name"] = ObsCore.SKA_MID
+
+    low_metadata = MetaData(template="ska-low")
+    assert low_metadata.get_data().obscore.instrument_name == ObsCore.SKA_LOW
+    low_metadata.get_data().obscore.instrument_name = ObsCore.UNKNOWN
+    low_metadata = MetaData(template="ska-low")
+    assert low_metadata.get_data().obscore.instrument_name == ObsCore.SKA_LOW
+
+    with pytest.raises(ValueError, match=r"Unknown metadata template"):
+        MetaData(template="unknown")
+
+
+def test_compute_crc(tmp_path):
+    """
+    Check that the CRC of a file is computed when its status is updated
+    to done
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    contents = b"visibilities" * 1000
+    data_path = tmp_path / "vis.dat"
+    data_path.write_bytes(contents)
+
+    metadata = new_test_metadata()
+    file = metadata.new_file(
+        dp_path=str(data_path), description="visibilities", compute_crc=True
+    )
+    assert read_metadata(metadata.output_path)["files"][0]["crc"] is None
+
+    file.update_status("done")
+    crc = read_metadata(metadata.output_path)["files"][0]["crc"]
+    assert crc == str(zlib.crc32(contents))
+
+
+def test_crc_computed_without_lock(tmp_path, monkeypatch):
+    """
+    Check that other threads can change the metadata while the CRC of a
+    file is computed
+    """
+    data_path = tmp_path / "vis.dat"
+    data_path.write_bytes(b"visibilities")
+    metadata = new_metadata(str(tmp_path / METADATA_FILENAME))
+    file = metadata.new_file(
+        dp_path=str(data_path), description="visibilities", compute_crc=True
+    )
+    crc32_path = checksum.crc32_path
+
+    def crc32_path_while_changing(path, **kwargs):
+        thread = threading.Thread(
+            target=metadata.new_file,
+            kwargs={"dp_path": "other.dat", "description": "other"},
+        )
+        thread.start()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        return crc32_path(path, **kwargs)
+
+    monkeypatch.setattr(checksum, "crc32_path", crc32_path_while_changing)
+    file.update_status("done")
+    assert [
+        (entry["path"], entry["status"], entry["crc"])
+        for entry in read_metadata(metadata.output_path)["files"]
+    ] == [
+        (str(data_path), "done", str(zlib.crc32(b"visibilities"))),
+        ("other.dat", "working", None),
+    ]
+
+
+def test_scan(tmp_path, monkeypatch):
+    """
+    Check that scanning a directory registers the data products in it with
+    a single write, and that scanning again only registers changes
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    for name, contents in {
+        "image.fits": b"image",
+        "logs/run.log": b"log",
+        "sub/cube.fits": b"cube" * 1000,
+        "vis.ms/table.f0": b"visibilities",
+        "vis.ms/table.dat": b"",
+    }.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(contents)
+
+    metadata = new_test_metadata()
+    writes = []
+    monkeypatch.setattr(
+        metadata, "write", lambda: writes.append(MetaData.write(metadata))
+    )
+
+    files = metadata.scan(
+        str(tmp_path),
+        pattern="*.*",
+        predicate=lambda path: not path.endswith(".log"),
+        description=os.path.basename,
+        compute_crc=True,
+    )
+    assert [file.full_path for file in files] == [
+        str(tmp_path / name)
+        for name in ["image.fits", "sub/cube.fits", "vis.ms"]
+    ]
+    assert len(writes) == 1
+    entries = read_metadata(metadata.output_path)["files"]
+    assert [entry["size"] for entry in entries] == [1, 4, 1]
+    assert [entry["status"] for entry in entries] == ["done"] * 3
+    assert entries[0]["crc"] == str(zlib.crc32(b"image"))
+    assert entries[1]["description"] == "cube.fits"
+
+    # Nothing changed
+    assert not metadata.scan(str(tmp_path), pattern="*.fits")
+    assert len(writes) == 1
+
+    # Only new or modified data products are registered
+    (tmp_path / "image.fits").write_bytes(b"modified image")
+    (tmp_path / "sub/new.fits").write_bytes(b"new")
+    files = metadata.scan(str(tmp_path), pattern="*.fits", compute_crc=True)
+    assert [file.full_path for file in files] == [
+        str(tmp_path / name) for name in ["image.fits", "sub/new.fits"]
+    ]
+    assert len(writes) == 2
+    entries = read_metadata(metadata.output_path)["files"]
+    assert len(entries) == 4
+    assert entries[0]["crc"] == str(zlib.crc32(b"modified image"))
+
+
+def test_scan_product_directory(tmp_path):
+    """
+    Check that scanning the directory of the metadata file does not
+    register the files written with it
+    """
+    metadata = MetaData(coordinated=True, sidecar=True)
+    metadata.output_path = str(tmp_path / METADATA_FILENAME)
+    metadata.set_execution_block_id("test")
+    metadata.write()
+    assert os.path.exists(sidecar.sidecar_path(metadata.output_path))
+    (tmp_path / f".{METADATA_FILENAME}.0123.tmp").write_text("partial")
+    (tmp_path / "vis.ms").write_bytes(b"visibilities")
+
+    files = metadata.scan(str(tmp_path))
+    assert [file.full_path for file in files] == [str(tmp_path / "vis.ms")]
+    assert not metadata.scan(str(tmp_path))
+
+
+def test_lazy_reading():
+    """
+    Check that the files section is only parsed when it is needed when
+    reading lazily, and that peek only reads the requested sections
+    """
+
+    # Wipe config db and directories
+    clean_up(f"{MOUNT_PATH}/product")
+
+    metadata = new_test_metadata(journal=True)
+    metadata.new_file(dp_path="a.ms", description="a")
+    metadata.get_data().obscore.calib_level = 1
+    metadata.write()
+    metadata.new_file(dp_path="b.ms", description="b")
+    path = metadata.output_path
+
+    # the journal is replayed, which needs the files
+    lazy = MetaData(path, lazy=True)
+    assert [file.path for file in lazy.get_data().files] == ["a.ms", "b.ms"]
+
+    metadata.close()
+    with open(path, "r", encoding="utf8") as metadata_file:
+        text = metadata_file.read()
+    assert MetaData.peek(path, ["execution_block", "files"]) == {
+        "execution_block": "test",
+        "files": read_metadata(path)["files"],
+    }
+
+    # break the files section: only parsing it fails
+    with open(path, "w", encoding="utf8") as metadata_file:
+        metadata_file.write(text.replace("- crc: null", "- crc: [", 1))
+    assert MetaData.peek(path)["obscore"]["calib_level"] == 1
+    lazy = MetaData(path, lazy=True)
+    lazy.output_path = path
+    with pytest.raises(yaml.YAMLError):
+        lazy.new_file(dp_path="c.ms", description="c")
+    with pytest.raises(yaml.YAMLError):
+        MetaData(path)
+
+    with open(path, "w", encoding="utf8") as metadata_file:
+        metadata_file.write(text)
+    lazy = MetaData(path, lazy=True)
+    lazy.output_path = path
+    lazy.new_file(dp_path="c.ms", description="c")
+    assert [file["path"] for file in read_metadata(path)["files"]] == [
+        "a.ms",
+        "b.ms",
+        "c.ms",
+    ]
+
+
 # -----------------------------------------------------------------------------
 # Ancillary functions
 # -----------------------------------------------------------------------------
 
 
-def read_file(file):
-    """Read and load files into yaml"""
-    with open(file, "r", encoding="utf8") as input_file:
-        data = yaml.safe_load(input_file)
-    return data
+def new_test_metadata(pb_id="test", **kwargs):
+    """Create a MetaData object writing below the test mount path"""
+    return new_metadata(
+        f"{MOUNT_PATH}/product/test/ska-sdp/{pb_id}/{METADATA_FILENAME}",
+        **kwargs,
+    )
 
 
 def clean_up(path):
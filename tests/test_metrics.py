@@ -0,0 +1,103 @@
+"""Test the metrics of metadata operations."""
+
+import json
+import logging
+
+from ska_sdp_dataproduct_metadata import MetaData
+from ska_sdp_dataproduct_metadata.metrics import Metrics
+
+from .conftest import METADATA_FILENAME, new_metadata
+
+
+def test_registry():
+    """Check that timings and counts are recorded per label"""
+    metrics = Metrics()
+    recorded = []
+    metrics.subscribe(lambda *args: recorded.append(args))
+
+    metrics.observe("validation_seconds", 0.5, processing_block="pb-1")
+    metrics.observe("validation_seconds", 0.25, processing_block="pb-1")
+    metrics.observe("validation_seconds", 1.0, processing_block="pb-2")
+    metrics.increment("bytes_written", 100)
+    timings = {}
+    with metrics.timer("write_seconds", timings):
+        pass
+
+    assert recorded[0] == (
+        "validation_seconds",
+        0.5,
+        {"processing_block": "pb-1"},
+    )
+    assert len(recorded) == 5
+    assert timings["write_seconds"] >= 0
+    snapshot = {
+        (metric["name"], tuple(metric["labels"].items())): metric
+        for metric in metrics.snapshot()
+    }
+    pb_1 = snapshot[("validation_seconds", (("processing_block", "pb-1"),))]
+    assert (pb_1["kind"], pb_1["count"], pb_1["sum"]) == ("timer", 2, 0.75)
+    written = snapshot[("bytes_written", ())]
+    assert (written["kind"], written["count"], written["sum"]) == (
+        "counter",
+        1,
+        100,
+    )
+
+    metrics.reset()
+    assert not metrics.snapshot()
+
+
+def test_prometheus_textfile(tmp_path):
+    """Check the format of the exported metrics"""
+    textfile = tmp_path / "metadata.prom"
+    metrics = Metrics(str(textfile))
+    metrics.observe("write_seconds", 0.5, processing_block='pb-"1"')
+    metrics.observe("write_seconds", 1.5)
+    metrics.increment("bytes_written", 10)
+    metrics.export()
+
+    prefix = "ska_sdp_dataproduct_metadata_"
+    assert textfile.read_text(encoding="utf8") == (
+        f"# TYPE {prefix}bytes_written counter\n"
+        f"{prefix}bytes_written_total 10\n"
+        f"# TYPE {prefix}write_seconds summary\n"
+        f"{prefix}write_seconds_count 1\n"
+        f"{prefix}write_seconds_sum 1.5\n"
+        f'{prefix}write_seconds_count{{processing_block="pb-\\"1\\""}} 1\n'
+        f'{prefix}write_seconds_sum{{processing_block="pb-\\"1\\""}} 0.5\n'
+    )
+
+
+def test_metadata_writes(tmp_path, monkeypatch, caplog):
+    """Check that writing metadata records metrics and logs a line"""
+    metrics = Metrics(str(tmp_path / "metadata.prom"))
+    monkeypatch.setattr(MetaData, "metrics", metrics)
+    monkeypatch.setattr(metrics, "log_level", logging.INFO)
+
+    output_path = str(tmp_path / "product" / METADATA_FILENAME)
+    for coordinated in (False, True):
+        metadata = new_metadata(output_path, coordinated=coordinated)
+        with caplog.at_level(logging.INFO, "ska_sdp_dataproduct_metadata"):
+            metadata.new_file(dp_path="data.bin", description="data")
+
+    records = [
+        json.loads(record.getMessage())
+        for record in caplog.records
+        if "metadata_write" in record.getMessage()
+    ]
+    assert len(records) == 2
+    with open(output_path, "rb") as metadata_file:
+        size = len(metadata_file.read())
+    assert records[1]["bytes"] == size
+    assert records[1]["files"] == 1
+    assert records[1]["path"] == output_path
+    assert "lock_wait_seconds" in records[1]
+    assert "lock_wait_seconds" not in records[0]
+
+    totals = {metric["name"]: metric for metric in metrics.snapshot()}
+    assert totals["flush_seconds"]["count"] == 2
+    assert totals["bytes_written"]["sum"] == records[0]["bytes"] + size
+    for name in ("validation_seconds", "serialisation_seconds"):
+        assert totals[name]["count"] == 2
+    exported = (tmp_path / "metadata.prom").read_text(encoding="utf8")
+    assert "ska_sdp_dataproduct_metadata_flush_seconds_count 2" in exported
@@ -0,0 +1,200 @@
+"""Test patches between metadata documents."""
+
+import copy
+import random
+
+import pytest
+
+from ska_sdp_dataproduct_metadata import MetaData, ObsCore, patch, sidecar
+from ska_sdp_dataproduct_metadata.filetable import FileRecord
+
+from .conftest import METADATA_FILENAME, new_metadata
+
+
+def plain(metadata):
+    """
+    The data of a MetaData object as plain dictionaries, without handing
+    it out as get_data does
+    """
+    document = metadata._document()  # pylint: disable=protected-access
+    return copy.deepcopy(document) | {
+        "files": [dict(entry) for entry in document["files"]]
+    }
+
+
+def test_diff():
+    """
+    Check that the patch between two MetaData objects consists of compact
+    operations, and transforms one into the other
+    """
+    metadata = MetaData(autoflush=False)
+    metadata.set_execution_block_id("test")
+    metadata.new_file(dp_path="a.ms", description="a")
+    metadata.new_file(dp_path="b.ms", description="b")
+    other = MetaData()
+    other.get_data().update(plain(metadata))
+
+    other.get_data().files[1]["status"] = "done"
+    other.get_data().files.append({"path": "c.ms", "status": "working"})
+    other.get_data().obscore.instrument_name = ObsCore.SKA_LOW
+    del other.get_data().obscore["dataproduct_type"]
+
+    result = metadata.diff(other)
+    assert result["base"] == metadata.sequence
+    assert result["sequence"] == other.sequence
+    assert result["ops"] == [
+        {"op": "replace", "path": "/files/1/status", "value": "done"},
+        {
+            "op": "add",
+            "path": "/files/-",
+            "value": {"path": "c.ms", "status": "working"},
+        },
+        {"op": "remove", "path": "/obscore/dataproduct_type"},
+        {
+            "op": "replace",
+            "path": "/obscore/instrument_name",
+            "value": ObsCore.SKA_LOW,
+        },
+    ]
+    metadata.apply_patch(result)
+    # pylint: disable-next=protected-access
+    assert isinstance(metadata._files()[2], FileRecord)
+    assert plain(metadata) == plain(other)
+    assert not metadata.diff(other)["ops"]
+
+
+def test_replication(tmp_path):
+    """
+    Check that the patches of the writes of a metadata file replicate it,
+    applied in order
+    """
+    producer = new_metadata(str(tmp_path / "a" / METADATA_FILENAME))
+    patches = []
+    producer.changelog.subscribe(patches.append)
+    replica = new_metadata(
+        str(tmp_path / "b" / METADATA_FILENAME), sidecar=True
+    )
+
+    def replicate():
+        while patches:
+            replica.apply_patch(patches.pop(0))
+        assert plain(replica) == plain(producer)
+        assert replica.sequence == producer.sequence
+        assert sidecar.read_sequence(replica.output_path) == producer.sequence
+
+    # the first patch replaces the whole document
+    file = producer.new_file(dp_path="a.ms", description="a")
+    assert patches[0]["base"] is None
+    assert patches[0]["ops"][0]["path"] == ""
+    replicate()
+
+    file.update_status("done")
+    assert patches[0]["base"] == 1
+    assert patches[0]["ops"] == [
+        {"op": "replace", "path": "/files/0/status", "value": "done"}
+    ]
+    with producer.batch():
+        for name in ["b.ms", "c.ms"]:
+            producer.new_file(dp_path=name, description=name)
+        producer.get_data().obscore.obs_id = "obs-1"
+    producer.new_file(dp_path="d.ms", description="d")
+    assert [patch["sequence"] for patch in patches] == [2, 3, 4]
+    replicate()
+
+    # patches only apply in order, and the replica is left unchanged
+    producer.new_file(dp_path="e.ms", description="e")
+    producer.new_file(dp_path="f.ms", description="f")
+    with pytest.raises(ValueError):
+        replica.apply_patch(patches[1])
+    replicate()
+
+    # a patch which cannot be applied does not change the replica
+    producer.get_data().files[0]["description"] = "changed"
+    producer.write()
+    invalid = copy.deepcopy(patches[0])
+    invalid["ops"].append({"op": "remove", "path": "/files/10"})
+    before = plain(replica)
+    with pytest.raises(ValueError):
+        replica.apply_patch(invalid)
+    assert plain(replica) == before
+    replicate()
+
+    # no patches are made without subscribers
+    producer.changelog.unsubscribe(patches.append)
+    producer.new_file(dp_path="g.ms", description="g")
+    assert not patches
+
+
+def random_document(rng):
+    """Random metadata document"""
+    paths = rng.sample(
+        [f"{index}.ms" for index in range(8)], rng.randint(0, 6)
+    )
+    files = [
+        {
+            "path": path,
+            "status": rng.choice(["working", "done", "failure"]),
+            **(
+                {"crc": rng.choice([None, "1", 1])}
+                if rng.random() < 0.5
+                else {}
+            ),
+            **(
+                {"size": rng.choice([1, 1.0, True])}
+                if rng.random() < 0.5
+                else {}
+            ),
+        }
+        for path in paths
+    ]
+    obscore = {
+        key: rng.choice([1, "1", None, [1], {"a/b~": 1}])
+        for key in rng.sample(["a", "b", "c/d", "e~f"], rng.randint(0, 4))
+    }
+    return {"execution_block": "eb", "files": files, "obscore": obscore}
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_patch_round_trip(seed):
+    """
+    Check that applying the operations between random documents transforms
+    one into the other
+    """
+    rng = random.Random(seed)
+    for _ in range(300):
+        old, new = random_document(rng), random_document(rng)
+        ops = patch.diff(old, new)
+        assert patch.apply(copy.deepcopy(old), ops) == new
+        assert not patch.diff(new, new)
+
+
+def test_apply():
+    """Check the operations of JSON Patch and the failures of a patch"""
+    document = {"a": {"b": [1, 2]}, "c": 1}
+    ops = [
+        {"op": "test", "path": "/c", "value": 1},
+        {"op": "add", "path": "/a/b/0", "value": 0},
+        {"op": "add", "path": "/a/b/-", "value": 3},
+        {"op": "replace", "path": "/c", "value": {"d": True}},
+        {"op": "add", "path": "/a~1b", "value": None},
+        {"op": "remove", "path": "/a/b/1"},
+    ]
+    assert patch.apply(document, ops) == {
+        "a": {"b": [0, 2, 3]},
+        "c": {"d": True},
+        "a/b": None,
+    }
+
+    original = copy.deepcopy(document)
+    for failing in [
+        {"op": "test", "path": "/c/d", "value": 1},
+        {"op": "replace", "path": "/x", "value": 1},
+        {"op": "remove", "path": "/a/b/9"},
+        {"op": "add", "path": "/a/b/01", "value": 1},
+        {"op": "add", "path": "/c/d/e", "value": 1},
+        {"op": "move", "from": "/c", "path": "/d"},
+        {"op": "remove", "path": ""},
+    ]:
+        with pytest.raises(ValueError):
+            patch.apply(document, ops[1:] + [failing])
+        assert document == original
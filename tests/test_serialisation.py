@@ -0,0 +1,115 @@
+"""Test reading and writing metadata as YAML."""
+
+import enum
+import os
+
+import pytest
+
+from ska_sdp_dataproduct_metadata import ObsCore, serialisation
+
+RESOURCES = os.path.join(os.path.dirname(__file__), "resources")
+
+DOCUMENT = {
+    "execution_block": "eb-test-20200325-00001",
+    "context": {
+        "notes": "A long line of notes, " * 20,
+        "multiline": "first line\nsecond line\n",
+        "unicode": "ünïcöde € \U0001f600",
+        "special": ["null", "yes", "1.0", " leading", "a: b", "- x", "#c"],
+        "numbers": [0, -12345678901234, 2.5, 1e-20, True, None],
+    },
+    "files": [
+        {
+            "crc": None,
+            "description": "raw visibilities",
+            "path": "vis.ms",
+            "status": "done",
+        }
+    ],
+    "obscore": {
+        "dataproduct_type": ObsCore.DataProductType.MS,
+        "calib_level": ObsCore.CalibrationLevel.LEVEL_1,
+    },
+}
+
+
+@pytest.mark.parametrize("backend", list(serialisation.BACKENDS))
+def test_round_trip(backend):
+    """
+    Check that dumped data is loaded back unchanged, with enumeration
+    members converted to their values
+    """
+    text = serialisation.dump(DOCUMENT, backend)
+    data = serialisation.load(text, backend)
+    assert data == DOCUMENT
+    for value in data["obscore"].values():
+        assert not isinstance(value, enum.Enum)
+
+
+@pytest.mark.skipif(
+    serialisation.LIBYAML not in serialisation.BACKENDS,
+    reason="PyYAML is built without libyaml",
+)
+@pytest.mark.parametrize(
+    "filename",
+    sorted(name for name in os.listdir(RESOURCES) if name.endswith(".yaml")),
+)
+def test_backends_are_identical(filename):
+    """
+    Check that both backends load the same data and dump it to exactly the
+    same text
+    """
+    path = os.path.join(RESOURCES, filename)
+    data = serialisation.load_file(path, serialisation.LIBYAML)
+    assert data == serialisation.load_file(path, serialisation.PYTHON)
+
+    for document in (data, DOCUMENT):
+        assert serialisation.dump(
+            document, serialisation.LIBYAML
+        ) == serialisation.dump(document, serialisation.PYTHON)
+
+
+def test_unknown_backend():
+    """Check that an unknown backend is rejected"""
+    with pytest.raises(ValueError, match=r"YAML backend"):
+        serialisation.dump(DOCUMENT, "unknown")
+
+
+@pytest.mark.parametrize("backend", list(serialisation.BACKENDS))
+def test_load_sections(backend):
+    """
+    Check that top-level entries are split and loaded without parsing the
+    others, and that other documents are loaded in full
+    """
+    text = serialisation.dump(DOCUMENT, backend)
+    sections = serialisation.split_sections(text)
+    assert list(sections) == ["context", "execution_block", "files", "obscore"]
+    assert "".join(sections.values()) == text
+
+    plain = serialisation.to_plain(DOCUMENT)
+    keys = ["obscore", "execution_block", "unknown"]
+    expected = {key: plain[key] for key in keys if key in plain}
+    assert serialisation.load_sections(text, keys, backend) == expected
+
+    data, deferred = serialisation.load_deferred(text, ["files"], backend)
+    assert "files" not in data
+    assert {**data, **serialisation.load(deferred["files"])} == plain
+
+    # a broken files section is not parsed
+    broken = text.replace("- crc: null", "- crc: [")
+    assert serialisation.load_sections(broken, keys, backend) == expected
+
+    # documents which cannot be split are loaded in full
+    for other in (
+        "--- \n" + text,
+        "# comment\n" + text.replace("obscore:", "obscore: &o") + "x: *o\n",
+        "{execution_block: eb, files: [],\nobscore: {}}\n",
+    ):
+        loaded = serialisation.load(other, backend)
+        assert serialisation.load_sections(other, keys, backend) == {
+            key: loaded[key] for key in keys if key in loaded
+        }
+        data, deferred = serialisation.load_deferred(other, ["files"])
+        assert {**data, **serialisation.load(deferred.get("files", "{}"))} == (
+            loaded
+        )
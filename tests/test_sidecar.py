@@ -0,0 +1,71 @@
+"""Test the JSON sidecar of metadata files."""
+
+import datetime
+
+from ska_sdp_dataproduct_metadata import MetaData, serialisation, sidecar
+
+from .conftest import METADATA_FILENAME, new_metadata, read_metadata
+
+
+def test_sidecar(tmp_path, monkeypatch):
+    """
+    Check that the sidecar mirrors the metadata file with an increasing
+    sequence number, and that it is preferred when it is up to date
+    """
+    output_path = str(tmp_path / "product" / METADATA_FILENAME)
+    metadata = new_metadata(output_path, sidecar=True)
+    assert sidecar.read_sequence(output_path) is None
+
+    file = metadata.new_file(dp_path="a.ms", description="a")
+    assert sidecar.read_sequence(output_path) == metadata.sequence == 1
+    file.update_status("done")
+    assert sidecar.read_sequence(output_path) == metadata.sequence == 2
+    sequence, data = sidecar.load(output_path)
+    assert sequence == 2
+    assert data == read_metadata(output_path)
+
+    # the sidecar is read instead of the metadata file
+    with monkeypatch.context() as patch:
+        patch.setattr(serialisation, "load_file", None)
+        read = MetaData(output_path, sidecar=True)
+    assert read.sequence == 2
+    assert read.get_data().dict() == metadata.get_data().dict()
+    read.output_path = output_path
+    read.new_file(dp_path="b.ms", description="b")
+    assert sidecar.read_sequence(output_path) == 3
+
+    # the sequence continues when another object writes
+    coordinated = new_metadata(output_path, sidecar=True, coordinated=True)
+    coordinated.new_file(dp_path="c.ms", description="c")
+    assert coordinated.sequence == 4
+    _, data = sidecar.load(output_path)
+    assert [entry["path"] for entry in data["files"]] == [
+        "a.ms",
+        "b.ms",
+        "c.ms",
+    ]
+
+    # a sidecar is out of date once the metadata file is replaced without it
+    new_metadata(output_path).new_file(dp_path="d.ms", description="d")
+    assert sidecar.read_sequence(output_path) is None
+    assert sidecar.load(output_path) is None
+    read = MetaData(output_path)
+    assert read.sequence == 0
+    assert [file.path for file in read.get_data().files] == ["d.ms"]
+
+
+def test_sidecar_date(tmp_path):
+    """
+    Check that a date in the metadata is written to the sidecar as a
+    string, along with the metadata file
+    """
+    output_path = str(tmp_path / METADATA_FILENAME)
+    metadata = new_metadata(output_path, sidecar=True)
+    metadata.get_data().context["date"] = datetime.date(2024, 1, 2)
+    metadata.write()
+    assert read_metadata(output_path)["context"]["date"] == datetime.date(
+        2024, 1, 2
+    )
+    _, data = sidecar.load(output_path)
+    assert data["context"]["date"] == "2024-01-02"
+    assert sidecar.read_sequence(output_path) == metadata.sequence == 1
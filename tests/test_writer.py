@@ -0,0 +1,151 @@
+"""Test writing metadata in the background."""
+
+import gc
+import threading
+import time
+import types
+
+import pytest
+
+from ska_sdp_dataproduct_metadata import MetaData
+from ska_sdp_dataproduct_metadata import writer as writer_module
+
+from .conftest import METADATA_FILENAME, new_metadata, read_metadata
+
+
+@pytest.fixture(name="background")
+def background_fixture(monkeypatch):
+    """
+    Record the background writes of MetaData objects, and the files they
+    write, holding them back until released
+    """
+    background = types.SimpleNamespace(
+        started=threading.Event(),
+        released=threading.Event(),
+        attempts=[],
+        writes=[],
+    )
+    # pylint: disable-next=protected-access
+    write_in_background = MetaData._write_in_background
+    write_atomic = writer_module.write_atomic
+
+    def recording_write_in_background(metadata):
+        background.started.set()
+        background.released.wait(10)
+        try:
+            write_in_background(metadata)
+        finally:
+            background.attempts.append(time.monotonic())
+
+    def recording_write_atomic(*args):
+        background.writes.append(time.monotonic())
+        write_atomic(*args)
+
+    def wait(count):
+        deadline = time.monotonic() + 10
+        while len(background.attempts) < count:
+            assert time.monotonic() < deadline, "metadata was not written"
+            time.sleep(0.01)
+
+    background.wait = wait
+    monkeypatch.setattr(
+        MetaData, "_write_in_background", recording_write_in_background
+    )
+    monkeypatch.setattr(writer_module, "write_atomic", recording_write_atomic)
+    return background
+
+
+def test_background_writes(tmp_path, background):
+    """
+    Check that changes from several threads are written in the background
+    at most once per interval, and that failed writes are reported
+    """
+    metadata = new_metadata(
+        str(tmp_path / METADATA_FILENAME), write_interval=0.1
+    )
+    metadata.new_file(dp_path="first.dat", description="first")
+    assert background.started.wait(10)
+
+    def register(prefix):
+        for index in range(100):
+            file = metadata.new_file(dp_path=f"{prefix}-{index}.dat")
+            file.update_status("done")
+
+    # the files are missing a description, which is only found on writing
+    threads = [
+        threading.Thread(target=register, args=(prefix,))
+        for prefix in ("a", "b")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # the first write started before the threads made their changes, which
+    # are written by a second write
+    background.released.set()
+    background.wait(2)
+    # the change failing with the error of the write is not applied
+    with pytest.raises(MetaData.ValidationError):
+        metadata.new_file(dp_path="c.dat", description="c")
+    assert not background.writes
+    assert "c.dat" not in [
+        entry["path"] for entry in metadata.get_data().dict()["files"]
+    ]
+
+    for entry in metadata.get_data().dict()["files"]:
+        entry["description"] = entry["description"] or "x"
+    with metadata.batch():
+        file = metadata.new_file(dp_path="d.dat", description="d")
+        file.update_status("done")
+    background.wait(3)
+    assert len(background.writes) == 1
+    assert len(read_metadata(metadata.output_path)["files"]) == 202
+
+    for index in range(50):
+        file.update_status("failure" if index % 2 else "done")
+    metadata.close()
+    assert (
+        read_metadata(metadata.output_path)["files"][-1]["status"] == "failure"
+    )
+    # background writes are at least the interval apart
+    writes = background.writes[:-1]
+    assert all(
+        later - earlier >= 0.1 for earlier, later in zip(writes, writes[1:])
+    )
+
+
+def test_background_writes_after_close(tmp_path):
+    """
+    Check that changes made after closing an object with background writes
+    are written before they return, and that the writer threads of objects
+    which are no longer used stop
+    """
+    metadata = new_metadata(
+        str(tmp_path / METADATA_FILENAME), write_interval=0.1
+    )
+    metadata.new_file(dp_path="a.ms", description="a")
+    metadata.close()
+    metadata.new_file(dp_path="b.ms", description="b")
+    assert not metadata.dirty
+    assert [
+        entry["path"] for entry in read_metadata(metadata.output_path)["files"]
+    ] == ["a.ms", "b.ms"]
+
+    def writer_threads():
+        return [
+            thread
+            for thread in threading.enumerate()
+            if thread.name == "MetaData writer"
+        ]
+
+    threads = len(writer_threads())
+    base = new_metadata(None, write_interval=0.1)
+    clones = [base.clone() for _ in range(10)]
+    assert len(writer_threads()) == threads + 11
+    del clones
+    base.close()
+    gc.collect()
+    deadline = time.monotonic() + 10
+    while len(writer_threads()) > threads and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(writer_threads()) == threads